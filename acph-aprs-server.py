@@ -0,0 +1,66 @@
+import sys
+import os
+import logging
+import argparse
+
+from acph.class_aprs_server import AcphAprsServer, SERVER_HOST, SERVER_PORT, SERVER_SPEED
+from acph.aprs_capture import read_beacons, capture_date
+
+def capture_beacons(args):
+	# the beacons of the capture files one after the other
+	def beacons():
+		for filepath in args.files:
+			for raw_message, reference, beacon_date in read_beacons(filepath, capture_date(filepath, args.date)):
+				yield raw_message, reference
+	return beacons
+
+def synthetic_beacons(args):
+	from acph.class_airport_db import OurAirportsDatabase
+	from benchmark.traffic import TrafficGenerator
+
+	airports = OurAirportsDatabase.withCsvFile(args.airports_dir, country='FR').airports
+	traffic = TrafficGenerator(airports, aircraft=args.synthetic, duration=args.duration, seed=args.seed)
+	beacons = [(raw_message, timestamp) for timestamp, raw_message in traffic.beacons()]
+	logging.getLogger('acph.main').warning('Synthetic traffic of {} aircraft, {} beacons around {} airfields'.format(len(traffic.devices), len(beacons), len(traffic.airfields)))
+	return lambda: beacons
+
+def main(args):
+	logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+	logger = logging.getLogger('acph.main')
+
+	if args.synthetic:
+		beacons = synthetic_beacons(args)
+	elif args.files:
+		for filepath in args.files:
+			if not os.path.isfile(filepath):
+				logger.error("File path {} does not exist. Exiting...".format(filepath))
+				sys.exit(1)
+		beacons = capture_beacons(args)
+	else:
+		logger.error('No capture file and no synthetic traffic to serve. Exiting...')
+		sys.exit(1)
+
+	server = AcphAprsServer(beacons, host=args.host, port=args.port, speed=args.speed, loop=args.loop, retime=not args.keep_time,
+		disconnect_interval=args.disconnect_every, stall_interval=args.stall_every, stall_duration=args.stall_duration)
+	server.run()
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='ACPH Glider flight logbook, local APRS server replaying captured or synthetic beacons')
+	parser.add_argument('files', nargs='*', help='capture files to serve: logbook logs or raw APRS messages, plain text or gzip (.gz)')
+	parser.add_argument("-d", "--date", action='store', dest='date', help='date of the beacons YYYY-MM-DD, default value is the date in the file name or in the log lines, required for raw APRS captures')
+	parser.add_argument("--synthetic", action='store', dest='synthetic', type=int, default=0, help='serve a synthetic traffic of n aircraft instead of capture files')
+	parser.add_argument("--airports-dir", action='store', dest='airports_dir', default='.', help='directory of the airports.csv and runways.csv files of the synthetic traffic, default value is .')
+	parser.add_argument("--duration", action='store', dest='duration', type=int, default=3600, help='seconds of synthetic traffic, default value is 3600')
+	parser.add_argument("--seed", action='store', dest='seed', type=int, default=20200814, help='seed of the synthetic traffic, default value is 20200814')
+	parser.add_argument("--host", action='store', dest='host', default=SERVER_HOST, help='address the server listens on, default value is {}'.format(SERVER_HOST))
+	parser.add_argument("-p", "--port", action='store', dest='port', type=int, default=SERVER_PORT, help='port the server listens on, default value is {}'.format(SERVER_PORT))
+	parser.add_argument("-s", "--speed", action='store', dest='speed', type=float, default=SERVER_SPEED, help='replay speed as a multiple of real time, 0 to send the beacons as fast as the clients read them, default value is {}'.format(SERVER_SPEED))
+	parser.add_argument("--loop", action='store_true', dest='loop', help='replay the beacons again when all are sent')
+	parser.add_argument("--keep-time", action='store_true', dest='keep_time', help='keep the time of the captured messages instead of the time they are sent')
+	parser.add_argument("--disconnect-every", action='store', dest='disconnect_every', type=float, default=0, help='disconnect the clients every n seconds, default value is 0 for never')
+	parser.add_argument("--stall-every", action='store', dest='stall_every', type=float, default=0, help='stop sending every n seconds, default value is 0 for never')
+	parser.add_argument("--stall-duration", action='store', dest='stall_duration', type=float, default=0, help='seconds of each stall, default value is 0')
+	parser.add_argument("-v", "--verbose", action='store_true', dest='verbose', help='log the statistics of the server')
+	args = parser.parse_args()
+
+	main(args)
@@ -2,6 +2,9 @@ import sys
 import signal
 import os
 import json
+import time
+import datetime
+import resource
 import argparse
 import configparser
 import logging
@@ -14,16 +17,26 @@ from pid.decorator import pidfile
 from ogn.client import AprsClient
 from ogn.parser import parse, ParseError
 
-from acph.class_aprs import AcphAprsClient
-from acph.class_flights_logbook import FlightsLogBook
+from acph.class_aprs import AcphAprsClient, aprs_settings
+from acph.class_aprs_async import AcphAsyncAprsClient, APRS_QUEUE_SIZE
+from acph.class_flights_logbook import FlightsLogBook, TAKEOFF_WINDOW, LANDING_WINDOW, WINCH_WINDOW, CACHE_MAX_AIRCRAFT, CACHE_LANDED_TIMEOUT, CACHE_IDLE_TIMEOUT
 from acph.class_ogn_db import OgnDevicesDatabase
 from acph.class_flights_logbook_pdo import FlightLogPDO
 from acph.class_airport_db import OurAirportsDatabase
+from acph.class_pipeline import AcphPipeline
+from acph.class_beacon_prefilter import BeaconPreFilter
+from acph.class_beacon_parser import AircraftBeaconParser
+from acph.class_metrics import AcphMetrics
 
 config_file='./acph-logbook.ini'
 
 def handle_exit(signal, frame):
 	raise(SystemExit)
+
+def max_resident_memory():
+	# ru_maxrss is in kilobytes on linux and in bytes on macOS
+	max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return round(max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
  
 @pidfile('acph-flights-log.pid','./')
 def main():
@@ -50,20 +63,23 @@ def main():
 		logger.error("Unable to load OGN devices database. Error is {}".format(err))
 		sys.exit()
 
-	# load the airport database from a local file or remotly
+	# load the airport database from a local file or remotly, through the compiled cache if a cache directory is set
 	try:
-		if 'logbook' in config and config['logbook']['acdb'] == 'remote':
-			airports_db = OurAirportsDatabase.withUrl()
-		else:
-			airports_db = OurAirportsDatabase.withCsvFile('.')
+		start_time = time.perf_counter()
+		airports_cache_file = os.path.join(config['logbook']['cache_dir'], 'airports.bin') if config['logbook'].get('cache_dir') else None
 
 		#  Airports DB only with european airports.
-		# listOfAirportsFiltered = airports_db.filterByContinent('EU')
-		# logger.info('After filtering on european airport, size of airport code database is {}'.format(len(listOfAirportsFiltered)))
+		# airports_region = {'continent': 'EU'}
 
 		# Airports DB only with french airports.
-		listOfAirportsFiltered = airports_db.filterByCountry('FR')
-		logger.warning('After filtering on French airport, size of airport code database is {}'.format(len(listOfAirportsFiltered)))
+		airports_region = {'country': 'FR'}
+
+		if 'logbook' in config and config['logbook']['acdb'] == 'remote':
+			airports_db = OurAirportsDatabase.withUrl(cache_file_path = airports_cache_file, **airports_region)
+		else:
+			airports_db = OurAirportsDatabase.withCsvFile('.', cache_file_path = airports_cache_file, **airports_region)
+		listOfAirportsFiltered = airports_db.airports
+		logger.warning('After filtering on {}, size of airport code database is {} (loaded in {}s, max resident memory {}MB)'.format(airports_region, len(listOfAirportsFiltered), round(time.perf_counter() - start_time, 3), max_resident_memory()))
 	except IOError:
 		logger.exception("File does not exist. Exiting...")
 		sys.exit()
@@ -71,33 +87,71 @@ def main():
 	# to handle CTRL-C, Kill,....
 	signal.signal(signal.SIGTERM, handle_exit)
 
-	# Create the persistence engine to store results on the fly: could be JSON or MySql
-	pdo_engine = FlightLogPDO.factory(config['logbook']['persistence'] if 'logbook' in config else 'JSON')
-	# pdo_engine.open(config_file)
-	pdo_engine.open(config['mysql_connector_python'])
+	# Create the persistence engine to store results on the fly: could be JSON, MySql or MySql-write-behind
+	def pdo_factory():
+		pdo_engine = FlightLogPDO.factory(config['logbook']['persistence'] if 'logbook' in config else 'JSON', config['persistence'] if 'persistence' in config else None)
+		# pdo_engine.open(config_file)
+		pdo_engine.open(config['mysql_connector_python'])
+		return pdo_engine
+	pdo_engine = pdo_factory()
 
 	# take the opportunity to purge data hold in the persistence engine
 	pdo_engine.purge(config['logbook'].getint('purge'))
 
-	# start the APRS client
-	if 'aprs' in config:
+	# with several workers, each logbook shard opens its own persistence engine
+	workers = config['logbook'].getint('workers', 0)
+	if workers > 0:
+		pdo_engine.close()
+
+	# start the APRS client, on the OGN servers or on the server set in the config (acph-aprs-server.py for a load test)
+	settings = aprs_settings(config['aprs'] if 'aprs' in config else None)
+	if 'aprs' in config and config['aprs'].get('client', 'ogn') == 'async':
+		# socket read in its own thread, the beacons are queued for the logbook
+		client = AcphAsyncAprsClient(aprs_user='N0CALL', aprs_filter=config['aprs'].get('filter', ''), settings=settings, queue_size=config['aprs'].getint('queue_size', APRS_QUEUE_SIZE))
+	elif 'aprs' in config and config['aprs'].get('client', 'ogn') == 'acph':
+		client = AcphAprsClient(aprs_user='N0CALL', aprs_passcode=-1, aprs_filter=config['aprs'].get('filter', ''), settings=settings)
+	elif 'aprs' in config:
 		# client = AcphAprsClient(aprs_user=config['aprs']['user'], aprs_passcode=config['aprs']['passcode'], aprs_filter=config['aprs']['filter'])
 		# client = AprsClient(aprs_user=config['aprs']['user'], aprs_filter=config['aprs']['filter'])
-		client = AprsClient(aprs_user='N0CALL', aprs_filter=config['aprs']['filter'])
+		client = AprsClient(aprs_user='N0CALL', aprs_filter=config['aprs']['filter'], settings=settings)
 	else:
 		client = AprsClient(aprs_user='N0CALL')
 	client.connect()
 
+	# instrumentation of the beacon processing, with the gauges of the async client
+	metrics = AcphMetrics.withConfig(config['metrics'] if 'metrics' in config else None)
+	if isinstance(client, AcphAsyncAprsClient):
+		metrics.addGauges('aprs', client.gauges)
+
 	# create the ACPH Flight logbook
-	logbook = FlightsLogBook(receivers_filter={'NAVITER'}, ogndb=ogndb, airports_db = listOfAirportsFiltered, pdo_engine = pdo_engine)
+	receivers_filter = {'NAVITER'}
+	prefilter = BeaconPreFilter.withConfig(config['prefilter'] if 'prefilter' in config else None, receivers_filter)
+	logbook = FlightsLogBook(receivers_filter=receivers_filter, ogndb=ogndb, airports_db = listOfAirportsFiltered, pdo_engine = pdo_engine, airports_engine = config['logbook'].get('airports_engine', 'vptree'), cache_dir = config['logbook'].get('cache_dir'), prefilter = prefilter,
+		parser = AircraftBeaconParser.withConfig(config['logbook']), takeoff_window = config['logbook'].getint('takeoff_window', TAKEOFF_WINDOW),
+		landing_window = config['logbook'].getint('landing_window', LANDING_WINDOW), winch_window = config['logbook'].getint('winch_window', WINCH_WINDOW), metrics = metrics,
+		max_aircraft = config['logbook'].getint('max_aircraft', CACHE_MAX_AIRCRAFT), landed_timeout = config['logbook'].getint('landed_timeout', CACHE_LANDED_TIMEOUT), idle_timeout = config['logbook'].getint('idle_timeout', CACHE_IDLE_TIMEOUT),
+		warm_start = config['logbook'].getboolean('warm_start', True))
+	if workers > 0:
+		pipeline = AcphPipeline(logbook, pdo_factory, workers)
+		pipeline.start()
+	elif logbook.warm_start:
+		# the flights of the day before the first beacon, the shards load their own aircraft with their first beacon
+		logbook.warmStart(datetime.datetime.utcnow().strftime('%Y-%m-%d'))
+	metrics.start()
 	try:
-		client.run(callback=logbook.handleBeacon, autoreconnect=True)
+		client.run(callback=pipeline.handleBeacon if workers > 0 else logbook.handleBeacon, autoreconnect=True)
 	except (KeyboardInterrupt, SystemExit):
-		# close the logbook persistent engine
-		logbook.pdo_engine.close()
+		# save the pending logbook changes and close the logbook persistent engine
+		if workers > 0:
+			pipeline.close()
+		else:
+			logbook.flush()
+			logbook.pdo_engine.close()
 
 		# close the connection to aprs server.
 		client.disconnect()
+		metrics.stop()
+		metrics.logStatistics()
 		
 		logger.warning('ACPH Flights logbook stopped...')
 	except Exception as e:
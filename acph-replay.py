@@ -0,0 +1,397 @@
+import sys
+import os
+import time
+import datetime
+import argparse
+import configparser
+import collections
+import logging
+import logging.config
+
+from acph.class_flights_logbook import FlightsLogBook, TAKEOFF_WINDOW, LANDING_WINDOW, WINCH_WINDOW, CACHE_MAX_AIRCRAFT, CACHE_LANDED_TIMEOUT, CACHE_IDLE_TIMEOUT
+from acph.class_ogn_db import OgnDevicesDatabase
+from acph.class_flights_logbook_pdo import FlightLogPDO
+from acph.class_airport_db import OurAirportsDatabase
+from acph.class_pipeline import AcphPipeline
+from acph.class_beacon_prefilter import BeaconPreFilter, REJECT_ADDRESS, REJECT_OUTSIDE_BBOX
+from acph.class_beacon_parser import AircraftBeaconParser, PARSED_FIELDS
+from acph.class_metrics import AcphMetrics
+from acph.aprs_capture import read_beacons, capture_date
+from ogn.parser import parse
+
+config_file='./acph-logbook.ini'
+
+PROGRESS_INTERVAL = 100000									# print the progress every n beacons
+RECEIVERS_FILTER = {'NAVITER'}								# same receivers filter as the logbook daemon
+
+class StageTimer:
+	""" Measure the time spent in some methods of an object, by wrapping them in the instance. """
+
+	def __init__(self):
+		self.durations = collections.OrderedDict()
+		self.calls = collections.Counter()
+
+	def wrap(self, obj, method_name, stage):
+		method = getattr(obj, method_name)
+		self.durations.setdefault(stage, 0)
+		durations = self.durations
+		calls = self.calls
+
+		def timed(*args, **kwargs):
+			start_time = time.perf_counter()
+			try:
+				return method(*args, **kwargs)
+			finally:
+				durations[stage] += time.perf_counter() - start_time
+				calls[stage] += 1
+		setattr(obj, method_name, timed)
+
+def logbook_flights(logbook):
+	""" Flights of the logbook by date, with the ones of the aircraft evicted from it. """
+	flights = {}
+	for date, evicted_for_a_date in (logbook.evicted_flights or {}).items():
+		for aircraft_id, entries in evicted_for_a_date.items():
+			flights.setdefault(date, {}).setdefault(aircraft_id, {}).update(entries)
+	# an aircraft seen again after its eviction is reloaded, its flights in memory are the most recent
+	for date, logbook_for_a_date in logbook.logbook.items():
+		for aircraft_id, entries in logbook_for_a_date.items():
+			flights.setdefault(date, {}).setdefault(aircraft_id, {}).update((entry['flight_id'], entry) for entry in entries)
+	return {date: [entry for entries in flights_for_a_date.values() for entry in entries.values()] for date, flights_for_a_date in flights.items()}
+
+def flights_table(logbook):
+	""" Flights of the logbook as sorted tuples, to compare the results of 2 replays. """
+	return sorted((date, entry['aircraft_id'], entry['flight_id'], str(entry['registration']), entry['status'], str(entry['takeoff_time']), str(entry['takeoff_airport']),
+		str(entry['landing_time']), str(entry['landing_airport']), str(entry['flight_duration']), entry['launch_type']) for date, entries in logbook_flights(logbook).items() for entry in entries)
+
+def most_common(counter):
+	# by count then by name, the same counts are printed in the same order whatever the order of the flights
+	return ', '.join('{} {}'.format(count, name) for name, count in sorted(counter.items(), key=lambda item: (-item[1], str(item[0]))))
+
+def print_flights_summary(logbook):
+	flights_by_date = logbook_flights(logbook)
+	flights = [entry for entries in flights_by_date.values() for entry in entries]
+	status = collections.Counter(entry['status'] for entry in flights)
+	launch_types = collections.Counter(entry['launch_type'] for entry in flights if entry['takeoff_time'])
+
+	print('\nFlights summary')
+	print('  aircraft seen: {}, flights: {} ({})'.format(
+		len({entry['aircraft_id'] for entry in flights}), len(flights), most_common(status)))
+	print('  launch types: {}'.format(most_common(launch_types) or '-'))
+
+	print('\n  {:<10} {:<10} {:<8} {:<8} {:<20} {:<8} {:<20} {:<8} {:<10} {}'.format('date', 'aircraft', 'reg.', 'status', 'takeoff', 'airport', 'landing', 'airport', 'duration', 'launch'))
+	for date, entries in flights_by_date.items():
+		entries = sorted((entry for entry in entries if entry['takeoff_time']), key=lambda entry: (entry['takeoff_time'], entry['aircraft_id'], entry['flight_id']))
+		for entry in entries:
+			print('  {:<10} {:<10} {:<8} {:<8} {:<20} {:<8} {:<20} {:<8} {:<10} {}'.format(date, entry['aircraft_id'], str(entry['registration']), entry['status'],
+				str(entry['takeoff_time']), str(entry['takeoff_airport']), str(entry['landing_time'] or '-'), str(entry['landing_airport'] or '-'), str(entry['flight_duration'] or '-'), entry['launch_type']))
+
+def main(args):
+	# read the config file
+	config = configparser.ConfigParser()
+	config.read(config_file)
+
+	# create logger
+	logging.config.fileConfig(config_file)
+	logger = logging.getLogger('acph.main')
+
+	# load the OGN devices database from a local file or remote server
+	try:
+		if config['logbook']['ognddb'] == 'remote':
+			ogndb = OgnDevicesDatabase.withURL()
+		else:
+			ogndb = OgnDevicesDatabase.withJsonFile('./ogn-devices-ddb.json')
+	except IOError as err:
+		logger.error("Unable to load OGN devices database. Error is {}".format(err))
+		sys.exit(1)
+
+	# load the airport database from a local file or remotly, through the compiled cache if a cache directory is set
+	try:
+		airports_cache_file = os.path.join(config['logbook']['cache_dir'], 'airports.bin') if config['logbook'].get('cache_dir') else None
+		airports_region = {'country': 'FR'}
+		if config['logbook']['acdb'] == 'remote':
+			airports_db = OurAirportsDatabase.withUrl(cache_file_path = airports_cache_file, **airports_region)
+		else:
+			airports_db = OurAirportsDatabase.withCsvFile('.', cache_file_path = airports_cache_file, **airports_region)
+	except IOError:
+		logger.exception("File does not exist. Exiting...")
+		sys.exit(1)
+
+	for filepath in args.files:
+		if not os.path.isfile(filepath):
+			logger.error("File path {} does not exist. Exiting...".format(filepath))
+			sys.exit(1)
+
+	if args.verify_prefilter:
+		sys.exit(0 if verify_prefilter(args, config, ogndb, airports_db.airports) else 1)
+	elif args.verify_parser:
+		sys.exit(0 if verify_parser(args) else 1)
+	elif args.scaling:
+		# same replay with each number of workers, 0 is the single process logbook
+		results = [replay(args, config, ogndb, airports_db.airports, workers, report=False) for workers in args.scaling]
+		print('\nScaling of {} beacons'.format(results[0]['beacons']))
+		print('  {:>8} {:>10} {:>12} {:>9}'.format('workers', 'time s', 'beacons/s', 'speedup'))
+		# speedup against the first replay of the list
+		for workers, result in zip(args.scaling, results):
+			print('  {:>8} {:>10} {:>12} {:>9}'.format(workers if workers else 'serial', round(result['duration'], 3), round(result['beacons_per_second']),
+				round(results[0]['duration'] / result['duration'], 2) if result['duration'] > 0 else 0))
+		sys.exit(0 if verify_scaling(args.scaling, results) else 1)
+	else:
+		replay(args, config, ogndb, airports_db.airports, args.workers if args.workers is not None else config['logbook'].getint('workers', 0))
+
+def verify_scaling(scaling, results):
+	""" Check that each replay of the scaling gives the same flights as the first one. """
+	same = True
+	reference = set(results[0]['flights'])
+	for workers, result in zip(scaling[1:], results[1:]):
+		flights = set(result['flights'])
+		if flights == reference:
+			continue
+		same = False
+		print('\nFlights of {} different from {}:'.format('{} workers'.format(workers) if workers else 'serial', '{} workers'.format(scaling[0]) if scaling[0] else 'serial'))
+		for flight in sorted(reference - flights)[:20]:
+			print('  - {}'.format(' '.join(str(value) for value in flight)))
+		for flight in sorted(flights - reference)[:20]:
+			print('  + {}'.format(' '.join(str(value) for value in flight)))
+	if same:
+		print('\nSame {} flights for each replay.'.format(len(reference)))
+	return same
+
+def create_prefilter(args, config, receivers_filter):
+	if args.no_prefilter:
+		return None
+	return BeaconPreFilter.withConfig(config['prefilter'] if 'prefilter' in config else None, receivers_filter)
+
+def create_parser(args, config):
+	if args.parser is not None:
+		return AircraftBeaconParser.withConfig({'parser': args.parser})
+	return AircraftBeaconParser.withConfig(config['logbook'])
+
+def verify_parser(args):
+	""" Parse each beacon with the fast parser and with ogn.parser, check they give the same values and compare their throughput. """
+	parser = AircraftBeaconParser()
+	beacons = []
+	for filepath in args.files:
+		for raw_message, reference, beacon_date in read_beacons(filepath, capture_date(filepath, args.date)):
+			beacons.append((raw_message, reference if reference is not None else datetime.datetime.utcnow()))
+			if len(beacons) == args.max_beacons:
+				break
+		if len(beacons) == args.max_beacons:
+			break
+
+	counter_fast_path = 0
+	counter_ogn_errors = 0
+	mismatches = []
+	for raw_message, reference in beacons:
+		beacon = parser.parsePosition(raw_message, reference)
+		if beacon is None:
+			continue
+		counter_fast_path += 1
+
+		try:
+			expected = parse(raw_message, reference)
+		except Exception:
+			# ogn.parser fails on a field of the comment the fast path does not read, the logbook would have dropped the beacon
+			counter_ogn_errors += 1
+			continue
+		fields = [field for field in PARSED_FIELDS if beacon.get(field) != expected.get(field)]
+		if fields:
+			mismatches.append((fields, raw_message))
+
+	# throughput of each parser on all the beacons, the fast parser falls back to ogn.parser
+	durations = {}
+	for name, parse_beacon in (('ogn.parser', parse), ('fast', parser.parse)):
+		start_time = time.perf_counter()
+		for raw_message, reference in beacons:
+			try:
+				parse_beacon(raw_message, reference)
+			except Exception:
+				pass
+		durations[name] = time.perf_counter() - start_time
+
+	print('{} beacons, {} parsed by the fast path, {} left to ogn.parser'.format(len(beacons), counter_fast_path, len(beacons) - counter_fast_path))
+	print('  {:<12} {:>10} {:>12} {:>10}'.format('parser', 'time s', 'beacons/s', 'avg us'))
+	for name, duration in durations.items():
+		print('  {:<12} {:>10} {:>12} {:>10}'.format(name, round(duration, 3), round(len(beacons) / duration) if duration > 0 else 0,
+			round(duration * 1e6 / len(beacons), 1) if beacons else 0))
+	if durations['fast'] > 0:
+		print('Speedup of the fast parser: {}'.format(round(durations['ogn.parser'] / durations['fast'], 2)))
+
+	if counter_ogn_errors:
+		print('{} beacons of the fast path are rejected by ogn.parser on a field the logbook does not use'.format(counter_ogn_errors))
+	if mismatches:
+		print('{} beacons parsed with different values:'.format(len(mismatches)))
+		for fields, raw_message in mismatches[:20]:
+			print('  [{}] {}'.format(', '.join(fields), raw_message))
+		return False
+	print('The fast parser gives the same values as ogn.parser.')
+	return True
+
+def verify_prefilter(args, config, ogndb, airports):
+	""" Parse each beacon rejected by the pre-filter, and check the logbook would not have handled it. """
+	prefilter = create_prefilter(args, config, RECEIVERS_FILTER)
+	if prefilter is None:
+		print('The pre-filter is disabled, nothing to verify.')
+		return True
+
+	logbook = FlightsLogBook(receivers_filter=RECEIVERS_FILTER, ogndb=ogndb, airports_db = airports, pdo_engine = None, airports_engine = 'grid')
+	counter_beacons = 0
+	counters_rejected = collections.Counter()
+	lost = []
+	for filepath in args.files:
+		for raw_message, reference, beacon_date in read_beacons(filepath, capture_date(filepath, args.date)):
+			counter_beacons += 1
+			reason = prefilter.rejectReason(raw_message)
+			if reason is None:
+				continue
+			counters_rejected[reason] += 1
+
+			try:
+				beacon = parse(raw_message, reference)
+			except Exception:
+				# the logbook does not handle the beacons the parser fails on
+				continue
+
+			if beacon.get('aprs_type') != 'position' or not logbook.isAircraftBeacon(beacon) or not logbook.filteringReceivers(beacon['receiver_name']) or not logbook.filteringAircraft(beacon['address']):
+				continue
+
+			# an aircraft position the logbook would handle, only rejected on purpose by the configured address prefixes or bounding box
+			if reason == REJECT_ADDRESS and beacon['name'].startswith(prefilter.exclude_prefixes):
+				continue
+			if reason == REJECT_OUTSIDE_BBOX and not (prefilter.bbox[0] <= beacon['latitude'] <= prefilter.bbox[2] and prefilter.bbox[1] <= beacon['longitude'] <= prefilter.bbox[3]):
+				continue
+			lost.append((reason, raw_message))
+
+	print('{} beacons, {} accepted by the pre-filter, {} rejected ({})'.format(counter_beacons, counter_beacons - sum(counters_rejected.values()), sum(counters_rejected.values()),
+		', '.join('{} {}'.format(count, reason) for reason, count in counters_rejected.most_common())))
+	if lost:
+		print('{} beacons handled by the logbook are rejected by the pre-filter:'.format(len(lost)))
+		for reason, raw_message in lost[:20]:
+			print('  [{}] {}'.format(reason, raw_message))
+		return False
+	print('No beacon handled by the logbook is rejected by the pre-filter.')
+	return True
+
+def replay(args, config, ogndb, airports, workers, report=True):
+	persistence = args.persistence if args.persistence else config['logbook'].get('persistence', 'JSON')
+	airports_engine = args.airports_engine if args.airports_engine else config['logbook'].get('airports_engine', 'vptree')
+
+	# the persistence engine is not purged, it would delete the replayed days
+	def pdo_factory():
+		pdo_engine = FlightLogPDO.factory(persistence, config['persistence'] if 'persistence' in config else None)
+		pdo_engine.open(config['mysql_connector_python'])
+		return pdo_engine
+	pdo_engine = pdo_factory() if workers == 0 else None
+
+	# the metrics of the logbook, with the ones of the shards and without endpoint, are printed at the end of the replay
+	metrics = AcphMetrics(port=None, log_interval=0) if args.metrics else None
+
+	start_time = time.perf_counter()
+	logbook = FlightsLogBook(receivers_filter=RECEIVERS_FILTER, ogndb=ogndb, airports_db = airports, pdo_engine = pdo_engine, airports_engine = airports_engine, cache_dir = config['logbook'].get('cache_dir'),
+		prefilter = create_prefilter(args, config, RECEIVERS_FILTER), parser = create_parser(args, config), takeoff_window = config['logbook'].getint('takeoff_window', TAKEOFF_WINDOW),
+		landing_window = config['logbook'].getint('landing_window', LANDING_WINDOW), winch_window = config['logbook'].getint('winch_window', WINCH_WINDOW), metrics = metrics,
+		max_aircraft = config['logbook'].getint('max_aircraft', CACHE_MAX_AIRCRAFT), landed_timeout = config['logbook'].getint('landed_timeout', CACHE_LANDED_TIMEOUT), idle_timeout = config['logbook'].getint('idle_timeout', CACHE_IDLE_TIMEOUT),
+		warm_start = config['logbook'].getboolean('warm_start', True))
+	# the summary reports the flights of the evicted aircraft too
+	logbook.evicted_flights = {}
+	init_duration = time.perf_counter() - start_time
+
+	timer = StageTimer()
+	if workers > 0:
+		# the shards persist their flights with their own engine
+		handler = AcphPipeline(logbook, pdo_factory, workers)
+		handler.start()
+	else:
+		handler = logbook
+		if report and not args.no_stage_timing:
+			timer.wrap(logbook, 'handleBeacon', 'handle beacon (all)')
+			timer.wrap(logbook, 'parse', 'parse')
+			timer.wrap(logbook, 'handleAircraftPosition', 'aircraft position')
+			timer.wrap(logbook, 'findNearestAirportWithEngine', 'nearest airport')
+			timer.wrap(logbook, 'detectLaunchType', 'launch type')
+			timer.wrap(pdo_engine, 'save_aircraft', 'persistence')
+	print('Replay {} with persistence engine {}, airports engine {} and {} (logbook initialized in {}s)'.format(', '.join(args.files), persistence, airports_engine,
+		'{} workers'.format(workers) if workers else 'a single process', round(init_duration, 3)))
+
+	counter_beacons = 0
+	start_time = time.perf_counter()
+	start_cpu_time = time.process_time()
+	try:
+		for filepath in args.files:
+			for raw_message, reference, beacon_date in read_beacons(filepath, capture_date(filepath, args.date)):
+				handler.handleBeacon(raw_message, reference, beacon_date)
+				counter_beacons += 1
+				if report and counter_beacons % PROGRESS_INTERVAL == 0:
+					print('  {} beacons, {} beacons/s'.format(counter_beacons, round(counter_beacons / (time.perf_counter() - start_time))))
+				if counter_beacons == args.max_beacons:
+					break
+			if counter_beacons == args.max_beacons:
+				break
+	except KeyboardInterrupt:
+		print('Replay interrupted.')
+
+	# save the pending logbook changes and close the logbook persistent engine, or wait for the shards to do it
+	read_duration = time.perf_counter() - start_time
+	if workers > 0:
+		handler.close()
+	else:
+		logbook.flush()
+		pdo_engine.close()
+	replay_duration = time.perf_counter() - start_time
+	cpu_duration = time.process_time() - start_cpu_time
+	beacons_per_second = counter_beacons / replay_duration if replay_duration > 0 else 0
+
+	if report:
+		print('\n{} beacons replayed in {}s ({}s to read them, cpu of the reader process {}s), {} beacons/s'.format(
+			counter_beacons, round(replay_duration, 3), round(read_duration, 3), round(cpu_duration, 3), round(beacons_per_second)))
+		print('{} aircraft position beacons, {} logbook entries saved, {} saves skipped'.format(handler.counter_aircraft_beacon_position, handler.counter_saves, handler.counter_saves_skipped))
+		print('Logbook cache: {} aircraft evicted, {} loaded from the persistence engine ({} reloads of an evicted aircraft), {} warm started, {} loads avoided'.format(handler.counter_evictions, handler.counter_loads, handler.counter_reloads, handler.counter_warm_started, handler.counter_loads_avoided))
+		if logbook.prefilter is not None:
+			print('Pre-filter: {} accepted, rejected {}'.format(logbook.prefilter.counter_accepted,
+				', '.join('{} {}'.format(count, reason) for reason, count in logbook.prefilter.counters_rejected.items()) ))
+		if logbook.parser is not None and workers == 0:
+			print('Parser: {} beacons parsed by the fast path, {} by ogn.parser'.format(logbook.parser.counter_fast_path, logbook.parser.counter_messages - logbook.parser.counter_fast_path))
+
+		if timer.durations:
+			handled_duration = timer.durations['handle beacon (all)']
+			print('\nStage timing (inclusive, nested stages are part of their caller)')
+			print('  {:<22} {:>10} {:>10} {:>12} {:>8}'.format('stage', 'calls', 'total s', 'avg us', '% replay'))
+			print('  {:<22} {:>10} {:>10} {:>12} {:>8}'.format('read capture', counter_beacons, round(read_duration - handled_duration, 3),
+				round((read_duration - handled_duration) * 1e6 / counter_beacons, 1) if counter_beacons else 0, round(100 * (read_duration - handled_duration) / replay_duration, 1) if replay_duration > 0 else 0))
+			for stage, duration in timer.durations.items():
+				calls = timer.calls[stage]
+				print('  {:<22} {:>10} {:>10} {:>12} {:>8}'.format(stage, calls, round(duration, 3), round(duration * 1e6 / calls, 1) if calls else 0,
+					round(100 * duration / replay_duration, 1) if replay_duration > 0 else 0))
+
+		if metrics is not None:
+			print('\nMetrics')
+			for line in metrics.summary():
+				print('  {}'.format(line))
+
+		print_flights_summary(handler)
+
+	return {'beacons': counter_beacons, 'duration': replay_duration, 'beacons_per_second': beacons_per_second, 'flights': flights_table(handler)}
+
+def workers_list(value):
+	return [int(workers) for workers in value.split(',')]
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='ACPH Glider flight logbook, replay of captured APRS beacons')
+	parser.add_argument('files', nargs='+', help='capture files to replay: logbook logs or raw APRS messages, plain text or gzip (.gz)')
+	parser.add_argument("-i", "--ini", action='store', dest='config_file', help='path to the ini config file, default value is {}'.format(config_file),
+						default='./acph-logbook.ini')
+	parser.add_argument("-p", "--persistence", action='store', dest='persistence', help='persistence engine (JSON, MySQL or MySQL-write-behind), default value is the one of the ini config file')
+	parser.add_argument("-a", "--airports-engine", action='store', dest='airports_engine', help='nearest airport engine (vptree, numpy or grid), default value is the one of the ini config file')
+	parser.add_argument("-d", "--date", action='store', dest='date', help='date of the beacons YYYY-MM-DD, default value is the date in the file name or in the log lines, required for raw APRS captures')
+	parser.add_argument("-n", "--max-beacons", action='store', dest='max_beacons', type=int, default=-1, help='stop after n beacons, default value is -1 for all')
+	parser.add_argument("-w", "--workers", action='store', dest='workers', type=int, help='number of logbook shards of the multi-process pipeline, 0 for a single process, default value is the one of the ini config file')
+	parser.add_argument("--scaling", action='store', dest='scaling', type=workers_list, help='replay once for each number of workers of the comma separated list (e.g. 0,1,2,4,8) and print the speedups')
+	parser.add_argument("--no-prefilter", action='store_true', dest='no_prefilter', help='do not pre-filter the raw beacons, even if enabled in the ini config file')
+	parser.add_argument("--verify-prefilter", action='store_true', dest='verify_prefilter', help='do not replay, parse every beacon rejected by the pre-filter and check none would have been handled by the logbook')
+	parser.add_argument("--parser", action='store', dest='parser', choices=('fast', 'ogn'), help='beacons parser, default value is the one of the ini config file')
+	parser.add_argument("--verify-parser", action='store_true', dest='verify_parser', help='do not replay, parse every beacon with the fast parser and with ogn.parser, check they give the same values and compare their throughput')
+	parser.add_argument("--no-stage-timing", action='store_true', dest='no_stage_timing', help='do not measure the time of each stage')
+	parser.add_argument("--metrics", action='store_true', dest='metrics', help='instrument the logbook with its metrics and print them')
+	args = parser.parse_args()
+	config_file=args.config_file
+
+	main(args)
@@ -0,0 +1,64 @@
+#  This module contains the reading of the captures of APRS beacons replayed by acph-replay.py and served by
+#  acph-aprs-server.py: logs of the logbook or raw APRS messages, plain text or gzip.
+
+import os
+import re
+import gzip
+import datetime
+
+LOG_LINE_MARKERS = ('raw data: ', 'aprs beacon ')		# text preceding the APRS message in a line of the logbook logs
+APRS_TIME_REGEX = re.compile(r'[/@](\d{2})(\d{2})(\d{2})h')	# time of an APRS position or status message
+DATE_REGEX = re.compile(r'(\d{4}-\d{2}-\d{2})')
+
+def open_capture(filepath):
+	# plain or gzip text file, undecodable bytes are replaced rather than stopping the replay
+	if filepath.endswith('.gz'):
+		return gzip.open(filepath, 'rt', encoding='utf-8', errors='replace')
+	return open(filepath, 'r', encoding='utf-8', errors='replace')
+
+def read_beacons(filepath, date=None):
+	""" Yield (raw APRS message, reference timestamp, date) for each beacon of a capture file.
+
+	A capture is either a log of the logbook ([2020-08-14 10:00:00,123] ... raw data: <message>)
+	or a raw APRS capture, one message per line. The reference timestamp is the simulated time:
+	the time of the log line, or for a raw capture the time of the APRS message on `date`.
+	"""
+	reference_dates = {}		# datetime of each second already seen in the file
+	reference = datetime.datetime.strptime(date, '%Y-%m-%d') if date else None
+
+	with open_capture(filepath) as fp:
+		for line in fp:
+			line = line.rstrip('\r\n')
+			if not line:
+				continue
+
+			if line[0] == '[' and line[11:12] == ' ':
+				# a log line
+				for marker in LOG_LINE_MARKERS:
+					position = line.find(marker, 24)
+					if position >= 0:
+						break
+				else:
+					continue
+
+				second = line[1:20]
+				reference = reference_dates.get(second)
+				if reference is None:
+					reference = datetime.datetime(int(second[0:4]), int(second[5:7]), int(second[8:10]), int(second[11:13]), int(second[14:16]), int(second[17:19]))
+					reference_dates[second] = reference
+				yield line[position + len(marker):], reference, date if date else second[0:10]
+			else:
+				# a raw APRS message
+				if reference is None:
+					raise ValueError('The date of the raw APRS capture {} is required (--date).'.format(filepath))
+				match = APRS_TIME_REGEX.search(line)
+				if match is not None:
+					reference = reference.replace(hour=int(match.group(1)) % 24, minute=int(match.group(2)) % 60, second=int(match.group(3)) % 60)
+				yield line, reference, date
+
+def capture_date(filepath, date=None):
+	""" Date of the beacons of a capture: `date` if set, else the date in the file name, None if there is none. """
+	if date is not None:
+		return date
+	match = DATE_REGEX.search(os.path.basename(filepath))
+	return match.group(1) if match else None
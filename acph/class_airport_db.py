@@ -1,7 +1,13 @@
 from __future__ import annotations
 from abc import ABC, abstractmethod
 
+import os
+import re
+import sys
+import mmap
+import struct
 import urllib
+import hashlib
 import logging
 import json
 import csv
@@ -9,9 +15,55 @@ import csv
 from urllib.request import urlopen
 from collections import namedtuple
 
-AirportCodeValue = namedtuple('AirportCodeValue', ['lat', 'lon', 'icao', 'continent', 'elevation', 'name', 'city', 'country', 'type', 'runways'])
+# runway_table and elevation_m are computed from runways and elevation once the airports are loaded
+AirportCodeValue = namedtuple('AirportCodeValue', ['lat', 'lon', 'icao', 'continent', 'elevation', 'name', 'city', 'country', 'type', 'runways', 'runway_table', 'elevation_m'], defaults=((), 0))
 AirportRunwayValue = namedtuple('Runway', ['direction', 'length_ft', 'width_ft', 'surface'])
 
+RUNWAY_DIRECTION_REGEX = re.compile(r'([0-9]{2}).?\/.?([0-9]{2})')
+RUNWAY_TABLE_BINS = 36				# one bin of the runway table every 10 degrees of heading
+FEETS_TO_METER = 0.3048				# ratio feet to meter
+
+def runway_table_bin(heading):
+	return int((heading + 5) // 10) % RUNWAY_TABLE_BINS
+
+def angle_difference(heading_1, heading_2):
+	angle_diff = (heading_1 - heading_2) % 360
+	if angle_diff > 180:
+		angle_diff -= 360
+	return angle_diff
+
+# Compiled airports cache file layout (little endian):
+#	header
+#	string offsets, (strings count + 1) uint32 offsets in the strings blob
+#	strings blob, utf-8 encoded, each distinct string is stored once
+#	airports records, runways of an airport are contiguous records of the runways section
+#	runways records
+AIRPORTS_CACHE_MAGIC = b'ACPHAPT\0'
+AIRPORTS_CACHE_VERSION = 1
+AIRPORTS_CACHE_HEADER = struct.Struct('<8sI32sIIII')		# magic, version, source signature, strings count, strings blob size, airports count, runways count
+AIRPORTS_CACHE_AIRPORT = struct.Struct('<ddiIIIIIIII')		# lat, lon, elevation, icao, continent, name, city, country, type, first runway, runways count
+AIRPORTS_CACHE_RUNWAY = struct.Struct('<IIII')				# direction, length_ft, width_ft, surface
+AIRPORTS_CACHE_OFFSET = struct.Struct('<I')
+
+class AirportsRegionFilter:
+	""" Region an airport must belong to, any criteria left to None is not checked. bbox is (lat_min, lon_min, lat_max, lon_max). """
+	def __init__(self, country = None, continent = None, bbox = None):
+		self.country = country
+		self.continent = continent
+		self.bbox = bbox
+
+	def isEmpty(self):
+		return self.country is None and self.continent is None and self.bbox is None
+
+	def matchPosition(self, lat, lon):
+		return self.bbox is None or (self.bbox[0] <= lat <= self.bbox[2] and self.bbox[1] <= lon <= self.bbox[3])
+
+	def match(self, lat, lon, continent, country):
+		return (self.country is None or country == self.country) and (self.continent is None or continent == self.continent) and self.matchPosition(lat, lon)
+
+	def __str__(self):
+		return 'country={}, continent={}, bbox={}'.format(self.country, self.continent, self.bbox)
+
 class AbstractAirportsDatabase(ABC):
 	def __init__(self):
 		self.logger = logging.getLogger(__name__)
@@ -24,6 +76,35 @@ class AbstractAirportsDatabase(ABC):
 	def filterByCountry(self,country):	
 		return {key: value for (key, value) in self.airports.items() if value.country == country}
 
+	def filterByRegion(self, region):
+		return {key: value for (key, value) in self.airports.items() if region.match(value.lat, value.lon, value.continent, value.country)}
+
+	def precomputeAirports(self):
+		self.airports = {icao: self.precomputeAirport(airport) for icao, airport in self.airports.items()}
+
+	@staticmethod
+	def precomputeAirport(airport):
+		# runway designators of the airport, first seen first
+		runways_heading = dict()
+		for rwy in airport.runways:
+			for match in RUNWAY_DIRECTION_REGEX.finditer(rwy.direction):
+				runways_heading.setdefault(match.group(1), int(match.group(1))*10)
+				runways_heading.setdefault(match.group(2), int(match.group(2))*10)
+
+		# for each 10 degrees heading bin, the runway with the min angle difference with the bin heading
+		runway_table = []
+		for heading in range(0, 360, 360 // RUNWAY_TABLE_BINS):
+			runway = ''
+			angle_diff_min = 9999
+			for designator, runway_heading in runways_heading.items():
+				angle_diff = abs(angle_difference(runway_heading, heading))
+				if angle_diff < angle_diff_min:
+					angle_diff_min = angle_diff
+					runway = designator
+			runway_table.append(runway)
+
+		return airport._replace(runway_table=tuple(runway_table), elevation_m=round(airport.elevation * FEETS_TO_METER))
+
 	@abstractmethod
 	def getAirportByIcao(self, icao : str) -> AirportCodeValue:
 		pass
@@ -34,15 +115,23 @@ class OurAirportsDatabase(AbstractAirportsDatabase):
 		return None
 
 	@staticmethod
-	def withCsvFile(csv_file_path, include_closed = False):
+	def withCsvFile(csv_file_path, include_closed = False, cache_file_path = None, country = None, continent = None, bbox = None):
 		csv_airports_file =  csv_file_path + '/airports.csv'
 		csv_runways_file = csv_file_path + '/runways.csv'
+		region = AirportsRegionFilter(country, continent, bbox)
 		instance = OurAirportsDatabase()
-		
-		# handle airport code
+
+		# use the compiled cache if it has been built from the same csv files
+		if cache_file_path is not None:
+			signature = OurAirportsDatabase.sourceSignature(include_closed, *[ '{}:{}:{}'.format(os.path.abspath(f), os.stat(f).st_mtime_ns, os.stat(f).st_size).encode('utf-8') for f in (csv_airports_file, csv_runways_file)])
+			if instance.loadCacheFile(cache_file_path, signature, region):
+				instance.precomputeAirports()
+				return instance
+
+		# handle airport code, the region filter is pushed down to the csv parsing except when building the cache
 		with open(csv_airports_file, mode='r') as csv_file:
 			reader = csv.DictReader(csv_file)
-			instance.__handleAirportCodes(reader, include_closed)
+			instance.__handleAirportCodes(reader, include_closed, AirportsRegionFilter() if cache_file_path is not None else region)
 
 		instance.logger.info('Airports code database, {} airports loaded from csv file {}'.format(len(instance.airports), csv_airports_file))	
 
@@ -52,36 +141,161 @@ class OurAirportsDatabase(AbstractAirportsDatabase):
 			instance.__handleAirportRunways(reader)
 		instance.logger.info('Airports runways database, {} airports loaded from csv file {}'.format(len(instance.airports), csv_runways_file))	
 
+		if cache_file_path is not None:
+			instance.saveCacheFile(cache_file_path, signature)
+			instance.airports = instance.filterByRegion(region)
+
+		instance.precomputeAirports()
 		return instance
 
 	@staticmethod
-	def withUrl(url_path = 'https://ourairports.com/data', include_closed = False):
+	def withUrl(url_path = 'https://ourairports.com/data', include_closed = False, cache_file_path = None, country = None, continent = None, bbox = None):
 		# https://ourairports.com/data/airports.csv
 		# https://ourairports.com/data/runways.csv
 		csv_airports_url =  url_path + '/airports.csv'
 		csv_runways_url = url_path + '/runways.csv'
+		region = AirportsRegionFilter(country, continent, bbox)
 		instance = OurAirportsDatabase()
-		
-		# handle airport codes
+
 		with urllib.request.urlopen(csv_airports_url) as response:
-			lines = [l.decode('utf-8') for l in response.readlines()]
-			reader = csv.DictReader(lines)
-			instance.__handleAirportCodes(reader, include_closed)
+			airports_content = response.read()
+		with urllib.request.urlopen(csv_runways_url) as response:
+			runways_content = response.read()
+
+		# use the compiled cache if it has been built from the same csv content
+		if cache_file_path is not None:
+			signature = OurAirportsDatabase.sourceSignature(include_closed, airports_content, runways_content)
+			if instance.loadCacheFile(cache_file_path, signature, region):
+				instance.precomputeAirports()
+				return instance
+
+		# handle airport codes, the region filter is pushed down to the csv parsing except when building the cache
+		reader = csv.DictReader(airports_content.decode('utf-8').splitlines())
+		instance.__handleAirportCodes(reader, include_closed, AirportsRegionFilter() if cache_file_path is not None else region)
 		instance.logger.info('Airports code database, {} airports loaded from URL {}'.format(len(instance.airports), csv_airports_url))	
 
 		# handle airport runways 
-		with urllib.request.urlopen(csv_runways_url) as response:
-			lines = [l.decode('utf-8') for l in response.readlines()]
-			reader = csv.DictReader(lines)
-			instance.__handleAirportRunways(reader)
+		reader = csv.DictReader(runways_content.decode('utf-8').splitlines())
+		instance.__handleAirportRunways(reader)
 		instance.logger.info('Airports runways database, {} airports loaded from URL {}'.format(len(instance.airports), csv_runways_url))	
 
+		if cache_file_path is not None:
+			instance.saveCacheFile(cache_file_path, signature)
+			instance.airports = instance.filterByRegion(region)
+
+		instance.precomputeAirports()
 		return instance
 
-	def __handleAirportCodes(self, reader, include_closed):
+	@staticmethod
+	def sourceSignature(include_closed, *sources):
+		digest = hashlib.sha256()
+		digest.update(b'closed' if include_closed else b'open')
+		for source in sources:
+			digest.update(hashlib.sha256(source).digest())
+		return digest.digest()
+
+	def saveCacheFile(self, cache_file_path, signature):
+		strings = []
+		strings_index = dict()
+		def sid(value):
+			index = strings_index.get(value)
+			if index is None:
+				index = strings_index[value] = len(strings)
+				strings.append(value.encode('utf-8'))
+			return index
+
+		airports_records = []
+		runways_records = []
+		for airport in self.airports.values():
+			airports_records.append(AIRPORTS_CACHE_AIRPORT.pack(airport.lat, airport.lon, airport.elevation,
+				sid(airport.icao), sid(airport.continent), sid(airport.name), sid(airport.city), sid(airport.country), sid(airport.type),
+				len(runways_records), len(airport.runways)))
+			for runway in airport.runways:
+				runways_records.append(AIRPORTS_CACHE_RUNWAY.pack(sid(runway.direction), sid(runway.length_ft), sid(runway.width_ft), sid(runway.surface)))
+
+		offsets = [0]
+		for value in strings:
+			offsets.append(offsets[-1] + len(value))
+
+		# write to a temporary file first, a process killed while saving does not leave a truncated cache
+		tmp_file_path = '{}.{}.tmp'.format(cache_file_path, os.getpid())
+		try:
+			with open(tmp_file_path, 'wb') as fp:
+				fp.write(AIRPORTS_CACHE_HEADER.pack(AIRPORTS_CACHE_MAGIC, AIRPORTS_CACHE_VERSION, signature, len(strings), offsets[-1], len(airports_records), len(runways_records)))
+				fp.write(struct.pack('<{}I'.format(len(offsets)), *offsets))
+				fp.write(b''.join(strings))
+				fp.write(b''.join(airports_records))
+				fp.write(b''.join(runways_records))
+			os.replace(tmp_file_path, cache_file_path)
+			self.logger.info('Airports database, {} airports saved to cache file {}'.format(len(airports_records), cache_file_path))
+		except IOError as err:
+			self.logger.warning('Unable to save airports cache file {}. Error is {}'.format(cache_file_path, err))
+
+	def loadCacheFile(self, cache_file_path, signature, region):
+		try:
+			with open(cache_file_path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+				self.__loadCache(buffer, signature, region)
+			self.logger.info('Airports database, {} airports loaded from cache file {} ({})'.format(len(self.airports), cache_file_path, region))
+			return True
+		except FileNotFoundError:
+			self.logger.info('No airports cache file {}, load the csv files.'.format(cache_file_path))
+		except (IOError, ValueError, struct.error) as err:
+			self.logger.warning('Unable to load airports cache file {}, load the csv files. Error is {}'.format(cache_file_path, err))
+		self.airports = dict()
+		return False
+
+	def __loadCache(self, buffer, signature, region):
+		# records are unpacked in place from the memory mapped file, no buffer is exported so the mapping can always be closed
+		magic, version, cache_signature, strings_count, strings_size, airports_count, runways_count = AIRPORTS_CACHE_HEADER.unpack_from(buffer, 0)
+		if magic != AIRPORTS_CACHE_MAGIC or version != AIRPORTS_CACHE_VERSION:
+			raise ValueError('not an airports cache file or unsupported version')
+		if cache_signature != signature:
+			raise ValueError('cache built from other csv files')
+
+		offsets_start = AIRPORTS_CACHE_HEADER.size
+		strings_start = offsets_start + (strings_count + 1) * AIRPORTS_CACHE_OFFSET.size
+		airports_start = strings_start + strings_size
+		runways_start = airports_start + airports_count * AIRPORTS_CACHE_AIRPORT.size
+		if len(buffer) != runways_start + runways_count * AIRPORTS_CACHE_RUNWAY.size:
+			raise ValueError('truncated cache file')
+
+		# strings are decoded on first use only and shared by all the records using them
+		strings = dict()
+		def string(index):
+			value = strings.get(index)
+			if value is None:
+				start = AIRPORTS_CACHE_OFFSET.unpack_from(buffer, offsets_start + index * AIRPORTS_CACHE_OFFSET.size)[0]
+				end = AIRPORTS_CACHE_OFFSET.unpack_from(buffer, offsets_start + (index + 1) * AIRPORTS_CACHE_OFFSET.size)[0]
+				value = strings[index] = sys.intern(buffer[strings_start + start:strings_start + end].decode('utf-8'))
+			return value
+
+		# region criteria are checked on the raw records, string of a non-matching airport are never decoded
+		string_matches = dict()
+		def match(index, expected):
+			if expected is None:
+				return True
+			matching = string_matches.get(index)
+			if matching is None:
+				matching = string_matches[index] = string(index) == expected
+			return matching
+
+		for offset in range(airports_start, runways_start, AIRPORTS_CACHE_AIRPORT.size):
+			lat, lon, elevation, icao, continent, name, city, country, type, first_runway, runways = AIRPORTS_CACHE_AIRPORT.unpack_from(buffer, offset)
+			if not (region.matchPosition(lat, lon) and match(country, region.country) and match(continent, region.continent)):
+				continue
+
+			airport = AirportCodeValue(lat, lon, string(icao), string(continent), elevation, string(name), string(city), string(country), string(type), [])
+			for index in range(first_runway, first_runway + runways):
+				direction, length_ft, width_ft, surface = AIRPORTS_CACHE_RUNWAY.unpack_from(buffer, runways_start + index * AIRPORTS_CACHE_RUNWAY.size)
+				airport.runways.append(AirportRunwayValue(string(direction), string(length_ft), string(width_ft), string(surface)))
+			self.airports[airport.icao] = airport
+
+	def __handleAirportCodes(self, reader, include_closed, region):
 		for row in reader:
 			if not include_closed and row['type'] == 'closed':
 				pass
+			elif not region.isEmpty() and not region.match(float(row['latitude_deg']), float(row['longitude_deg']), row['continent'], row['iso_country']):
+				pass
 			else:
 				if not row['elevation_ft']:
 					elevation_in_feet = 0
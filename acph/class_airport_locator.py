@@ -0,0 +1,236 @@
+#  This module contains nearest airport search engines, alternatives to the Vantage Point-tree (VP-tree)
+#  to locate the nearest airport of an aircraft position.
+
+import math
+import logging
+import numpy as np
+
+from acph.geo_math import EARTH_RADIUS
+
+BATCH_MAX_MATRIX_SIZE = 1000000	# max number of (query, airport) distances computed at once by a batch query
+GRID_POLAR_LATITUDE = 89.0		# above this latitude a grid row is a single cell
+GRID_CELL_MARGIN = 1.01			# 1% margin on grid cell width to absorb the flat earth approximation
+GRID_LOG_INTERVAL = 10000		# log the grid index counters every n lookups
+
+class NumpyAirportLocator:
+
+	""" Nearest airport engine based on numpy vectorized haversine distances.
+
+	Airports coordinates are kept as contiguous arrays of radians, so a query
+	computes the distances to all the airports in a few numpy operations
+	instead of walking a tree with one geopy call per visited node.
+
+	Parameters
+	----------
+	airports_db : dict
+		Airports indexed by ICAO code, values are `AirportCodeValue`.
+	"""
+
+	def __init__(self, airports_db):
+		if not len(airports_db):
+			raise ValueError('Airports database can not be empty.')
+
+		self.icaos = [item.icao for item in airports_db.values()]
+		self.lat = np.radians(np.array([item.lat for item in airports_db.values()], dtype=np.float64))
+		self.lon = np.radians(np.array([item.lon for item in airports_db.values()], dtype=np.float64))
+		self.cos_lat = np.cos(self.lat)
+
+	def get_nearest_airport(self, latitude, longitude, distance_threshold=float('inf')):
+		""" Get the nearest airport of a position.
+
+		Parameters
+		----------
+		latitude : float
+			Latitude of the query point in degrees.
+		longitude : float
+			Longitude of the query point in degrees.
+		distance_threshold : float, optional
+			Max distance in km, beyond it no airport is returned.
+
+		Returns
+		-------
+		tuple
+			(icao, distance in km) of the nearest airport, (None, inf) if the
+			nearest airport is further than `distance_threshold`.
+		"""
+		lat = math.radians(latitude)
+		lon = math.radians(longitude)
+
+		# the haversine term is monotonic with the distance, only the nearest one needs the arcsin
+		hav = np.sin((self.lat - lat) * 0.5) ** 2 + math.cos(lat) * self.cos_lat * np.sin((self.lon - lon) * 0.5) ** 2
+		index = int(np.argmin(hav))
+		nearest_distance = 2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, hav[index])))
+
+		if nearest_distance <= distance_threshold:
+			return self.icaos[index], nearest_distance
+		return None, float('inf')
+
+	def get_nearest_airports(self, latitudes, longitudes, distance_threshold=float('inf')):
+		""" Get the nearest airport for a batch of positions.
+
+		Parameters
+		----------
+		latitudes : sequence of float
+			Latitudes of the query points in degrees.
+		longitudes : sequence of float
+			Longitudes of the query points in degrees.
+		distance_threshold : float, optional
+			Max distance in km, beyond it no airport is returned.
+
+		Returns
+		-------
+		list
+			One (icao, distance in km) tuple per query point, same contract
+			as `get_nearest_airport`.
+		"""
+		lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+		lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+		if lat.shape != lon.shape:
+			raise ValueError('latitudes and longitudes must have the same length.')
+
+		results = []
+		chunk_size = max(1, BATCH_MAX_MATRIX_SIZE // len(self.icaos))
+		for start in range(0, len(lat), chunk_size):
+			chunk_lat = lat[start:start + chunk_size, np.newaxis]
+			chunk_lon = lon[start:start + chunk_size, np.newaxis]
+
+			hav = np.sin((self.lat - chunk_lat) * 0.5) ** 2 + np.cos(chunk_lat) * self.cos_lat * np.sin((self.lon - chunk_lon) * 0.5) ** 2
+			indexes = np.argmin(hav, axis=1)
+			distances = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(1.0, hav[np.arange(len(indexes)), indexes])))
+
+			for index, nearest_distance in zip(indexes.tolist(), distances.tolist()):
+				if nearest_distance <= distance_threshold:
+					results.append((self.icaos[index], nearest_distance))
+				else:
+					results.append((None, float('inf')))
+
+		return results
+
+class GridAirportLocator:
+
+	""" Nearest airport engine based on a fixed-cell grid of quantised lat/lon.
+
+	Rows are `distance_threshold` high (in degrees of latitude) and the cells
+	of a row are wide enough to span `distance_threshold` at the row's highest
+	latitude. Every airport within `distance_threshold` of a position is
+	therefore in the 3x3 cells around it, and a position far from any airfield
+	is answered with at most 9 dict lookups and no distance computation.
+
+	Parameters
+	----------
+	airports_db : dict
+		Airports indexed by ICAO code, values are `AirportCodeValue`.
+	distance_threshold : float
+		Max distance in km the index is able to answer for.
+	log_interval : int, optional
+		Log the lookup counters every `log_interval` lookups.
+	"""
+
+	def __init__(self, airports_db, distance_threshold, log_interval=GRID_LOG_INTERVAL):
+		if not len(airports_db):
+			raise ValueError('Airports database can not be empty.')
+		if distance_threshold <= 0:
+			raise ValueError('distance_threshold must be strictly positive.')
+
+		self.logger = logging.getLogger(__name__)
+		self.distance_threshold = distance_threshold
+		self.cell_size = math.degrees(distance_threshold / EARTH_RADIUS)
+		self.row_cells = dict()
+		self.cells = dict()
+		self.log_interval = log_interval
+
+		self.counter_lookups = 0
+		self.counter_short_circuits = 0
+		self.counter_distances = 0
+
+		for item in airports_db.values():
+			lat = math.radians(item.lat)
+			cell = self._cell(item.lat, item.lon)
+			self.cells.setdefault(cell, []).append((lat, math.radians(item.lon), math.cos(lat), item.icao))
+
+		self.logger.info('Airports grid index, {} airports in {} cells of {}km'.format(len(airports_db), len(self.cells), distance_threshold))
+
+	def _cells_in_row(self, row):
+		cells_in_row = self.row_cells.get(row)
+		if cells_in_row is None:
+			max_latitude = max(abs(row * self.cell_size), abs((row + 1) * self.cell_size))
+			if max_latitude >= GRID_POLAR_LATITUDE:
+				cells_in_row = 1
+			else:
+				# cells of a row are 360 / n degrees wide, so a row wraps around the antimeridian without a narrow last cell
+				min_width = self.cell_size * GRID_CELL_MARGIN / math.cos(math.radians(max_latitude))
+				cells_in_row = max(1, int(360.0 // min_width))
+			self.row_cells[row] = cells_in_row
+		return cells_in_row
+
+	def _column(self, row, longitude):
+		cells_in_row = self._cells_in_row(row)
+		return int((longitude + 180.0) * cells_in_row // 360.0) % cells_in_row
+
+	def _cell(self, latitude, longitude):
+		row = math.floor(latitude / self.cell_size)
+		return row, self._column(row, longitude)
+
+	def get_nearest_airport(self, latitude, longitude, distance_threshold=None):
+		""" Get the nearest airport of a position within the grid distance threshold.
+
+		Parameters
+		----------
+		latitude : float
+			Latitude of the query point in degrees.
+		longitude : float
+			Longitude of the query point in degrees.
+		distance_threshold : float, optional
+			Max distance in km, can not be greater than the one of the grid.
+
+		Returns
+		-------
+		tuple
+			(icao, distance in km) of the nearest airport, (None, inf) if there
+			is no airport within `distance_threshold`.
+		"""
+		if distance_threshold is None:
+			distance_threshold = self.distance_threshold
+		elif distance_threshold > self.distance_threshold:
+			raise ValueError('distance_threshold can not be greater than the grid one ({}km).'.format(self.distance_threshold))
+
+		self.counter_lookups += 1
+		if self.counter_lookups % self.log_interval == 0:
+			self.logStatistics()
+
+		candidates = []
+		row = math.floor(latitude / self.cell_size)
+		for neighbour_row in (row - 1, row, row + 1):
+			cells_in_row = self._cells_in_row(neighbour_row)
+			column = self._column(neighbour_row, longitude)
+			for neighbour_column in {(column - 1) % cells_in_row, column, (column + 1) % cells_in_row}:
+				cell = self.cells.get((neighbour_row, neighbour_column))
+				if cell is not None:
+					candidates.extend(cell)
+
+		if not candidates:
+			self.counter_short_circuits += 1
+			return None, float('inf')
+
+		self.counter_distances += len(candidates)
+		lat = math.radians(latitude)
+		lon = math.radians(longitude)
+		cos_lat = math.cos(lat)
+		nearest_hav = 2.0
+		nearest_icao = None
+		for airport_lat, airport_lon, airport_cos_lat, icao in candidates:
+			hav = math.sin((airport_lat - lat) * 0.5) ** 2 + cos_lat * airport_cos_lat * math.sin((airport_lon - lon) * 0.5) ** 2
+			if hav < nearest_hav:
+				nearest_hav = hav
+				nearest_icao = icao
+
+		nearest_distance = 2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, nearest_hav)))
+		if nearest_distance <= distance_threshold:
+			return nearest_icao, nearest_distance
+		return None, float('inf')
+
+	def logStatistics(self):
+		self.logger.info('Airports grid index, {} lookups, {} short-circuited ({}%), {} distances computed'.format(
+			self.counter_lookups, self.counter_short_circuits,
+			round(100 * self.counter_short_circuits / self.counter_lookups, 1) if self.counter_lookups else 0,
+			self.counter_distances))
@@ -1,6 +1,8 @@
 from ogn.client import AprsClient
 from ogn.client import settings
 
+import time
+import types
 import socket
 import logging
 
@@ -13,13 +15,31 @@ def create_aprs_login(user_name, pass_code, app_name, app_version, aprs_filter=N
 	else:
 		return "user {} pass {} vers {} {} filter {}\n".format(user_name, pass_code, app_name, app_version, aprs_filter)
 
+def aprs_settings(section=None):
+	""" Copy of the ogn.client settings with the server of the [aprs] section of the config (host, port), to connect to another APRS server than the OGN one. """
+	aprs = types.SimpleNamespace(**{name: getattr(settings, name) for name in dir(settings) if name.isupper()})
+	if section is not None:
+		aprs.APRS_SERVER_HOST = section.get('host', '').strip() or aprs.APRS_SERVER_HOST
+		port = section.get('port', '').strip()
+		if port:
+			# the same port with or without filter
+			aprs.APRS_SERVER_PORT_FULL_FEED = aprs.APRS_SERVER_PORT_CLIENT_DEFINED_FILTERS = int(port)
+	return aprs
+
+APRS_RECV_BUFFER_SIZE = 65536		# size of the receive buffer, a line longer than the buffer is dropped
+APRS_RECONNECT_WAIT = 15			# number of seconds between 2 connection attempts
+
 class AcphAprsClient(AprsClient):
-	def __init__(self, aprs_user, aprs_passcode, aprs_filter='', settings=settings):
+	def __init__(self, aprs_user, aprs_passcode, aprs_filter='', settings=settings, precheck=True):
 		super().__init__(aprs_user, aprs_filter, settings)
 		self.logger = logging.getLogger(__name__)
 		self.settings.APRS_APP_NAME = 'acph-ogn-client'
 		self.settings.APRS_APP_VER = '1.0-beta'
 		self.aprs_passcode = aprs_passcode
+		self.precheck = precheck
+		self.buffer = bytearray(APRS_RECV_BUFFER_SIZE)
+		self.counter_lines = 0
+		self.counter_skipped = 0
 		self.logger.warning("Connect to OGN as {} with filter '{}'".format(aprs_user, (aprs_filter if aprs_filter else 'full-feed')))
 
 	def connect(self):
@@ -37,10 +57,78 @@ class AcphAprsClient(AprsClient):
 
 			login = create_aprs_login(self.aprs_user, self.aprs_passcode, self.settings.APRS_APP_NAME, self.settings.APRS_APP_VER, self.aprs_filter)
 			self.sock.send(login.encode())
-			self.sock_file = self.sock.makefile('rw')
 
 			self._kill = False
-		
+
+	def run(self, callback, timed_callback=lambda client: None, autoreconnect=False, **kwargs):
+		while not self._kill:
+			try:
+				self.receive(callback, timed_callback, **kwargs)
+			except OSError as e:
+				self.logger.error('Socket error: {}'.format(e))
+
+			if not autoreconnect or self._kill:
+				return
+			while not self._kill:
+				try:
+					self.connect()
+					break
+				except OSError as e:
+					self.logger.error('Connect error: {}, next connection try in {}s.'.format(e, APRS_RECONNECT_WAIT))
+					time.sleep(APRS_RECONNECT_WAIT)
+
+	def receive(self, callback, timed_callback, **kwargs):
+		""" Read the socket until the connection is lost and call `callback` with each line.
+
+		The bytes are received in a reusable buffer, the complete lines of the buffer are decoded
+		at once and split, with the pre-check the server comments (# ...) are dropped before the
+		callback.
+		"""
+		buffer = self.buffer
+		view = memoryview(buffer)
+		size = len(buffer)
+		filled = 0
+		keepalive_time = time.time()
+		try:
+			while not self._kill:
+				if time.time() - keepalive_time > self.settings.APRS_KEEPALIVE_TIME:
+					self.logger.info('Send keepalive, {} lines received, {} server comments dropped'.format(self.counter_lines, self.counter_skipped))
+					self.sock.send(b'#keepalive\n')
+					timed_callback(self)
+					keepalive_time = time.time()
+
+				received = self.sock.recv_into(view[filled:])
+				if received == 0:
+					self.logger.warning('Read returns zero length string. Failure. Orderly closeout.')
+					return
+				filled += received
+
+				# only the new bytes can end a line
+				end = buffer.rfind(b'\n', filled - received, filled)
+				if end < 0:
+					if filled == size:
+						self.logger.warning('Line longer than {} bytes dropped.'.format(size))
+						filled = 0
+					continue
+
+				lines = str(view[:end], 'utf-8', 'replace').split('\n')
+				self.counter_lines += len(lines)
+				for line in lines:
+					line = line.strip()
+					if not line:
+						continue
+					if self.precheck and line[0] == '#':
+						self.counter_skipped += 1
+						continue
+					callback(line, **kwargs)
+
+				# keep the beginning of the next line at the start of the buffer
+				remaining = filled - end - 1
+				view[:remaining] = view[end + 1:filled]
+				filled = remaining
+		finally:
+			view.release()
+
 	def disconnect(self):
 		super().disconnect()
 		self.logger.warning('Disconnected from APRS server.')
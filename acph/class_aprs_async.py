@@ -0,0 +1,268 @@
+#  This module contains an APRS client reading the OGN feed with asyncio in a dedicated thread, the lines
+#  are given to the logbook through a bounded queue so that a slow processing never blocks the socket.
+
+import time
+import queue
+import random
+import asyncio
+import logging
+import threading
+
+from ogn.client import settings
+from acph.class_aprs import create_aprs_login
+
+APRS_QUEUE_SIZE = 10000				# max number of lines waiting to be processed, the new lines are dropped when full
+APRS_READ_SIZE = 65536				# max number of bytes read from the socket at once, a line longer than that is dropped
+APRS_READ_TIMEOUT = 90				# reconnect when nothing is received for n seconds (the server sends a comment every 20s)
+APRS_CONNECT_TIMEOUT = 15			# max number of seconds to connect to the server
+APRS_WATCHDOG_INTERVAL = 5			# number of seconds between 2 checks of the keepalive and read timeout
+APRS_RECONNECT_DELAY = 1			# delay before the first reconnection, doubled after each failure
+APRS_RECONNECT_MAX_DELAY = 120		# max delay between 2 connection attempts
+APRS_STATS_INTERVAL = 60			# log the gauges every n seconds
+APRS_LAG_SAMPLE = 100				# measure the feed lag on one line every n lines
+APRS_QUEUE_POLL = 1					# max number of seconds the consumer waits for a line before checking it has to stop
+
+def beacon_lag(line, now):
+	""" Seconds between the wall clock and the HHMMSSh time of a position or status beacon, None if it has no such time. """
+	position = line.find(':/')
+	if position < 0:
+		position = line.find(':>')
+	if position < 0 or line[position + 8:position + 9] != 'h':
+		return None
+	try:
+		beacon_seconds = int(line[position + 2:position + 4]) * 3600 + int(line[position + 4:position + 6]) * 60 + int(line[position + 6:position + 8])
+	except ValueError:
+		return None
+
+	lag = int(now) % 86400 - beacon_seconds
+	if lag > 43200:
+		lag -= 86400
+	elif lag < -43200:
+		lag += 86400
+	return lag
+
+class AcphAsyncAprsClient:
+
+	""" APRS client of the OGN feed with the interface of ogn.client AprsClient.
+
+	The socket is read by an asyncio event loop in a dedicated thread: it logs
+	in, sends the keepalives, reconnects with a jittered exponential backoff and
+	puts the lines in a bounded queue. `run` consumes the queue and calls the
+	callback in the caller thread. When the queue is full, the new lines are
+	dropped and counted instead of blocking the socket, so the server never
+	drops a client whose processing is slow.
+
+	Parameters
+	----------
+	aprs_user : str
+		Callsign used to log in.
+	aprs_passcode : int, optional
+		APRS passcode, -1 for a read only connection.
+	aprs_filter : str, optional
+		Server side filter, full feed if empty.
+	queue_size : int, optional
+		Max number of lines waiting to be processed.
+	precheck : bool, optional
+		Drop the server comments (# ...) instead of queuing them.
+	"""
+
+	def __init__(self, aprs_user, aprs_passcode=-1, aprs_filter='', settings=settings, queue_size=APRS_QUEUE_SIZE, precheck=True):
+		self.logger = logging.getLogger(__name__)
+		self.aprs_user = aprs_user
+		self.aprs_passcode = aprs_passcode
+		self.aprs_filter = aprs_filter
+		self.settings = settings
+		self.host = settings.APRS_SERVER_HOST
+		self.port = settings.APRS_SERVER_PORT_CLIENT_DEFINED_FILTERS if aprs_filter else settings.APRS_SERVER_PORT_FULL_FEED
+
+		self.lines = queue.Queue(queue_size)
+		self.queue_size = queue_size
+		self.precheck = precheck
+		self.autoreconnect = True
+		self.loop = None
+		self.thread = None
+		self.ingest_task = None
+		self._kill = False
+
+		# gauges
+		self.counter_lines = 0
+		self.counter_dropped = 0
+		self.counter_skipped = 0
+		self.counter_connections = 0
+		self.counter_connection_errors = 0
+		self.feed_lag = None
+		self.feed_lag_max = None
+		self.last_line_time = 0
+
+	def connect(self):
+		""" Start the ingestion thread, it connects to the server and reconnects until the client is disconnected. """
+		if self.thread is not None and self.thread.is_alive():
+			return
+		self._kill = False
+		self.thread = threading.Thread(target=self.__runLoop, name='acph-aprs-ingest', daemon=True)
+		self.thread.start()
+		self.logger.warning("Connect to OGN ({}:{}) as {} with filter '{}'".format(self.host, self.port, self.aprs_user, self.aprs_filter if self.aprs_filter else 'full-feed'))
+
+	def disconnect(self):
+		self._kill = True
+		if self.loop is not None and self.ingest_task is not None:
+			try:
+				self.loop.call_soon_threadsafe(self.ingest_task.cancel)
+			except RuntimeError:
+				# the ingestion has already stopped and closed its event loop
+				pass
+		if self.thread is not None:
+			self.thread.join(APRS_CONNECT_TIMEOUT)
+		self.logStatistics()
+		self.logger.warning('Disconnected from APRS server.')
+
+	def run(self, callback, timed_callback=lambda client: None, autoreconnect=False, **kwargs):
+		""" Call `callback` with each line received, until the client is disconnected or, without autoreconnect, the connection is lost. """
+		self.autoreconnect = autoreconnect
+		timed_callback_time = stats_time = time.monotonic()
+		counter_consumed = 0
+
+		while not self._kill:
+			try:
+				line = self.lines.get(timeout=APRS_QUEUE_POLL)
+			except queue.Empty:
+				line = None
+				if self.thread is None or not self.thread.is_alive():
+					break
+
+			if line is not None:
+				counter_consumed += 1
+				if counter_consumed % APRS_LAG_SAMPLE == 0:
+					lag = beacon_lag(line, time.time())
+					if lag is not None:
+						self.feed_lag = lag
+						self.feed_lag_max = lag if self.feed_lag_max is None else max(self.feed_lag_max, lag)
+				callback(line, **kwargs)
+
+			now = time.monotonic()
+			if now - timed_callback_time > self.settings.APRS_KEEPALIVE_TIME:
+				timed_callback(self)
+				timed_callback_time = now
+			if now - stats_time > APRS_STATS_INTERVAL:
+				self.logStatistics()
+				self.feed_lag_max = None
+				stats_time = now
+
+	def gauges(self):
+		return {
+			'queue_depth': self.lines.qsize(),
+			'queue_size': self.queue_size,
+			'lines_received': self.counter_lines,
+			'lines_dropped': self.counter_dropped,
+			'lines_skipped': self.counter_skipped,
+			'connections': self.counter_connections,
+			'connection_errors': self.counter_connection_errors,
+			'feed_lag': self.feed_lag,
+			'feed_lag_max': self.feed_lag_max,
+		}
+
+	def logStatistics(self):
+		self.logger.info('APRS feed, queue {queue_depth}/{queue_size}, {lines_received} lines received, {lines_skipped} server comments dropped, {lines_dropped} dropped, {connections} connections ({connection_errors} errors), feed lag {feed_lag}s (max {feed_lag_max}s)'.format(**self.gauges()))
+
+	def __runLoop(self):
+		self.loop = asyncio.new_event_loop()
+		try:
+			self.ingest_task = self.loop.create_task(self.__ingest())
+			self.loop.run_until_complete(self.ingest_task)
+		except asyncio.CancelledError:
+			pass
+		finally:
+			self.loop.close()
+
+	async def __ingest(self):
+		attempt = 0
+		while not self._kill:
+			try:
+				reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), APRS_CONNECT_TIMEOUT)
+			except (OSError, asyncio.TimeoutError) as e:
+				self.counter_connection_errors += 1
+				self.logger.error('Connect error to {}:{}: {}'.format(self.host, self.port, e))
+			else:
+				self.counter_connections += 1
+				if await self.__read(reader, writer):
+					# the connection worked, the backoff starts again from the first delay
+					attempt = 0
+
+			if self._kill or not self.autoreconnect:
+				break
+
+			# exponential backoff, jittered so that the clients of a restarted server do not reconnect all at once
+			delay = min(APRS_RECONNECT_MAX_DELAY, APRS_RECONNECT_DELAY * 2 ** attempt) * random.uniform(0.5, 1)
+			attempt += 1
+			self.logger.info('Waiting {}s before next connection try.'.format(round(delay, 1)))
+			await asyncio.sleep(delay)
+
+	async def __read(self, reader, writer):
+		""" Read the lines of a connection until it is lost, True if at least a line other than a server comment (# ...) was received. """
+		login = create_aprs_login(self.aprs_user, self.aprs_passcode, self.settings.APRS_APP_NAME, self.settings.APRS_APP_VER, self.aprs_filter)
+		writer.write(login.encode())
+		self.last_line_time = time.monotonic()
+		watchdog = asyncio.get_running_loop().create_task(self.__watchdog(writer))
+		received = False
+		oversized = False
+		pending = bytearray()
+		try:
+			while True:
+				data = await reader.read(APRS_READ_SIZE)
+				if not data:
+					self.logger.warning('Connection closed by {}:{}'.format(self.host, self.port))
+					break
+				self.last_line_time = time.monotonic()
+
+				# the complete lines are decoded at once, the end of the last one is kept for the next read
+				pending += data
+				end = pending.rfind(b'\n')
+				if end < 0:
+					if len(pending) > APRS_READ_SIZE:
+						if not oversized:
+							self.logger.warning('Line longer than {} bytes dropped.'.format(APRS_READ_SIZE))
+						pending.clear()
+						oversized = True
+					continue
+
+				# the rest of a dropped line ends at the first new line
+				start = pending.find(b'\n') + 1 if oversized else 0
+				oversized = False
+				lines = pending[start:end].decode('utf-8', 'replace').split('\n')
+				del pending[:end + 1]
+
+				self.counter_lines += len(lines)
+				for line in lines:
+					line = line.strip()
+					if not line:
+						continue
+					if line[0] != '#':
+						# a server that sends its banner and closes the connection does not reset the backoff
+						received = True
+					elif self.precheck:
+						self.counter_skipped += 1
+						continue
+					try:
+						self.lines.put_nowait(line)
+					except queue.Full:
+						self.counter_dropped += 1
+		except OSError as e:
+			self.logger.error('Read error from {}:{}: {}'.format(self.host, self.port, e))
+		finally:
+			watchdog.cancel()
+			writer.close()
+		return received
+
+	async def __watchdog(self, writer):
+		keepalive_time = time.monotonic()
+		while True:
+			await asyncio.sleep(APRS_WATCHDOG_INTERVAL)
+			now = time.monotonic()
+			if now - self.last_line_time > APRS_READ_TIMEOUT:
+				self.logger.warning('Nothing received from {}:{} for {}s, reconnect.'.format(self.host, self.port, APRS_READ_TIMEOUT))
+				writer.transport.abort()
+				return
+			if now - keepalive_time > self.settings.APRS_KEEPALIVE_TIME:
+				self.logger.info('Send keepalive to {}:{}'.format(self.host, self.port))
+				writer.write(b'#keepalive\n')
+				keepalive_time = now
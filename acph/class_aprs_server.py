@@ -0,0 +1,349 @@
+#  This module contains a local stand-in of an APRS-IS server of the OGN network: it speaks the login handshake,
+#  honours the range filters (r/lat/lon/dist) and streams recorded or synthetic beacons at a multiple of real time,
+#  with injected disconnects and stalls, to load test the APRS clients and the logbook without the live servers.
+
+import re
+import time
+import asyncio
+import logging
+import datetime
+
+from acph.geo_math import haversine
+
+SERVER_HOST = '127.0.0.1'			# the server is only reachable from the host by default
+SERVER_PORT = 14580					# port of the client defined filters of the OGN servers
+SERVER_NAME = 'ACPH-STANDIN'		# name of the server in its comments and login responses
+SERVER_SPEED = 1.0					# replay speed, multiple of real time, 0 to send the beacons as fast as the clients read them
+SERVER_KEEPALIVE_INTERVAL = 20		# send a server comment every n seconds, as the OGN servers do
+SERVER_LOGIN_TIMEOUT = 30			# close a connection without login after n seconds
+SERVER_BUFFER_LIMIT = 4194304		# bytes, a client with more bytes waiting to be sent is disconnected, as aprsc does
+SERVER_STATS_INTERVAL = 10			# log the statistics every n seconds
+SERVER_SLEEP_MIN = 0.002			# seconds, beacons due within this delay are sent without sleeping
+SERVER_BATCH_SIZE = 1000			# max number of beacons written at once to a client
+
+LOGIN_REGEX = re.compile(r'^user\s+(\S+)(?:\s+pass\s+(-?\d+))?(?:\s+vers\s+(\S+)\s+(\S+))?(?:\s+filter\s+(.*))?$', re.IGNORECASE)
+POSITION_REGEX = re.compile(r':[/@]\d{6}h(\d{2})(\d{2}\.\d{2})([NS]).(\d{3})(\d{2}\.\d{2})([EW])')	# latitude and longitude of an OGN position message
+TIME_REGEX = re.compile(r':([/@>])\d{6}h')																# time of a position or status message
+
+def aprs_position(line):
+	""" (latitude, longitude) of an APRS position message in decimal degrees, None if the line has no position. """
+	match = POSITION_REGEX.search(line)
+	if match is None:
+		return None
+	latitude = int(match.group(1)) + float(match.group(2)) / 60
+	longitude = int(match.group(4)) + float(match.group(5)) / 60
+	return (-latitude if match.group(3) == 'S' else latitude, -longitude if match.group(6) == 'W' else longitude)
+
+def parse_login(line):
+	""" (user, filter) of an APRS-IS login line, None if it is not a login. """
+	match = LOGIN_REGEX.match(line.strip())
+	if match is None:
+		return None
+	return match.group(1), (match.group(5) or '').strip()
+
+class AprsRangeFilter:
+
+	""" Subset of the APRS-IS server side filter: the range filters r/lat/lon/dist.
+
+	A position matches when it is within dist km of the center of one of the
+	range filters. A message without position (a status) matches when the
+	last position of its sender matched, as the APRS-IS servers use the last
+	known position of a station. The other filter types are ignored, and a
+	filter without range filter lets everything through (full feed).
+
+	Parameters
+	----------
+	aprs_filter : str
+		Filter sent by the client at login, e.g. r/45.5138/3.2661/200.
+	"""
+
+	def __init__(self, aprs_filter=''):
+		self.logger = logging.getLogger(__name__)
+		self.ranges = []			# (latitude, longitude, distance in km)
+		self.ignored = []			# filters not supported
+		self.senders = set()		# senders whose last position matched
+
+		for term in aprs_filter.split():
+			fields = term.split('/')
+			try:
+				if fields[0].lower() == 'r' and len(fields) == 4:
+					self.ranges.append((float(fields[1]), float(fields[2]), float(fields[3])))
+					continue
+			except ValueError:
+				pass
+			self.ignored.append(term)
+		if self.ignored:
+			self.logger.warning('APRS filters {} not supported by the stand-in server, ignored.'.format(' '.join(self.ignored)))
+
+	def isFullFeed(self):
+		return not self.ranges
+
+	def match(self, line, position):
+		if not self.ranges:
+			return True
+		sender = line[:line.find('>')]
+		if position is None:
+			return sender in self.senders
+
+		latitude, longitude = position
+		if any(haversine(latitude, longitude, center_latitude, center_longitude) <= distance for center_latitude, center_longitude, distance in self.ranges):
+			self.senders.add(sender)
+			return True
+		self.senders.discard(sender)
+		return False
+
+	def __str__(self):
+		return ' '.join('r/{}/{}/{}'.format(*item) for item in self.ranges) if self.ranges else 'full-feed'
+
+class AprsServerConnection:
+	""" A logged in client of the stand-in server. """
+
+	def __init__(self, reader, writer, user, aprs_filter):
+		self.reader = reader
+		self.writer = writer
+		self.user = user
+		self.filter = aprs_filter
+		self.peer = writer.get_extra_info('peername')
+		self.counter_lines = 0
+		self.closed = False
+
+	def close(self, abort=False):
+		if not self.closed:
+			self.closed = True
+			if abort:
+				self.writer.transport.abort()
+			else:
+				self.writer.close()
+
+class AcphAprsServer:
+
+	""" Local APRS-IS server streaming a source of beacons to its clients.
+
+	The beacons are sent when the time elapsed since the first one, divided
+	by `speed`, has elapsed on the wall clock: all the clients share the same
+	feed, as with a live server a client connecting late or reconnecting only
+	gets the beacons from then on. The time of the messages can be rewritten
+	to the wall clock time they are sent, the feed lag measured by the APRS
+	client is then the end-to-end lag of the logbook. A client whose send
+	buffer grows above SERVER_BUFFER_LIMIT is disconnected, except at speed 0
+	where the server waits for the slowest client.
+
+	Parameters
+	----------
+	beacons : callable
+		Returns an iterable of (raw APRS message, timestamp), by time.
+	host, port : str, int, optional
+		Address the server listens on.
+	speed : float, optional
+		Multiple of real time, 0 to send the beacons as fast as the clients read them.
+	loop : bool, optional
+		Replay the beacons again from the first one when all are sent.
+	retime : bool, optional
+		Rewrite the time of the messages to the time they are sent.
+	disconnect_interval : float, optional
+		Disconnect all the clients every n seconds, never if 0.
+	stall_interval, stall_duration : float, optional
+		Every `stall_interval` seconds, send nothing for `stall_duration` seconds, never if 0.
+	"""
+
+	def __init__(self, beacons, host=SERVER_HOST, port=SERVER_PORT, speed=SERVER_SPEED, loop=False, retime=True, disconnect_interval=0, stall_interval=0, stall_duration=0):
+		self.logger = logging.getLogger(__name__)
+		self.beacons = beacons
+		self.host = host
+		self.port = port
+		self.speed = speed
+		self.loop = loop
+		self.retime = retime
+		self.disconnect_interval = disconnect_interval
+		self.stall_interval = stall_interval
+		self.stall_duration = stall_duration
+
+		self.clients = []
+		self.server = None
+		self.clients_connected = None
+		self.stalled = False
+
+		# statistics
+		self.counter_beacons = 0
+		self.counter_lines_sent = 0
+		self.counter_connections = 0
+		self.counter_slow_clients = 0
+		self.counter_disconnects = 0
+		self.counter_stalls = 0
+		self.replay_lag = 0.0		# seconds the feed is behind the replay clock
+
+	def run(self):
+		""" Serve until interrupted. """
+		try:
+			asyncio.run(self.serve())
+		except KeyboardInterrupt:
+			pass
+		self.logStatistics()
+
+	async def serve(self):
+		self.clients_connected = asyncio.Event()
+		self.server = await asyncio.start_server(self.__handleConnection, self.host, self.port)
+		self.logger.warning('APRS stand-in server listening on {}:{}, speed {}, waiting for a client to start the feed.'.format(self.host, self.port, self.speed if self.speed > 0 else 'max'))
+		tasks = [asyncio.ensure_future(task) for task in (self.__feed(), self.__keepalive(), self.__logPeriodically())]
+		if self.disconnect_interval > 0:
+			tasks.append(asyncio.ensure_future(self.__injectDisconnects()))
+		if self.stall_interval > 0 and self.stall_duration > 0:
+			tasks.append(asyncio.ensure_future(self.__injectStalls()))
+		try:
+			async with self.server:
+				await tasks[0]
+				if not self.loop:
+					# the beacons are all sent, the clients stay connected and get the keepalives
+					self.logger.warning('All the beacons are sent, the server keeps the clients connected.')
+					await self.server.serve_forever()
+		finally:
+			for task in tasks:
+				task.cancel()
+			for client in list(self.clients):
+				client.close()
+
+	async def __handleConnection(self, reader, writer):
+		self.counter_connections += 1
+		writer.write('# aprsc 2.1.8 {} {}:{}\r\n'.format(SERVER_NAME, self.host, self.port).encode())
+		try:
+			line = await asyncio.wait_for(reader.readline(), SERVER_LOGIN_TIMEOUT)
+		except (asyncio.TimeoutError, OSError):
+			writer.close()
+			return
+		login = parse_login(line.decode('utf-8', 'replace'))
+		if login is None:
+			self.logger.warning('Invalid login from {}: {}'.format(writer.get_extra_info('peername'), line))
+			writer.close()
+			return
+
+		user, aprs_filter = login
+		client = AprsServerConnection(reader, writer, user, AprsRangeFilter(aprs_filter))
+		writer.write('# logresp {} unverified, server {}\r\n'.format(user, SERVER_NAME).encode())
+		self.clients.append(client)
+		self.clients_connected.set()
+		self.logger.warning('Client {} logged in from {} with filter {}'.format(user, client.peer, client.filter))
+
+		# the client only sends keepalives, read until it disconnects
+		try:
+			while not client.closed:
+				if not await reader.readline():
+					break
+		except OSError:
+			pass
+		finally:
+			client.close()
+			if client in self.clients:
+				self.clients.remove(client)
+			self.logger.warning('Client {} from {} disconnected, {} lines sent.'.format(client.user, client.peer, client.counter_lines))
+
+	def __retime(self, line, now):
+		match = TIME_REGEX.search(line)
+		if match is None:
+			return line
+		return line[:match.start() + 2] + now + line[match.end() - 1:]
+
+	async def __feed(self):
+		# the feed starts with the first client
+		await self.clients_connected.wait()
+		while True:
+			await self.__replay()
+			if not self.loop:
+				return
+			self.logger.warning('All the beacons are sent, replay them again.')
+
+	async def __replay(self):
+		start_time = None
+		first_timestamp = None
+		batch = []
+		for line, timestamp in self.beacons():
+			if start_time is None:
+				start_time = time.monotonic()
+				first_timestamp = timestamp
+
+			if self.speed > 0:
+				delay = start_time + (timestamp - first_timestamp).total_seconds() / self.speed - time.monotonic()
+				if delay > SERVER_SLEEP_MIN:
+					await self.__send(batch)
+					batch = []
+					await asyncio.sleep(delay)
+				self.replay_lag = max(0.0, -delay)
+			batch.append(line)
+			if len(batch) >= SERVER_BATCH_SIZE:
+				await self.__send(batch)
+				batch = []
+		await self.__send(batch)
+
+	async def __send(self, lines):
+		while self.stalled:
+			await asyncio.sleep(SERVER_SLEEP_MIN)
+		if not lines:
+			# yield to the connections
+			await asyncio.sleep(0)
+			return
+
+		self.counter_beacons += len(lines)
+		if self.retime:
+			now = datetime.datetime.utcnow().strftime('%H%M%S')
+			lines = [self.__retime(line, now) for line in lines]
+		positions = [aprs_position(line) for line in lines] if any(not client.filter.isFullFeed() for client in self.clients) else None
+
+		for client in list(self.clients):
+			if client.filter.isFullFeed():
+				selected = lines
+			else:
+				selected = [line for line, position in zip(lines, positions) if client.filter.match(line, position)]
+			if not selected:
+				continue
+			client.writer.write(('\r\n'.join(selected) + '\r\n').encode())
+			client.counter_lines += len(selected)
+			self.counter_lines_sent += len(selected)
+
+			if self.speed == 0:
+				try:
+					await client.writer.drain()
+				except OSError:
+					client.close()
+			elif client.writer.transport.get_write_buffer_size() > SERVER_BUFFER_LIMIT:
+				self.counter_slow_clients += 1
+				self.logger.warning('Client {} from {} does not read fast enough, {} bytes waiting, disconnect it.'.format(client.user, client.peer, client.writer.transport.get_write_buffer_size()))
+				client.close(abort=True)
+		await asyncio.sleep(0)
+
+	async def __keepalive(self):
+		while True:
+			await asyncio.sleep(SERVER_KEEPALIVE_INTERVAL)
+			if self.stalled:
+				continue
+			comment = '# aprsc 2.1.8 {} GMT {} {}:{}\r\n'.format(datetime.datetime.utcnow().strftime('%d %b %Y %H:%M:%S'), SERVER_NAME, self.host, self.port).encode()
+			for client in self.clients:
+				client.writer.write(comment)
+
+	async def __injectDisconnects(self):
+		while True:
+			await asyncio.sleep(self.disconnect_interval)
+			if self.clients:
+				self.counter_disconnects += 1
+				self.logger.warning('Injected disconnect of {} clients.'.format(len(self.clients)))
+				for client in list(self.clients):
+					client.close(abort=True)
+
+	async def __injectStalls(self):
+		while True:
+			await asyncio.sleep(self.stall_interval)
+			self.counter_stalls += 1
+			self.logger.warning('Injected stall, nothing sent for {}s.'.format(self.stall_duration))
+			self.stalled = True
+			await asyncio.sleep(self.stall_duration)
+			self.stalled = False
+
+	async def __logPeriodically(self):
+		counter_beacons = self.counter_beacons
+		while True:
+			await asyncio.sleep(SERVER_STATS_INTERVAL)
+			self.logger.info('APRS stand-in server, {} beacons/s'.format(round((self.counter_beacons - counter_beacons) / SERVER_STATS_INTERVAL)))
+			counter_beacons = self.counter_beacons
+			self.logStatistics()
+
+	def logStatistics(self):
+		self.logger.info('APRS stand-in server, {} clients, {} beacons, {} lines sent, {} connections, {} slow clients disconnected, {} injected disconnects, {} injected stalls, replay lag {}s'.format(
+			len(self.clients), self.counter_beacons, self.counter_lines_sent, self.counter_connections, self.counter_slow_clients, self.counter_disconnects, self.counter_stalls, round(self.replay_lag, 3)))
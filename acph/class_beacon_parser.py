@@ -0,0 +1,119 @@
+#  This module contains a fast parser of the aircraft position beacons (OGN aprs_aircraft and flarm), the
+#  other messages are left to ogn.parser.
+
+import re
+import logging
+
+from datetime import datetime, timedelta, timezone
+from ogn.parser import parse
+from ogn.parser.utils import parseAngle, KNOTS_TO_MS, KPH_TO_MS, FEETS_TO_METER, FPM_TO_MS
+
+PARSERS = ('fast', 'ogn')						# values of the parser setting of the logbook
+BEACON_TYPES = {'APRS': 'aprs_aircraft', 'OGFLR': 'flarm'}	# beacon type of the destinations handled by the fast path
+PARSED_FIELDS = ('aprs_type', 'beacon_type', 'name', 'dstcall', 'receiver_name', 'timestamp', 'latitude', 'longitude', 'track', 'ground_speed', 'altitude',
+	'address', 'address_type', 'aircraft_type', 'climb_rate')	# fields set by the fast path, with the values of ogn.parser
+PARSER_LOG_INTERVAL = 100000					# log the counters every n messages
+HALF_DAY = timedelta(hours=12)
+ONE_DAY = timedelta(days=1)
+
+# Aircraft position of the aprs_aircraft and flarm beacons, same fields and same backtracking as the patterns
+# of ogn.parser restricted to: no comma in the body (ogn.parser takes the last comma as the end of the path),
+# HHMMSSh time, course, speed and altitude present and an id comment. The header, the position and the
+# climb rate are read in a single match, the rest of the comment is skipped.
+PATTERN_AIRCRAFT_POSITION = re.compile(r"""
+	(?P<callsign>[^>:\n]+)>(?P<dstcall>APRS|OGFLR),[^:\n]*,(?P<receiver>[^,:\n]+):/
+	(?P<time>(?:[0-1]\d|2[0-3])[0-5]\d[0-5]\d)h
+	(?P<latitude>[0-8]\d{3}\.\d{2})(?P<latitude_sign>[NS])[^,\n]
+	(?P<longitude>1[0-7]\d{3}\.\d{2}|0\d{4}\.\d{2})(?P<longitude_sign>[EW])[^,\n]
+	(?P<course>\d{3})/(?P<ground_speed>\d{3})/A=(?P<altitude>-\d{5}|\d{6})
+	(?:\s!W(?P<latitude_enhancement>\d)(?P<longitude_enhancement>\d)!)?
+	\sid(?P<details>[\dA-F]{2})(?P<address>[\dA-F]{6})\s?
+	(?:(?P<climb_rate>[+-]\d+)fpm\s)?
+	[^,\n]*\Z""", re.VERBOSE)
+
+class AircraftBeaconParser:
+
+	""" Parser of the aircraft position beacons, with the same results as ogn.parser.
+
+	The fast path reads only the fields of a position the logbook uses, with
+	one specialised regex instead of the cascade of ogn.parser (APRS header,
+	position, comment parser of the dstcall). The conversions (angles, units,
+	timestamp on the reference date) are the ones of ogn.parser. Any message
+	the fast path does not recognise (receiver, status, other dstcall, no
+	course or altitude,...) is parsed by ogn.parser.
+	"""
+
+	def __init__(self):
+		self.logger = logging.getLogger(__name__)
+		self.counter_messages = 0
+		self.counter_fast_path = 0
+
+	@staticmethod
+	def withConfig(section):
+		""" Parser of the parser setting of a [logbook] config section, None to only use ogn.parser. """
+		name = section.get('parser', 'fast') if section is not None else 'fast'
+		if name not in PARSERS:
+			raise ValueError('{} is an invalid value for the beacon parser.'.format(name))
+		return AircraftBeaconParser() if name == 'fast' else None
+
+	def parse(self, raw_message, reference_timestamp=None):
+		self.counter_messages += 1
+		if self.counter_messages % PARSER_LOG_INTERVAL == 0:
+			self.logStatistics()
+
+		if reference_timestamp is None:
+			reference_timestamp = datetime.utcnow()
+
+		beacon = self.parsePosition(raw_message, reference_timestamp)
+		if beacon is None:
+			return parse(raw_message, reference_timestamp)
+		self.counter_fast_path += 1
+		return beacon
+
+	def parsePosition(self, raw_message, reference_timestamp):
+		""" Beacon of an aircraft position, None if the message is not one the fast path recognises. """
+		# the classes of the pattern only match the ASCII characters the ogn.parser ones match
+		if not raw_message.isascii() or '\n' in raw_message:
+			return None
+		match = PATTERN_AIRCRAFT_POSITION.match(raw_message)
+		if match is None:
+			return None
+
+		callsign, dstcall, receiver, time, latitude, latitude_sign, longitude, longitude_sign, course, ground_speed, altitude, \
+			latitude_enhancement, longitude_enhancement, details, address, climb_rate = match.groups()
+		details = int(details, 16)
+		beacon = {
+			'raw_message': raw_message,
+			'reference_timestamp': reference_timestamp,
+			'aprs_type': 'position',
+			'beacon_type': BEACON_TYPES[dstcall],
+			'name': callsign,
+			'dstcall': dstcall,
+			'receiver_name': receiver,
+			'timestamp': self.timestamp(time, reference_timestamp),
+			'latitude': parseAngle('0' + latitude + (latitude_enhancement or '0')) * (-1 if latitude_sign == 'S' else 1),
+			'longitude': parseAngle(longitude + (longitude_enhancement or '0')) * (-1 if longitude_sign == 'W' else 1),
+			'track': int(course),
+			'ground_speed': int(ground_speed) * KNOTS_TO_MS / KPH_TO_MS,
+			'altitude': int(altitude) * FEETS_TO_METER,
+			'address': address,
+			'address_type': details & 0b00000011,
+			'aircraft_type': (details & 0b00111100) >> 2,
+		}
+		if climb_rate:
+			beacon['climb_rate'] = int(climb_rate) * FPM_TO_MS
+		return beacon
+
+	def timestamp(self, time, reference_timestamp):
+		# HHMMSS on the day of the reference, shifted by one day if more than 12 hours away (ogn.parser createTimestamp)
+		result = datetime(reference_timestamp.year, reference_timestamp.month, reference_timestamp.day, int(time[0:2]), int(time[2:4]), int(time[4:6]),
+			tzinfo=timezone.utc if reference_timestamp.tzinfo is not None else None)
+		if result > reference_timestamp + HALF_DAY:
+			result -= ONE_DAY
+		elif result < reference_timestamp - HALF_DAY:
+			result += ONE_DAY
+		return result
+
+	def logStatistics(self):
+		self.logger.info('Beacons parser, {} messages, {} parsed by the fast path, {} by ogn.parser'.format(self.counter_messages, self.counter_fast_path,
+			self.counter_messages - self.counter_fast_path))
@@ -0,0 +1,132 @@
+#  This module contains a pre-filter of the raw APRS messages, to drop the beacons the logbook does not
+#  handle before the full (and costly) parsing by ogn.parser.
+
+import logging
+
+# reasons of a rejection
+REJECT_COMMENT = 'comment'					# server comment or keepalive (# ...)
+REJECT_MALFORMED = 'malformed'				# no APRS header, the parser would fail
+REJECT_NOT_POSITION = 'not_position'		# status or other non position message
+REJECT_RECEIVER_BEACON = 'receiver_beacon'	# position of a receiver
+REJECT_RECEIVER = 'receiver'				# received by a filtered receiver
+REJECT_ADDRESS = 'address'					# callsign with an excluded prefix
+REJECT_OUTSIDE_BBOX = 'outside_bbox'		# position outside the bounding box
+REJECT_REASONS = (REJECT_COMMENT, REJECT_MALFORMED, REJECT_NOT_POSITION, REJECT_RECEIVER_BEACON, REJECT_RECEIVER, REJECT_ADDRESS, REJECT_OUTSIDE_BBOX)
+
+POSITION_TYPES = '/@!='				# APRS data type of the position messages
+TIMESTAMPED_POSITION_TYPES = '/@'	# position messages with a timestamp (7 chars) before the latitude
+RECEIVER_DSTCALL = 'OGNSDR'			# destination of the receivers beacons
+RECEIVER_PATH = ',TCPIP*'			# path of the beacons sent by a receiver itself
+BBOX_MARGIN = 0.001					# degree, covers the precision enhancement (!Wab!) not read by the pre-filter
+PREFILTER_LOG_INTERVAL = 100000		# log the counters every n messages
+
+class BeaconPreFilter:
+
+	""" Pre-filter of the raw APRS messages.
+
+	A message is only rejected when the header split (first `:`) is sure
+	to be the one of ogn.parser, it is read with str.find and fixed-offset
+	slices, no regex and no dict per message. Any message it can not decide
+	on (compressed position, comma in the body,...) is accepted and left to
+	the full parser.
+
+	Parameters
+	----------
+	receivers_filter : set, optional
+		Receivers whose beacons are rejected, same as the logbook ones.
+	exclude_prefixes : sequence of str, optional
+		Callsign prefixes (e.g. RND, ICA) of the rejected aircraft.
+	bbox : tuple, optional
+		(min latitude, min longitude, max latitude, max longitude) in degrees,
+		positions outside are rejected.
+	"""
+
+	def __init__(self, receivers_filter=None, exclude_prefixes=(), bbox=None):
+		self.logger = logging.getLogger(__name__)
+		self.receivers_filter = frozenset(receivers_filter) if receivers_filter else frozenset()
+		self.exclude_prefixes = tuple(prefix for prefix in exclude_prefixes if prefix)
+		if bbox is not None:
+			min_latitude, min_longitude, max_latitude, max_longitude = bbox
+			bbox = (min_latitude - BBOX_MARGIN, min_longitude - BBOX_MARGIN, max_latitude + BBOX_MARGIN, max_longitude + BBOX_MARGIN)
+		self.bbox = bbox
+
+		self.counter_messages = 0
+		self.counter_accepted = 0
+		self.counters_rejected = dict.fromkeys(REJECT_REASONS, 0)
+
+	@staticmethod
+	def withConfig(section, receivers_filter=None):
+		""" Pre-filter of a [prefilter] config section, None if it is disabled. """
+		if section is None or not section.getboolean('enabled', True):
+			return None
+		bbox = section.get('bbox', '').strip()
+		return BeaconPreFilter(receivers_filter,
+			exclude_prefixes=[prefix.strip() for prefix in section.get('exclude_prefixes', '').split(',')],
+			bbox=tuple(float(value) for value in bbox.split(',')) if bbox else None)
+
+	def accept(self, raw_message):
+		self.counter_messages += 1
+		if self.counter_messages % PREFILTER_LOG_INTERVAL == 0:
+			self.logStatistics()
+
+		reason = self.rejectReason(raw_message)
+		if reason is None:
+			self.counter_accepted += 1
+		else:
+			self.counters_rejected[reason] += 1
+		return reason is None
+
+	def rejectReason(self, raw_message):
+		""" Reason to reject a raw message, None if it has to be parsed. """
+		if raw_message[:1] == '#':
+			return REJECT_COMMENT
+
+		header_end = raw_message.find(':')
+		callsign_end = raw_message.find('>', 0, header_end)
+		if header_end < 0 or callsign_end <= 0 or header_end + 1 >= len(raw_message):
+			return REJECT_MALFORMED
+
+		# the parser takes the last comma followed by a colon as the end of the path, the body must have no comma
+		if raw_message.find(',', header_end) >= 0:
+			return None
+
+		aprs_type = raw_message[header_end + 1]
+		if aprs_type not in POSITION_TYPES:
+			return REJECT_NOT_POSITION
+
+		if raw_message.startswith(RECEIVER_DSTCALL, callsign_end + 1) or raw_message.find(RECEIVER_PATH, callsign_end, header_end) >= 0:
+			return REJECT_RECEIVER_BEACON
+
+		if self.receivers_filter and raw_message[raw_message.rfind(',', 0, header_end) + 1:header_end] in self.receivers_filter:
+			return REJECT_RECEIVER
+
+		if self.exclude_prefixes and raw_message.startswith(self.exclude_prefixes):
+			return REJECT_ADDRESS
+
+		if self.bbox is not None:
+			# DDMM.mmN then the symbol table then DDDMM.mmE
+			position = header_end + (9 if aprs_type in TIMESTAMPED_POSITION_TYPES else 2)
+			try:
+				latitude = int(raw_message[position:position + 2]) + float(raw_message[position + 2:position + 7]) / 60
+				longitude = int(raw_message[position + 9:position + 12]) + float(raw_message[position + 12:position + 17]) / 60
+			except ValueError:
+				return None
+
+			if raw_message[position + 7:position + 8] == 'S':
+				latitude = -latitude
+			elif raw_message[position + 7:position + 8] != 'N':
+				return None
+			if raw_message[position + 17:position + 18] == 'W':
+				longitude = -longitude
+			elif raw_message[position + 17:position + 18] != 'E':
+				return None
+
+			if not (self.bbox[0] <= latitude <= self.bbox[2] and self.bbox[1] <= longitude <= self.bbox[3]):
+				return REJECT_OUTSIDE_BBOX
+
+		return None
+
+	def logStatistics(self):
+		rejected = sum(self.counters_rejected.values())
+		self.logger.info('Beacons pre-filter, {} accepted, {} rejected ({})'.format(self.counter_accepted, rejected,
+			', '.join('{} {}'.format(count, reason) for reason, count in self.counters_rejected.items() if count)))
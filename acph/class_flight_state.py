@@ -0,0 +1,278 @@
+#  This module contains the in memory state of a flight of the logbook: a slotted object with the last positions
+#  of the aircraft in a fixed size ring buffer of doubles, with running averages, the dict view is only built to
+#  persist it.
+
+import math
+
+from array import array
+
+# columns of a position in the ring buffer
+POSITION_FIELDS = ('altitude', 'ground_speed', 'climb_rate', 'track', 'latitude', 'longitude')
+POSITION_COLUMNS = {field: column for column, field in enumerate(POSITION_FIELDS)}
+POSITION_WIDTH = len(POSITION_FIELDS)
+# dict view of a position as persisted before the buffer: the rounded altitude and ground speed and the track are integers, a missing climb rate is ''
+POSITION_INTEGERS = tuple(field in ('altitude', 'ground_speed', 'track') for field in POSITION_FIELDS)
+POSITION_MISSING = tuple('' if field == 'climb_rate' else None for field in POSITION_FIELDS)
+
+# fields of a logbook entry, in the order of their dict view
+FLIGHT_STATE_FIELDS = ('aircraft_id', 'status', 'status_last_airport', 'receivers', 'aircraft_type', 'aircraft_model', 'registration', 'cn', 'tracked', 'identified',
+	'takeoff_time', 'takeoff_airport', 'landing_time', 'landing_airport', 'flight_duration', 'launch_type', 'flight_id', 'last_positions', 'takeoff_runway', 'landing_runway')
+
+class PositionWindows:
+
+	""" Running averages maintained by the position buffers, shared by all the flights of a logbook.
+
+	Parameters
+	----------
+	windows : iterable of (str, int)
+		Position field and number of most recent positions of each average.
+	"""
+
+	def __init__(self, windows=()):
+		self.windows = tuple(dict.fromkeys(windows))
+		self.items = tuple((POSITION_COLUMNS[field], n) for field, n in self.windows)
+		self.index = {window: i for i, window in enumerate(self.windows)}
+		self.size = max((n for field, n in self.windows), default=0)
+
+	def __len__(self):
+		return len(self.windows)
+
+NO_WINDOWS = PositionWindows()
+
+class PositionRingBuffer:
+
+	""" The last `size` positions of an aircraft, most recent first.
+
+	The positions are stored in a single array of doubles, one row of
+	POSITION_WIDTH columns per position, and the oldest row is overwritten
+	when the buffer is full. A missing value (no climb rate in the beacon) is
+	stored as NaN and ignored by `average`. Iterating over the buffer gives the
+	positions as dicts, for the persistence engines, with the same values as
+	the beacons: integers for the altitude, ground speed and track, '' for a
+	missing climb rate.
+
+	The sum and number of values of each window of `windows` are updated when
+	a position is added, so these averages are read in O(1). The sums are
+	computed again from the positions each time the buffer wraps around, the
+	rounding errors of the additions and subtractions do not accumulate.
+
+	Parameters
+	----------
+	size : int
+		Max number of positions kept, at least the largest window.
+	positions : iterable of dict, optional
+		Initial positions, most recent first, as given by the iteration.
+	windows : PositionWindows, optional
+		Running averages maintained.
+	"""
+
+	__slots__ = ('size', 'count', 'head', 'values', 'windows', 'totals')
+
+	def __init__(self, size, positions=(), windows=NO_WINDOWS):
+		if size < windows.size:
+			raise ValueError('A buffer of {} positions cannot maintain an average on {} positions.'.format(size, windows.size))
+		self.size = size
+		self.count = 0
+		self.head = 0		# row of the next position written
+		self.values = array('d', bytes(8 * POSITION_WIDTH * size))
+		self.windows = windows
+		self.totals = array('d', bytes(16 * len(windows)))	# sum of each window, then its number of values
+
+		for position in reversed(list(positions)[:size]):
+			self.appendleft(*(self.__toFloat(position.get(field)) for field in POSITION_FIELDS))
+
+	def __len__(self):
+		return self.count
+
+	def __iter__(self):
+		values = self.values
+		for row in self.rows():
+			offset = row * POSITION_WIDTH
+			yield {field: missing if value != value else int(value) if integer and value.is_integer() else value
+				for field, value, integer, missing in zip(POSITION_FIELDS, values[offset:offset + POSITION_WIDTH], POSITION_INTEGERS, POSITION_MISSING)}
+
+	def __getstate__(self):
+		return (self.size, self.count, self.head, self.values, self.windows, self.totals)
+
+	def __setstate__(self, state):
+		self.size, self.count, self.head, self.values, self.windows, self.totals = state
+
+	@staticmethod
+	def __toFloat(value):
+		try:
+			return float(value)
+		except (TypeError, ValueError):
+			return math.nan
+
+	def rows(self):
+		""" Rows of the positions in the array, most recent first. """
+		return [(self.head - 1 - i) % self.size for i in range(self.count)]
+
+	def appendleft(self, altitude, ground_speed, climb_rate, track, latitude, longitude):
+		if climb_rate is None or climb_rate == '':
+			climb_rate = math.nan
+		values = self.values
+		head = self.head
+		size = self.size
+
+		# the new value enters each window, the value of the position n-1 (before this one) leaves the windows of n positions
+		if self.windows.items:
+			position = (altitude, ground_speed, climb_rate, track, latitude, longitude)
+			totals = self.totals
+			length = len(totals) >> 1
+			count = self.count
+			for i, (column, n) in enumerate(self.windows.items):
+				value = position[column]
+				if value == value:
+					totals[i] += value
+					totals[length + i] += 1
+				if count >= n:
+					value = values[((head - n) % size) * POSITION_WIDTH + column]
+					if value == value:
+						totals[i] -= value
+						totals[length + i] -= 1
+
+		offset = head * POSITION_WIDTH
+		values[offset] = altitude
+		values[offset + 1] = ground_speed
+		values[offset + 2] = climb_rate
+		values[offset + 3] = track
+		values[offset + 4] = latitude
+		values[offset + 5] = longitude
+
+		self.head = (head + 1) % size
+		if self.count < size:
+			self.count += 1
+		if self.head == 0 and self.windows.items:
+			self.resync()
+
+	def resync(self):
+		""" Compute the sums of the windows from the positions. """
+		values = self.values
+		totals = self.totals
+		length = len(totals) >> 1
+		rows = self.rows()
+		for i, (column, n) in enumerate(self.windows.items):
+			window = [values[row * POSITION_WIDTH + column] for row in rows[:n]]
+			window = [value for value in window if value == value]
+			totals[i] = math.fsum(window)
+			totals[length + i] = len(window)
+
+	def average(self, field, n=3):
+		""" Average of a field on the n most recent positions, 0 if none of them has a value. """
+		i = self.windows.index.get((field, n))
+		if i is not None:
+			counter = self.totals[len(self.windows) + i]
+			return self.totals[i] / counter if counter else 0
+
+		# not a maintained window
+		column = POSITION_COLUMNS[field]
+		values = self.values
+		total = 0.0
+		counter = 0
+		for row in self.rows()[:n]:
+			value = values[row * POSITION_WIDTH + column]
+			if value == value:
+				total += value
+				counter += 1
+		return total / counter if counter else 0
+
+class FlightState:
+
+	""" A flight of an aircraft in the logbook.
+
+	The fields are slots instead of the keys of a dict, so an entry costs a
+	fraction of the memory of the dict it replaces. The logbook reads and
+	writes them as attributes; the mapping methods (`entry['status']`, `get`,
+	`update`) are kept for the code handling the entries as dicts. `asDict`
+	builds the dict view persisted by the engines, `fromDict` rebuilds an entry
+	loaded from them.
+
+	Parameters
+	----------
+	aircraft_id : str
+		OGN id of the aircraft.
+	flight_id : int
+		Number of the flight of the aircraft for the day, from 1.
+	aircraft_type : str
+		OGN sender type of the aircraft.
+	ognDevice : dict
+		Entry of the aircraft in the OGN devices database.
+	positions_size : int
+		Number of positions kept in `last_positions`.
+	windows : PositionWindows, optional
+		Running averages maintained by `last_positions`.
+	"""
+
+	__slots__ = FLIGHT_STATE_FIELDS
+
+	def __init__(self, aircraft_id, flight_id, aircraft_type, ognDevice, positions_size, windows=NO_WINDOWS):
+		self.aircraft_id = aircraft_id
+		self.status = '?'
+		self.status_last_airport = ''
+		self.receivers = []
+		self.aircraft_type = aircraft_type
+		self.aircraft_model = ognDevice.get('aircraft_model')
+		self.registration = ognDevice.get('registration')
+		self.cn = ognDevice.get('cn')
+		self.tracked = ognDevice.get('tracked')
+		self.identified = ognDevice.get('identified')
+		self.takeoff_time = ''
+		self.takeoff_airport = ''
+		self.landing_time = ''
+		self.landing_airport = ''
+		self.flight_duration = ''
+		self.launch_type = '#unknown'
+		self.flight_id = flight_id
+		self.last_positions = PositionRingBuffer(positions_size, windows=windows)
+		self.takeoff_runway = ''
+		self.landing_runway = ''
+
+	@classmethod
+	def fromDict(cls, entry, positions_size, windows=NO_WINDOWS):
+		""" Entry rebuilt from its dict view, the keys which are not a field (the date of a MySQL row) are ignored. """
+		flight_state = cls.__new__(cls)
+		for field in FLIGHT_STATE_FIELDS:
+			setattr(flight_state, field, entry.get(field, ''))
+		flight_state.receivers = list(flight_state.receivers) if flight_state.receivers else []
+		flight_state.last_positions = PositionRingBuffer(positions_size, flight_state.last_positions or (), windows)
+		return flight_state
+
+	def asDict(self):
+		entry = {field: getattr(self, field) for field in FLIGHT_STATE_FIELDS}
+		entry['receivers'] = list(self.receivers)
+		entry['last_positions'] = list(self.last_positions)
+		return entry
+
+	def __getstate__(self):
+		return tuple(getattr(self, field) for field in FLIGHT_STATE_FIELDS)
+
+	def __setstate__(self, state):
+		for field, value in zip(FLIGHT_STATE_FIELDS, state):
+			setattr(self, field, value)
+
+	def __getitem__(self, key):
+		if key not in FLIGHT_STATE_FIELDS:
+			raise KeyError(key)
+		return getattr(self, key)
+
+	def __setitem__(self, key, value):
+		if key not in FLIGHT_STATE_FIELDS:
+			raise KeyError(key)
+		setattr(self, key, value)
+
+	def __contains__(self, key):
+		return key in FLIGHT_STATE_FIELDS
+
+	def __repr__(self):
+		return '{}({})'.format(self.__class__.__name__, self.asDict())
+
+	def get(self, key, default=None):
+		return getattr(self, key) if key in FLIGHT_STATE_FIELDS else default
+
+	def keys(self):
+		return FLIGHT_STATE_FIELDS
+
+	def update(self, fields):
+		for key, value in fields.items():
+			self[key] = value
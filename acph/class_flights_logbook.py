@@ -1,14 +1,20 @@
+import time
 import logging
+import operator
 import collections
-import itertools
 import datetime
-import re
 
 from ogn.parser import parse, ParseError
 from geopy import distance
-from collections import deque
 
 from acph.class_vptree import AcphVPTree
+from acph.class_airport_locator import NumpyAirportLocator, GridAirportLocator
+from acph.class_airport_db import runway_table_bin
+from acph.class_ogn_db import UNKNOWN_OGN_DEVICE
+from acph.class_towplane_index import TowPlaneIndex
+from acph.geo_math import haversine, equirectangular, within_distance
+from acph.class_flight_state import FlightState, PositionWindows
+from acph.class_metrics import NO_METRICS, STAGE_PREFILTER, STAGE_PARSE, STAGE_HANDLE, STAGE_OGN_LOOKUP, STAGE_NEAREST_AIRPORT, STAGE_STATE_MACHINE, STAGE_LAUNCH_TYPE, STAGE_SAVE
 
 # OGN constants for sender_type and address_type
 # http://wiki.glidernet.org/wiki:ogn-flavoured-aprs
@@ -44,9 +50,20 @@ WINCH_CLIMB_RATE_THRESHOLD = 10		# 1O m/s
 AIRPORT_DISTANCE_THRESHOLD = 4		# 4 km
 FEETS_TO_METER = 0.3048				# ratio feet to meter
 
-BUFFER_AIRCRAFT_BEACON = 1000		# to keep the last  n aircraft beacons received
 NBR_OF_DAY_LOGBOOK = 1				# number of logbook's days to keep in memory
 BUFFER_AIRCRAFT_POSITION = 5		# to keep for each aircraft the last n received positions
+TAKEOFF_WINDOW = 3					# number of positions of the average ground speed detecting a take-off
+LANDING_WINDOW = 3					# number of positions of the average ground speed detecting a landing
+WINCH_WINDOW = 5					# number of positions of the average climb rate detecting a winch launch
+PERSISTENCE_LOG_INTERVAL = 1000		# log the persistence counters every n aircraft beacons
+CACHE_MAX_AIRCRAFT = 20000			# max number of aircraft kept in memory, the least recently seen are evicted above, 0 for no limit
+CACHE_LANDED_TIMEOUT = 900			# evict an aircraft not in the air (last flight landed or on the ground) when no beacon is received for n seconds, 0 to keep it
+CACHE_IDLE_TIMEOUT = 3600			# evict an aircraft when no beacon is received for n seconds, 0 to keep it
+CACHE_SWEEP_INTERVAL = 60			# look for the aircraft to evict every n seconds of beacons
+
+# a change of any of these fields is persisted immediately, other changes are throttled by the persistence engine
+PERSISTED_STATE_FIELDS = ('status', 'status_last_airport', 'takeoff_time', 'takeoff_airport', 'landing_time', 'landing_airport', 'flight_duration', 'launch_type', 'takeoff_runway', 'landing_runway')
+persisted_state_of = operator.attrgetter(*PERSISTED_STATE_FIELDS)
 
 def feet_to_meter(altitude_in_feet):
 	return round(altitude_in_feet * FEETS_TO_METER)
@@ -73,20 +90,76 @@ class LRU(collections.OrderedDict):
 			del self[oldest]
 
 class FlightsLogBook:
-	def __init__(self, receivers_filter, ogndb, airports_db, pdo_engine):
+	def __init__(self, receivers_filter, ogndb, airports_db, pdo_engine, airports_engine = 'vptree', cache_dir = None, prefilter = None, parser = None,
+		takeoff_window = TAKEOFF_WINDOW, landing_window = LANDING_WINDOW, winch_window = WINCH_WINDOW, metrics = None,
+		max_aircraft = CACHE_MAX_AIRCRAFT, landed_timeout = CACHE_LANDED_TIMEOUT, idle_timeout = CACHE_IDLE_TIMEOUT, warm_start = False):
 		self.receivers_filter = receivers_filter
+		self.prefilter = prefilter
+		self.parser = parser
+		self.parse = parser.parse if parser is not None else parse
+		self.metrics = metrics if metrics is not None else NO_METRICS
 		self.ogn_devices_db = ogndb
 		self.pdo_engine = pdo_engine
 		self.airports = airports_db
-		self.airports_tree =  AcphVPTree([ [item.lat, item.lon, item.icao] for item in airports_db.values()], self.vptree_distance_great_circle)	
+		self.airports_ground_band = {icao: (max(0, airport.elevation_m - ALTITUDE_THRESHOLD), airport.elevation_m + ALTITUDE_THRESHOLD) for icao, airport in airports_db.items()}
+		self.airports_tree = None
+		self.airports_locator = None
+		if airports_engine.upper() == 'VPTREE':
+			airports_points = [ [item.lat, item.lon, item.icao] for item in airports_db.values()]
+			if cache_dir is None:
+				self.airports_tree = AcphVPTree(airports_points, self.vptree_distance_great_circle)
+			else:
+				self.airports_tree = AcphVPTree.withCacheFile(airports_points, self.vptree_distance_great_circle, cache_dir)
+			self.findNearestAirportWithEngine = self.findNearestAirport_vptree
+		elif airports_engine.upper() == 'NUMPY':
+			self.airports_locator = NumpyAirportLocator(airports_db)
+			self.findNearestAirportWithEngine = self.findNearestAirport_numpy
+		elif airports_engine.upper() == 'GRID':
+			self.airports_locator = GridAirportLocator(airports_db, AIRPORT_DISTANCE_THRESHOLD)
+			self.findNearestAirportWithEngine = self.findNearestAirport_grid
+		else:
+			raise ValueError('{} is an invalid value for the nearest airport engine.'.format(airports_engine))
 		self.logbook = LRU(maxsize=NBR_OF_DAY_LOGBOOK)
-		self.buffer_aircraft_beacons = deque(maxlen=BUFFER_AIRCRAFT_BEACON)
+
+		# averages maintained by the positions buffer of each flight as positions are added, the buffer is made larger if a window needs it
+		self.takeoff_window = takeoff_window
+		self.landing_window = landing_window
+		self.winch_window = winch_window
+		self.positions_windows = PositionWindows((('ground_speed', takeoff_window), ('ground_speed', landing_window), ('climb_rate', winch_window)))
+		self.positions_size = max(BUFFER_AIRCRAFT_POSITION, self.positions_windows.size)
+		self.tow_planes = TowPlaneIndex()
 		self.logger = logging.getLogger(__name__)
 		self.logger.warning(' ACPH Flights Logbook initialized.')
 		self.counter_aircraft_beacon_position = 0
 
+		# for each flight (date, aircraft id, flight id) not yet landed: [state fields when last saved, beacon timestamp of last save, entry not saved since or None]
+		self.persisted_states = dict()
+		self.counter_saves = 0
+		self.counter_saves_skipped = 0
+
+		# the aircraft of the logbook by last beacon, evicted when landed or idle for too long and reloaded from the persistence engine when seen again
+		self.max_aircraft = max_aircraft
+		self.landed_timeout = datetime.timedelta(seconds=landed_timeout)
+		self.idle_timeout = datetime.timedelta(seconds=idle_timeout)
+		self.aircraft_seen = collections.OrderedDict()		# (date, aircraft id) -> timestamp of its last beacon, least recently seen first
+		self.aircraft_evicted = set()						# (date, aircraft id) evicted, to count the reloads
+		self.last_sweep = None
+		self.counter_loads = 0
+		self.counter_reloads = 0
+		self.counter_evictions = 0
+		self.counters_evictions = collections.Counter()		# reason -> number of aircraft evicted
+		self.evicted_flights = None				# date -> aircraft id -> flight id -> flight of the evicted aircraft, only kept if set to a dict (replay report)
+
+		# with the warm start, all the flights of a day are loaded at once when the day starts, an aircraft not loaded has no flight that day (negative cache)
+		self.warm_start = warm_start
+		self.aircraft_filter = None				# aircraft handled by this logbook (pipeline shard), all if None
+		self.days_loaded = set()				# days loaded by the warm start
+		self.counter_warm_started = 0
+		self.counter_loads_avoided = 0
+		self.metrics.addGauges('logbook', self.gauges)
+
 	def vptree_distance_great_circle(self,p1, p2):
-		return distance.great_circle((p1[0], p1[1]), (p2[0], p2[1])).km
+		return haversine(p1[0], p1[1], p2[0], p2[1])
 
 	def vptree_distance_geodesic(self, p1, p2):
 		return distance.geodesic((p1[0], p1[1]), (p2[0], p2[1]), ellipsoid='WGS-84').km
@@ -111,8 +184,35 @@ class FlightsLogBook:
 		self.logger.info('handle beacon position weather, raw data: {raw_message}'.format(**beacon))
 
 	def handleBeacon(self, raw_message, timestamp = None, date = None):
+		metrics = self.metrics
+
+		# drop the beacons that would not be handled before parsing them
+		if self.prefilter is not None:
+			start = metrics.clock()
+			accepted = self.prefilter.accept(raw_message)
+			metrics.observe(STAGE_PREFILTER, start)
+			if not accepted:
+				return
+
+		try:
+			start = metrics.clock()
+			beacon = self.parse(raw_message, timestamp)
+			metrics.observe(STAGE_PARSE, start)
+		except ParseError as parsingError:
+			# self.logger.error("Exception occurred", exc_info=True)
+			self.logger.info(parsingError)
+			return
+		except KeyboardInterrupt:
+			self.logger.error('Keyboard interrupt')
+			raise(KeyboardInterrupt)
+		except:
+			self.logger.exception('Unexpected error when parsing following aprs beacon {}'.format(raw_message))
+			return
+		self.handleParsedBeacon(beacon, date)
+
+	def handleParsedBeacon(self, beacon, date = None):
+		start = self.metrics.clock()
 		try:
-			beacon = parse(raw_message, timestamp)
 			self.logger.debug('Receive beacon {aprs_type}, raw data: {raw_message}'.format(**beacon))
 			handlers = {
 				'position': self.handlePosition,
@@ -122,15 +222,14 @@ class FlightsLogBook:
 				'position_weather': self.handleWeather,
 			}
 			func = handlers.get(beacon.get('aprs_type'),lambda beacon, date: self.logger.warning('aprs type ' + beacon['aprs_type'] + ' is unknown, beacon not handle.'))
+			self.metrics.count('beacons', beacon.get('aprs_type'), beacon.get('beacon_type'))
 			func(beacon, date)
-		except ParseError as parsingError:
-			# self.logger.error("Exception occurred", exc_info=True)
-			self.logger.info(parsingError)
 		except KeyboardInterrupt:
 			self.logger.error('Keyboard interrupt')
 			raise(KeyboardInterrupt)
 		except:
 			self.logger.exception('Unexpected error when handling following aprs beacon {raw_message}'.format(**beacon))
+		self.metrics.observe(STAGE_HANDLE, start)
 	
 	def isAircraftBeacon(self, beacon):
 		return beacon['beacon_type'] == 'aprs_aircraft' or beacon['beacon_type'] == 'flarm'
@@ -153,66 +252,103 @@ class FlightsLogBook:
 		# else:
 		# 	return False
 
+	def createLogbookForDate(self, date):
+		logbook_for_a_date = {}		# create an empty dict
+		self.logbook.update({date: logbook_for_a_date})
+
+		# flights of the days no more in memory are forgotten, after saving their last state
+		self.flush(lambda key: key[0] not in self.logbook)
+		for key in [key for key in self.aircraft_seen if key[0] not in self.logbook]:
+			del self.aircraft_seen[key]
+		self.aircraft_evicted = {key for key in self.aircraft_evicted if key[0] in self.logbook}
+		self.days_loaded = {day for day in self.days_loaded if day in self.logbook}
+		return logbook_for_a_date
+
+	def warmStart(self, date):
+		""" Load all the flights of a day from the persistence engine in a single query, instead of one query per aircraft when it is first seen.
+
+		The aircraft without flight that day are then known, their first beacon does not query the
+		persistence engine. If the loading fails, nothing is kept and the aircraft are loaded one by one.
+		Returns the number of aircraft loaded.
+		"""
+		if date in self.days_loaded:
+			return 0
+		start_time = time.perf_counter()
+		flights = {}
+		counter_rows = 0
+		try:
+			for row in self.pdo_engine.load_day(date):
+				if self.aircraft_filter is None or self.aircraft_filter(row['aircraft_id']):
+					flights.setdefault(row['aircraft_id'], []).append(FlightState.fromDict(row, self.positions_size, self.positions_windows))
+					counter_rows += 1
+		except Exception as e:
+			self.logger.error('Warm start of the logbook of {} failed, the aircraft will be loaded when first seen: {}'.format(date, e))
+			return 0
+
+		logbook_for_a_date = self.logbook.get(date)
+		if logbook_for_a_date is None:
+			logbook_for_a_date = self.createLogbookForDate(date)
+		for aircraft_id, logbook_for_aircraft in flights.items():
+			# an aircraft already in memory is more recent than the persistence engine
+			if aircraft_id in logbook_for_a_date:
+				continue
+			logbook_for_aircraft.sort(key=operator.attrgetter('flight_id'))
+			logbook_for_a_date[aircraft_id] = logbook_for_aircraft
+			# not seen yet, the eviction timeouts start at the next sweep
+			self.aircraft_seen[(date, aircraft_id)] = None
+		self.days_loaded.add(date)
+		self.counter_warm_started += len(flights)
+
+		while self.max_aircraft > 0 and len(self.aircraft_seen) > self.max_aircraft:
+			self.evictAircraft(next(iter(self.aircraft_seen)), 'cap')
+		self.logger.warning('Warm start of the logbook of {}, {} flights of {} aircraft loaded in {}s'.format(date, counter_rows, len(flights), round(time.perf_counter() - start_time, 3)))
+		return len(flights)
+
 	def findLogbookEntryByID(self, aircraft_id, date, aircraft_type, ognDevice):
 		logbook_for_a_date = self.logbook.get(date)
 
 		# Not yet create an entry for this day in the logbook, create it
 		if (logbook_for_a_date is None):
-			logbook_for_a_date = {}		# create an empty dict
-			self.logbook.update({date: logbook_for_a_date})
+			logbook_for_a_date = self.createLogbookForDate(date)
+			if self.warm_start:
+				self.warmStart(date)
 
 		# get the list of flights for this aircraft, if the list is not yet created, create it
 		logbook_for_aircraft = logbook_for_a_date.get(aircraft_id, None)
-		if (logbook_for_aircraft is None):
+		if (logbook_for_aircraft is None and date in self.days_loaded and (date, aircraft_id) not in self.aircraft_evicted):
+			# no flight of this aircraft in the persistence engine, all the flights of the day have been loaded by the warm start
+			logbook_for_aircraft = []
+			logbook_for_a_date.update({aircraft_id: logbook_for_aircraft})
+			self.counter_loads_avoided += 1
+		elif (logbook_for_aircraft is None):
 			# try to load it from the persistence engine (load all flights included already landed one) 
 			# needed when the supervisor relaunch the logbook program in the middle of day for example after an unexpected interuption.
-			logbook_for_aircraft = self.pdo_engine.load_aircraft(date, aircraft_id)
+			logbook_for_aircraft = [FlightState.fromDict(row, self.positions_size, self.positions_windows) for row in self.pdo_engine.load_aircraft(date, aircraft_id)]
 			logbook_for_a_date.update({aircraft_id: logbook_for_aircraft}) 
+			self.counter_loads += 1
+			if (date, aircraft_id) in self.aircraft_evicted:
+				self.aircraft_evicted.discard((date, aircraft_id))
+				self.counter_reloads += 1
 
 		# look for the last flight for this aircraft which is not already landed,
 		last_flight_log = None
 		last_flight_log_index = len(logbook_for_aircraft) -1
-		if last_flight_log_index>=0 and not logbook_for_aircraft[last_flight_log_index]['status'] == 'landed':
+		if last_flight_log_index>=0 and not logbook_for_aircraft[last_flight_log_index].status == 'landed':
 			last_flight_log = logbook_for_aircraft[last_flight_log_index]
 	
 		# if found nothing, first time we received a beacon for this aircraft_id or aircraft_id has already landed, create an new entry in the logbook
 		if last_flight_log is None:
-			last_flight_log = { 'aircraft_id': aircraft_id,
-				 'status': '?',
-				 'status_last_airport': '',
-				 'receivers': [],
-				 'aircraft_type' : aircraft_type,
-				 'aircraft_model': ognDevice.get('aircraft_model'),
-				 'registration': ognDevice.get('registration'),
-				 'cn': ognDevice.get('cn'),
-				 'tracked': ognDevice.get('tracked'),
-				 'identified': ognDevice.get('identified'),
-				 'takeoff_time': '',
-				 'takeoff_airport': '',
-				 'landing_time' : '',
-				 'landing_airport' : '',
-				 'flight_duration': '',
-				 'launch_type' : '#unknown',
-				 'flight_id' : len(logbook_for_aircraft) + 1,
-				 'last_positions' : deque(maxlen=BUFFER_AIRCRAFT_POSITION),
-				 'takeoff_runway' : '',
-				 'landing_runway' : ''
-				}
+			# the persistence engine may only give back the last flights of the aircraft
+			flight_id = logbook_for_aircraft[-1].flight_id + 1 if logbook_for_aircraft else 1
+			last_flight_log = FlightState(aircraft_id, flight_id, aircraft_type, ognDevice, self.positions_size, self.positions_windows)
 			logbook_for_aircraft.append(last_flight_log)
 		return last_flight_log
 
 	def findOgnAircraftById(self, aircraft_id):
 			ognDevice = self.ogn_devices_db.getAircraftById(aircraft_id)
-			# if we don't found this aircraft_id in OGN DB return a fake entry
+			# if we don't found this aircraft_id in OGN DB return the shared unknown device entry
 			if ognDevice is None:
-				ognDevice = {
-					"device_type":"#unknown",			# normaly F or I or O
-					"device_id": aircraft_id,
-					"aircraft_model":"#unknown",
-					"registration":"#unknown",
-					"cn":"#unknown",
-					"tracked":"N",
-					"identified":"N"}
+				ognDevice = UNKNOWN_OGN_DEVICE
 			return ognDevice
 
 	def __forDate(self, beacon, date):
@@ -229,38 +365,31 @@ class FlightsLogBook:
 		# 	raise Exception("Device id {} is unknow in OGN database".format(aircraft_id))
 
 		# handle even aircraft_id not in OGN DB (findOgnAircraftById return a fake OgnDb entry if aircraft_id doesn't exist in the DB)
+		start = self.metrics.clock()
 		ognDevice = self.findOgnAircraftById(aircraft_id)
+		self.metrics.observe(STAGE_OGN_LOOKUP, start)
 
 		# round some value from aprs message
-		beacon['altitude'] = round(beacon['altitude'])
-		beacon['ground_speed'] = round(beacon['ground_speed'])
-		if beacon.get('climb_rate') is not None:
-			beacon['climb_rate'] = round(beacon['climb_rate'],1) 
+		self.roundBeaconValues(beacon)
 		# self.logger.debug('Sender (type {sender}, callsign: {name}), Receiver callsign: {receiver_name}, {aircraft} {address} at {altitude}m, speed={ground_speed}km/h, heading={track}°, climb rate={climb_rate}m/s'.format(**beacon, aircraft=OGN_SENDER_TYPES[beacon['aircraft_type']], sender=ADDRESS_TYPES[beacon['address_type']]))
 	
 		# look for current entry in the logbook for this aircraft_id at the date of the received beacon.
 		lg_entry = self.findLogbookEntryByID(aircraft_id,self.__forDate(beacon,date), OGN_SENDER_TYPES[beacon['aircraft_type']], ognDevice)
 		if (lg_entry is None):
 				raise Exception('No entry found in the logbook for aircarft id {} and the date of {}'.format(aircraft_id,beacon['timestamp'].strftime('%Y-%m-%d')))
+		self.touchAircraft((self.__forDate(beacon, date), aircraft_id), beacon['timestamp'])
 		
 		# add the receiver who receive the beacon for this aircraft
-		if beacon['receiver_name'] not in lg_entry['receivers']:
-			lg_entry['receivers'].append(beacon['receiver_name'])
+		if beacon['receiver_name'] not in lg_entry.receivers:
+			lg_entry.receivers.append(beacon['receiver_name'])
 
 		# add gps coord, speed, altitude, track, clim rate to the buffer for this aircraft
-		toSave={
-			'altitude': beacon['altitude'],
-			'ground_speed': beacon['ground_speed'],
-			'climb_rate':  beacon.get('climb_rate',''),
-			'track':  beacon['track'],
-			'latitude': beacon['latitude'],
-			'longitude': beacon['longitude'],
-			# 'timestamp': beacon['timestamp']
-		}
-		lg_entry['last_positions'].appendleft(toSave)
+		lg_entry.last_positions.appendleft(beacon['altitude'], beacon['ground_speed'], beacon.get('climb_rate'), beacon['track'], beacon['latitude'], beacon['longitude'])
 
 		# handle the new aircraft beacon
-		nearest_airport, nearest_airport_distance = self.findNearestAirport_vptree(beacon['latitude'], beacon['longitude'])
+		start = self.metrics.clock()
+		nearest_airport, nearest_airport_distance = self.findNearestAirportWithEngine(beacon['latitude'], beacon['longitude'])
+		self.metrics.observe(STAGE_NEAREST_AIRPORT, start)
 		# is_near_coordinates = self.near_coordinates(airport, beacon['latitude'], beacon['longitude'])
 		stateMachine = {
 				'?': self.handleStateUnknow,
@@ -268,8 +397,13 @@ class FlightsLogBook:
 				'air': self.handleStateAirborne,
 				'landed': self.handleStateLanded,
 		}
-		functionToCall = stateMachine.get(lg_entry['status'],lambda lg_entry: self.logger.error('Unknown state <' +lg_entry['status'] + '>, no specific action to do.' ))
+		functionToCall = stateMachine.get(lg_entry.status,lambda lg_entry: self.logger.error('Unknown state <' +lg_entry.status + '>, no specific action to do.' ))
+		status = lg_entry.status
+		start = self.metrics.clock()
 		functionToCall(lg_entry, beacon, nearest_airport, nearest_airport_distance, ognDevice)
+		self.metrics.observe(STAGE_STATE_MACHINE, start)
+		if lg_entry.status != status:
+			self.metrics.count('state_transitions', status, lg_entry.status)
 
 		# if (self.ogn_devices_db.getAircraftRegistrationById(aircraft_id) == 'F-CJBH'):
 		# # if ( aircraft_id == 'DDE307'):
@@ -284,14 +418,142 @@ class FlightsLogBook:
 		self.updateBufferAicraftBeacons(lg_entry, beacon, ognDevice)
 
 		#persiste current logbook state
-		self.pdo_engine.save_aircraft(lg_entry, self.__forDate(beacon, date))
+		self.persistAircraft(lg_entry, self.__forDate(beacon, date), beacon['timestamp'])
+		if self.counter_aircraft_beacon_position % PERSISTENCE_LOG_INTERVAL == 0:
+			self.logger.info('Persistence, {} logbook entries saved, {} saves skipped (no state change within {}s)'.format(self.counter_saves, self.counter_saves_skipped, self.pdo_engine.save_throttle))
+			self.logger.info('Logbook cache, {aircraft} aircraft in memory, {evictions_landed} landed, {evictions_idle} idle and {evictions_cap} over the cap evicted, {loads} loads ({reloads} reloads of an evicted aircraft), {warm_started} aircraft warm started, {loads_avoided} loads avoided'.format(**self.gauges()))
+
+	def touchAircraft(self, key, timestamp):
+		# the aircraft becomes the most recently seen, the least recently seen are evicted when the logbook holds too many aircraft or periodically when idle
+		self.aircraft_seen[key] = timestamp
+		self.aircraft_seen.move_to_end(key)
+		while self.max_aircraft > 0 and len(self.aircraft_seen) > self.max_aircraft:
+			self.evictAircraft(next(iter(self.aircraft_seen)), 'cap')
+
+		if self.last_sweep is None or timestamp < self.last_sweep:
+			self.last_sweep = timestamp
+		elif (timestamp - self.last_sweep).total_seconds() >= CACHE_SWEEP_INTERVAL:
+			self.saveThrottledAircraft(timestamp)
+			self.evictIdleAircraft(timestamp)
+			self.last_sweep = timestamp
+
+	def saveThrottledAircraft(self, timestamp):
+		# the changes not yet saved of an aircraft that stopped transmitting in the air would wait for its idle eviction
+		for key, persisted_state in self.persisted_states.items():
+			if persisted_state[2] is not None and (timestamp - persisted_state[1]).total_seconds() >= self.pdo_engine.save_throttle:
+				self.pdo_engine.save_aircraft(persisted_state[2].asDict(), key[0])
+				self.counter_saves += 1
+				persisted_state[1] = timestamp
+				persisted_state[2] = None
+
+	def evictIdleAircraft(self, timestamp):
+		""" Evict the aircraft idle for the idle timeout, and the ones not in the air idle for the landed timeout.
+
+		The aircraft are scanned from the least recently seen and the scan stops at the first one seen
+		within the shortest timeout: the beacons are received about in order, an aircraft received late
+		is evicted by a later sweep.
+		"""
+		timeouts = [timeout for timeout in (self.landed_timeout, self.idle_timeout) if timeout]
+		if not timeouts:
+			return
+		for key, last_seen in list(self.aircraft_seen.items()):
+			if last_seen is None:
+				# loaded by the warm start and not seen since, its timeouts start now
+				self.aircraft_seen[key] = timestamp
+				self.aircraft_seen.move_to_end(key)
+				continue
+			idle = timestamp - last_seen
+			if idle < min(timeouts):
+				break
+			if self.idle_timeout and idle >= self.idle_timeout:
+				self.evictAircraft(key, 'idle')
+			elif self.landed_timeout and idle >= self.landed_timeout:
+				# after a landing the beacons on the ground start a new flight, the aircraft is not in the air if this flight did not take off
+				flights = self.logbook.get(key[0], {}).get(key[1])
+				if flights and flights[-1].status != 'air':
+					self.evictAircraft(key, 'landed')
+
+	def evictAircraft(self, key, reason):
+		""" Remove an aircraft from the logbook, after saving the changes of its flights not yet saved. """
+		date, aircraft_id = key
+		self.aircraft_seen.pop(key, None)
+		flights = self.logbook.get(date, {}).pop(aircraft_id, None)
+		if flights is None:
+			return
+		for flight in flights:
+			persisted_state = self.persisted_states.pop((date, aircraft_id, flight.flight_id), None)
+			if persisted_state is not None and persisted_state[2] is not None:
+				self.pdo_engine.save_aircraft(persisted_state[2].asDict(), date)
+				self.counter_saves += 1
+		if self.evicted_flights is not None:
+			self.evicted_flights.setdefault(date, {}).setdefault(aircraft_id, {}).update((flight.flight_id, flight) for flight in flights)
+		self.aircraft_evicted.add(key)
+		self.counter_evictions += 1
+		self.counters_evictions[reason] += 1
+		self.logger.debug('Aircraft {} evicted from the logbook of {} ({}), {} flights'.format(aircraft_id, date, reason, len(flights)))
+
+	def gauges(self):
+		return {
+			'aircraft': len(self.aircraft_seen),
+			'evictions_landed': self.counters_evictions['landed'],
+			'evictions_idle': self.counters_evictions['idle'],
+			'evictions_cap': self.counters_evictions['cap'],
+			'loads': self.counter_loads,
+			'reloads': self.counter_reloads,
+			'warm_started': self.counter_warm_started,
+			'loads_avoided': self.counter_loads_avoided,
+		}
+
+	def persistAircraft(self, lg_entry, date, timestamp):
+		key = (date, lg_entry.aircraft_id, lg_entry.flight_id)
+		state = persisted_state_of(lg_entry)
+		persisted_state = self.persisted_states.get(key)
+
+		if persisted_state is not None and persisted_state[0] == state and (timestamp - persisted_state[1]).total_seconds() < self.pdo_engine.save_throttle:
+			# only positions or receivers changed, save it later
+			persisted_state[2] = lg_entry
+			self.counter_saves_skipped += 1
+			return
+
+		# the persistence engines get the dict view of the entry
+		start = self.metrics.clock()
+		self.pdo_engine.save_aircraft(lg_entry.asDict(), date)
+		self.metrics.observe(STAGE_SAVE, start)
+		self.counter_saves += 1
+		if lg_entry.status == 'landed':
+			# final state, no more change expected for this flight
+			self.persisted_states.pop(key, None)
+		else:
+			self.persisted_states[key] = [state, timestamp, None]
+
+	def flush(self, forget = None):
+		# save the flights with changes not yet saved, and forget the flights matching the forget function
+		for key, persisted_state in list(self.persisted_states.items()):
+			if persisted_state[2] is not None:
+				self.pdo_engine.save_aircraft(persisted_state[2].asDict(), key[0])
+				self.counter_saves += 1
+				persisted_state[2] = None
+			if forget is not None and forget(key):
+				del self.persisted_states[key]
 
 
+	def roundBeaconValues(self, beacon):
+		beacon['altitude'] = round(beacon['altitude'])
+		beacon['ground_speed'] = round(beacon['ground_speed'])
+		if beacon.get('climb_rate') is not None:
+			beacon['climb_rate'] = round(beacon['climb_rate'],1) 
+
+	def handleTowPlanePosition(self, beacon, date = None):
+		# position of a tow plane whose flight is handled by another logbook (pipeline shard), only kept to detect the launch type of the gliders
+		if self.isAircraftBeacon(beacon) and self.filteringReceivers(beacon['receiver_name']) and self.filteringAircraft(beacon['address']):
+			self.roundBeaconValues(beacon)
+			self.updateBufferAicraftBeacons(None, beacon, self.findOgnAircraftById(beacon['address']))
+
 	def handleStateUnknow(self, lg_entry, beacon, nearest_airport, nearest_airport_distance, ognDevice):
 		# is_near_ground = self.near_ground(nearest_airport,beacon['altitude'])
 
-		# if nearest_airport is not None and is_near_ground and self.average_ground_speed(lg_entry['last_positions']) < GROUND_SPEED_THRESHOLD:
-		if nearest_airport is not None and self.average_ground_speed(lg_entry['last_positions']) < GROUND_SPEED_THRESHOLD:
+		# if nearest_airport is not None and is_near_ground and self.average_ground_speed(lg_entry.last_positions) < GROUND_SPEED_THRESHOLD:
+		if nearest_airport is not None and self.average_ground_speed(lg_entry.last_positions, self.takeoff_window) < GROUND_SPEED_THRESHOLD:
 			lg_entry.update({'status' : 'ground','status_last_airport': nearest_airport })
 		else:
 			lg_entry.update({'status' : 'air','status_last_airport': nearest_airport })
@@ -299,33 +561,14 @@ class FlightsLogBook:
 	def handleStateOnGround(self, lg_entry, beacon, nearest_airport, nearest_airport_distance, ognDevice):
 		# is_near_ground = self.near_ground(nearest_airport,beacon['altitude'])
 
-		# if nearest_airport is not None and is_near_ground and self.average_ground_speed(lg_entry['last_positions']) >= GROUND_SPEED_THRESHOLD:
-		if nearest_airport is not None and self.average_ground_speed(lg_entry['last_positions']) >= GROUND_SPEED_THRESHOLD:
+		# if nearest_airport is not None and is_near_ground and self.average_ground_speed(lg_entry.last_positions) >= GROUND_SPEED_THRESHOLD:
+		if nearest_airport is not None and self.average_ground_speed(lg_entry.last_positions, self.takeoff_window) >= GROUND_SPEED_THRESHOLD:
 			# takeoff detected
 			lg_entry.update({'takeoff_time': beacon['timestamp'], 'status' : 'air' , 'status_last_airport': nearest_airport , 'takeoff_airport': nearest_airport, 'takeoff_runway': self.detectRunway(beacon, nearest_airport) })
 
 	def detectRunway(self, beacon, airport):
-		# get all runways heading of the airport
-		rwy_directions = dict()
-		beacon_heading = int(beacon['track'])
-
-		# for each compute the angle between runway heading and beacon heading
-		rwy_reg = re.compile(r'([0-9]{2}).?\/.?([0-9]{2})')
-		for rwy in self.airports.get(airport).runways:
-			matches = rwy_reg.finditer(rwy.direction)
-			for match in matches:
-				rwy_directions.update({match.group(1): abs(self.angle_difference(int(match.group(1))*10, beacon_heading))})
-				rwy_directions.update({match.group(2): abs(self.angle_difference(int(match.group(2))*10, beacon_heading))})
-
-		# look for the runway with the min angle difference with beacon heading
-		runway =''
-		angle_diff_min = 9999
-		for key, value in rwy_directions.items():
-			if value < angle_diff_min:
-				angle_diff_min = value
-				runway = key
-
-		return runway
+		# runway with the min angle difference with beacon heading, precomputed by 10 degrees heading bins when loading the airports
+		return self.airports.get(airport).runway_table[runway_table_bin(int(beacon['track']))]
 
 	def detectRunway_old(self, beacon, airport):
 		two_digits_heading = round(int(beacon['track'])/10)
@@ -341,7 +584,7 @@ class FlightsLogBook:
 			self.detectLaunchType(lg_entry,beacon,ognDevice)
 
 		# transitions
-		if nearest_airport is not None and is_near_ground and self.average_ground_speed(lg_entry['last_positions']) < GROUND_SPEED_THRESHOLD:
+		if nearest_airport is not None and is_near_ground and self.average_ground_speed(lg_entry.last_positions, self.landing_window) < GROUND_SPEED_THRESHOLD:
 			# landing detected
 			# if takeoff have not been detected, cannot compute flight duration
 			if not lg_entry.get('takeoff_time') and not lg_entry.get('takeoff_airport'):
@@ -362,10 +605,10 @@ class FlightsLogBook:
 		nearest_airpot_icao = None
 		for airport in self.airports.values():
 			# distance_to_airport = distance.geodesic((latitude, longitude), (airport['lat'],airport['lon']), ellipsoid='WGS-84').km
-			distance_to_airport = distance.great_circle((latitude, longitude), (airport['lat'],airport['lon'])).km
+			distance_to_airport = haversine(latitude, longitude, airport.lat, airport.lon)
 			if (distance_to_airport < nearest_airport_distance and distance_to_airport <= distance_threshold):
 				nearest_airport_distance = distance_to_airport
-				nearest_airpot_icao = airport['icao']
+				nearest_airpot_icao = airport.icao
 
 		return nearest_airpot_icao, nearest_airport_distance, 
 	
@@ -382,16 +625,32 @@ class FlightsLogBook:
 		
 		return nearest_airpot_icao, nearest_airport_distance, 
 
+	def findNearestAirport_numpy(self, latitude, longitude, distance_threshold = AIRPORT_DISTANCE_THRESHOLD):
+		nearest_airpot_icao, nearest_airport_distance = self.airports_locator.get_nearest_airport(latitude, longitude, distance_threshold)
+		self.logger.debug('Nearest airport found within {}km is {}, distance is {}km'.format(distance_threshold, nearest_airpot_icao, round(nearest_airport_distance,3)))
+		return nearest_airpot_icao, nearest_airport_distance, 
+
+	def findNearestAirport_grid(self, latitude, longitude, distance_threshold = AIRPORT_DISTANCE_THRESHOLD):
+		nearest_airpot_icao, nearest_airport_distance = self.airports_locator.get_nearest_airport(latitude, longitude, distance_threshold)
+		self.logger.debug('Nearest airport found within {}km is {}, distance is {}km'.format(distance_threshold, nearest_airpot_icao, round(nearest_airport_distance,3)))
+		return nearest_airpot_icao, nearest_airport_distance, 
+
+	def findNearestAirports_numpy(self, coordinates, distance_threshold = AIRPORT_DISTANCE_THRESHOLD):
+		latitudes = [latitude for latitude, longitude in coordinates]
+		longitudes = [longitude for latitude, longitude in coordinates]
+		return self.airports_locator.get_nearest_airports(latitudes, longitudes, distance_threshold)
+
 	def near_coordinates(self, icao, latitude, longitude):
 		return True
 	
 	def near_ground(self, icao, altitude):
-		if altitude >= max(0,feet_to_meter(self.airports.get(icao).elevation)-ALTITUDE_THRESHOLD) and altitude <= feet_to_meter(self.airports.get(icao).elevation)+ALTITUDE_THRESHOLD:
-			return True
-		else:
-			return False
+		ground_band = self.airports_ground_band[icao]
+		return ground_band[0] <= altitude <= ground_band[1]
 
 	def updateBufferAicraftBeacons(self, lg_entry, beacon, ognDevice):
+		# only the tow planes positions are needed to detect the launch type of the gliders
+		if OGN_SENDER_TYPES[beacon['aircraft_type']] != 'tow_plane':
+			return
 		aircraft_id = beacon['address']
 
 		toSave={
@@ -406,11 +665,11 @@ class FlightsLogBook:
 			'longitude': beacon['longitude'],
 			'timestamp': beacon['timestamp']
 		}
-		self.buffer_aircraft_beacons.appendleft(toSave)
+		self.tow_planes.add(toSave)
 
 
 	def detectLaunchType(self, lg_entry, beacon, ognDevice):
-		if lg_entry['launch_type'] == '#unknown' and lg_entry['status'] == 'air':
+		if lg_entry.launch_type == '#unknown' and lg_entry.status == 'air':
 			switcher = {
 				'glider' : self.detectLaunchTypeForGlider,
 				'tow_plane' : 'autonome',
@@ -418,9 +677,11 @@ class FlightsLogBook:
 				'powered_aircraft' :'autonome',
 			}
 			result = switcher.get(OGN_SENDER_TYPES[beacon['aircraft_type']],'#unknown')
-			if isinstance(result, collections.Callable):
+			if callable(result):
+				start = self.metrics.clock()
 				result = result(lg_entry, beacon, ognDevice)
-			lg_entry['launch_type'] = result
+				self.metrics.observe(STAGE_LAUNCH_TYPE, start)
+			lg_entry.launch_type = result
 
 	# for glider detect launch type
 	def detectLaunchTypeForGlider(self, lg_entry, beacon, ognDevice, distance_threshold = 0.5):
@@ -428,51 +689,46 @@ class FlightsLogBook:
 
 		tow_plane = '#unknown'
 		# Try to detect tow plane:
-		# iterate over the last beacon positions received
-		# and look for the aircraft of type tow_plane with minimum distance from this glider 
-		for elem in self.buffer_aircraft_beacons:
-			if elem['aircraft_type'] == 'tow_plane':
-				dist = distance.great_circle((beacon['latitude'], beacon['longitude']), (elem['latitude'],elem['longitude'])).km
-				deltasec = (beacon['timestamp'] - elem['timestamp']).total_seconds()
-
+		# iterate over the tow planes positions of the last 10 seconds close to this glider, most recent first
+		# and look for the one flying with the glider
+		candidates = self.tow_planes.candidates(beacon['latitude'], beacon['longitude'], beacon['timestamp'])
+		for elem in candidates:
+			if self.inRangeHeading(beacon['track'], elem['track']) and self.inRangeSpeed(beacon['ground_speed'], elem['ground_speed']) and self.inRangeAltitude(beacon['altitude'], elem['altitude']):
+				dist = equirectangular(beacon['latitude'], beacon['longitude'], elem['latitude'], elem['longitude'])
 				# dist = distance.geodesic((beacon['latitude'], beacon['longitude']), (elem['latitude'],elem['longitude']), ellipsoid='WGS-84').km
-				self.logger.debug('distance with {aircraft_type} {imat} (altitude={altitude}, speed={ground_speed}km/h, heading={track}°, climb rate={climb_rate}m/s) is {distplane}km, {deltasec}s ago'.format(**elem,distplane = round(dist,2), imat= self.ogn_devices_db.getAircraftRegistrationById(elem['aircraft_id']), deltasec = deltasec))
-
-				if deltasec > 10:
-					self.logger.debug('No tow plane positions in the buffer that are less than 10 seconds old and which satisfy the conditions')
-					break
+				self.logger.debug('distance with {aircraft_type} {imat} (altitude={altitude}, speed={ground_speed}km/h, heading={track}°, climb rate={climb_rate}m/s) is {distplane}km, {deltasec}s ago'.format(**elem,distplane = round(dist,2), imat= self.ogn_devices_db.getAircraftRegistrationById(elem['aircraft_id']), deltasec = (beacon['timestamp'] - elem['timestamp']).total_seconds()))
 
-				if self.inRangeDistance(dist) and self.inRangeHeading(beacon['track'], elem['track']) and self.inRangeSpeed(beacon['ground_speed'], elem['ground_speed']) and self.inRangeAltitude(beacon['altitude'], elem['altitude']):
+				if self.inRangeDistance((beacon['latitude'], beacon['longitude']), (elem['latitude'], elem['longitude'])):
 					tow_plane = elem['registration']
 					self.logger.debug(
-						'Found the tow plane {} in the buffer (position {}/ max size {})'
+						'Found the tow plane {} in the index (position {}/ {} candidates)'
 						' --> parameters: altitude={}, speed={}km/h, heading={}°, climb rate={}m/s, dist to the glider {distplane}km'
-						.format(tow_plane, self.buffer_aircraft_beacons.index(elem), BUFFER_AIRCRAFT_BEACON,
+						.format(tow_plane, candidates.index(elem), len(candidates),
 						elem['altitude'],elem['ground_speed'],elem['track'],elem['climb_rate'],distplane = round(dist,2)))
 					break
 
 		# Try to detect winch tow launch
-		if tow_plane == '#unknown' and isinstance(lg_entry['takeoff_time'], datetime.datetime):
-			time_since_takeoff = (beacon['timestamp']-lg_entry['takeoff_time']).total_seconds()
+		if tow_plane == '#unknown' and isinstance(lg_entry.takeoff_time, datetime.datetime):
+			time_since_takeoff = (beacon['timestamp']-lg_entry.takeoff_time).total_seconds()
 			if time_since_takeoff > 60:
 				self.logger.debug('take-off more than 60 seconds ago, stop to try to detect winch tow lauch for {}'.format(self.ogn_devices_db.getAircraftRegistrationById(beacon['address'])))
-			elif self.average_climb_rate(lg_entry['last_positions'],5) >= WINCH_CLIMB_RATE_THRESHOLD:
+			elif self.average_climb_rate(lg_entry.last_positions, self.winch_window) >= WINCH_CLIMB_RATE_THRESHOLD:
 				self.logger.debug('winch tow detected for {} {} seconds after takeoff'.format(self.ogn_devices_db.getAircraftRegistrationById(beacon['address']), time_since_takeoff))
 				tow_plane = 'winch'
 
 		# If launch type still undefined 
 		if tow_plane == '#unknown':
 			# default to autonome if takeoff time has been detected more than 3 minutes ago
-			if lg_entry['takeoff_time']:
-				if (beacon['timestamp']-lg_entry['takeoff_time']).total_seconds() > 180:
-					self.logger.debug('takeoff time has been detected {} secondes ago, default launch type to autonome for {}'.format((beacon['timestamp']-lg_entry['takeoff_time']).total_seconds(), 
+			if lg_entry.takeoff_time:
+				if (beacon['timestamp']-lg_entry.takeoff_time).total_seconds() > 180:
+					self.logger.debug('takeoff time has been detected {} secondes ago, default launch type to autonome for {}'.format((beacon['timestamp']-lg_entry.takeoff_time).total_seconds(), 
 						self.ogn_devices_db.getAircraftRegistrationById(beacon['address']) ))
 					tow_plane = 'autonome'
 
 		return tow_plane
 
-	def inRangeDistance(self, dist, distance_precision = 0.4):
-		return True if dist <=  distance_precision else False
+	def inRangeDistance(self, p1, p2, distance_precision = 0.4):
+		return within_distance(p1[0], p1[1], p2[0], p2[1], distance_precision)
 
 	def angle_difference(self, heading_1, heading_2):
 		angle_diff = (heading_1 - heading_2) % 360
@@ -492,17 +748,9 @@ class FlightsLogBook:
 	def inRangeAltitude(self, glider_altitude, beacon_altitude, altitude_precision= 35):
 		return True if abs(glider_altitude-beacon_altitude) <=  altitude_precision else False
 	
+	# O(1) for the windows of positions_windows
 	def average_ground_speed(self, last_positions, n=3):
-		last_ground_speeds = [ elem['ground_speed'] for elem in last_positions]
-		if len(last_ground_speeds)<=0:
-			return 0
-		else:
-			return sum(itertools.islice(last_ground_speeds, min(n, len(last_ground_speeds))))/min(n,len(last_ground_speeds))
+		return last_positions.average('ground_speed', n)
 
 	def average_climb_rate(self, last_positions, n=3):
-		last_climb_rates = [ elem['climb_rate'] for elem in last_positions]
-		if len(last_climb_rates)<=0:
-			return 0
-		else:
-			return sum(itertools.islice(last_climb_rates, min(n, len(last_climb_rates))))/min(n,len(last_climb_rates))
-
+		return last_positions.average('climb_rate', n)
@@ -1,31 +1,80 @@
 from __future__ import annotations
 from abc import ABC, abstractmethod
 
+import time
 import logging
 import json
 import datetime
+import threading
+import collections
 import mysql.connector
 
 from mysql.connector import errorcode
 from acph.setup_db import TABLES_NAME
+from acph.class_mysql_pool import MysqlConnectionPool, MYSQL_POOL_SIZE, MYSQL_POOL_CHECK_INTERVAL, MYSQL_CONNECT_TIMEOUT, MYSQL_RECONNECT_DELAY
 
 from datetime import date
 from datetime import timedelta
 
-from collections import deque
-from acph.class_flights_logbook import BUFFER_AIRCRAFT_POSITION
+# positional parameters to be used by a prepared statement, the update clause refers to the inserted values,
+# without any parameter, so that executemany can send one multi-row insert
+MYSQL_UPSERT_QUERY = ("INSERT INTO `{tablename}` "
+	 "(`date`, `aircraft_id`, `flight_id`, `status`, `status_last_airport`, `aircraft_type`, `aircraft_model`, `registration`, `cn`, `tracked`, `identified`, `takeoff_time`, `takeoff_airport`, `landing_time`, `landing_airport`, `flight_duration`, `launch_type`, `receivers`, `last_positions`, `takeoff_runway`, `landing_runway`)"
+	 " VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+	 " ON DUPLICATE KEY UPDATE "
+	 "`status` = VALUES(`status`), "
+	 "`status_last_airport` = VALUES(`status_last_airport`), "
+	 "`aircraft_type` = VALUES(`aircraft_type`), "
+	 "`aircraft_model` = VALUES(`aircraft_model`), "
+	 "`registration` = VALUES(`registration`), "
+	 "`cn` = VALUES(`cn`), "
+	 "`tracked` = VALUES(`tracked`), "
+	 "`identified` = VALUES(`identified`), "
+	 "`takeoff_time` = VALUES(`takeoff_time`), "
+	 "`takeoff_airport` = VALUES(`takeoff_airport`), "
+	 "`landing_time` = VALUES(`landing_time`), "
+	 "`landing_airport` = VALUES(`landing_airport`), "
+	 "`flight_duration` = VALUES(`flight_duration`), "
+	 "`launch_type` = VALUES(`launch_type`), "
+	 "`receivers` = VALUES(`receivers`), "
+	 "`last_positions` = VALUES(`last_positions`), "
+	 "`takeoff_runway` = VALUES(`takeoff_runway`), "
+	 "`landing_runway` = VALUES(`landing_runway`)"
+	 ).format(tablename=TABLES_NAME['logbook-by-aircraft'])
+
+MYSQL_LOAD_AIRCRAFT_QUERY = "SELECT * FROM `{tablename}` WHERE date = %s and aircraft_id = %s".format(tablename=TABLES_NAME['logbook-by-aircraft'])
+MYSQL_LOAD_DAY_QUERY = "SELECT * FROM `{tablename}` WHERE date = %s ORDER BY aircraft_id, flight_id".format(tablename=TABLES_NAME['logbook-by-aircraft'])
+MYSQL_LOAD_DAY_BATCH = 500			# rows fetched at once when loading all the flights of a day
+MYSQL_PURGE_QUERY = "DELETE FROM `{tablename}` WHERE date < %s".format(tablename=TABLES_NAME['logbook-by-aircraft'])
+
+# write-behind engine default settings
+WRITE_BEHIND_BATCH_SIZE = 50			# flush as soon as n logbook entries are pending
+WRITE_BEHIND_FLUSH_INTERVAL = 5			# flush pending logbook entries at least every n seconds
+WRITE_BEHIND_MAX_QUEUE_SIZE = 1000		# max number of pending logbook entries, save_aircraft blocks beyond it
+WRITE_BEHIND_MAX_BLOCK = 1				# max number of seconds save_aircraft blocks on a full queue, the logbook entry is dropped beyond it
+WRITE_BEHIND_LOG_INTERVAL = 100			# log the write-behind counters every n flushes
+
+JSON_FILE_PATH = './db/acph-logbook-{}-{}.json'		# JSON engine, file of the last flight of an aircraft for a date
+JSON_TIME_FIELDS = ('takeoff_time', 'landing_time')		# JSON engine, fields saved as strings and loaded as datetime
 
 class FlightLogPDO(ABC):
-	def __init__(self):
+	# min number of seconds between 2 saves of a flight when only its positions or receivers changed
+	DEFAULT_SAVE_THROTTLE = 30
+
+	def __init__(self, settings = None):
 		self.logger = logging.getLogger(__name__)
 		self.logger.debug("Persistence Engine is of type {}".format(self.__class__.__name__))
+		self.settings = settings if settings is not None else {}
+		self.save_throttle = float(self.settings.get('save_throttle', self.DEFAULT_SAVE_THROTTLE))
 
 	@staticmethod
-	def factory(target) -> FlightLogPDO:
+	def factory(target, settings = None) -> FlightLogPDO:
 		if target.upper() == 'JSON':
-			return JsonFileFlightLogPDO()
+			return JsonFileFlightLogPDO(settings)
 		elif target.upper() == 'MYSQL':
-			return MysqlFlightLogPDO()
+			return MysqlFlightLogPDO(settings)
+		elif target.upper() == 'MYSQL-WRITE-BEHIND':
+			return MysqlWriteBehindFlightLogPDO(settings)
 		else:
 			raise ValueError('{} is an invalid value for the FlightLogPDO factory method.'.format(target))
 
@@ -41,6 +90,13 @@ class FlightLogPDO(ABC):
 
 		return []
 
+	def load_day(self, date :str):
+		""" Rows of all the flights of a day, by aircraft and flight. An error of the engine is raised, the rows may be incomplete. """
+		if date is None:
+			raise ValueError('Cannot load logbook for a null date.')
+
+		return []
+
 	def open(self, config) -> None:
 		self.logger.warning('Open persistence engine of type {}.'.format(self.__class__.__name__))
 		pass
@@ -58,147 +114,132 @@ class FlightLogPDO(ABC):
 			return obj.__str__()
 
 class MysqlFlightLogPDO(FlightLogPDO):
-	def __init__(self):
-		super().__init__()
-		self.cnx = None
-
-	# Inspiration here: https://bitworks.software/en/2019-03-12-tornado-persistent-mysql-connection-strategy.html
-	def get_cursor(self, dictionary=False):
-		try:
-			self.cnx.ping(reconnect=True, attempts=3, delay=5)
-		except mysql.connector.Error as err:
-			self.logger.warning("Connection with MySql DB probably loose following the session time-out, try to reconnect. Error is {}".format(err))
-			self.open(False)
-		return self.cnx.cursor(dictionary=dictionary)
+	def __init__(self, settings = None):
+		super().__init__(settings)
+		self.pool = None
 
 	def purge(self, data_older_than :int = 30) -> None:
 		super().purge(data_older_than)
 
 		# delete from `acph_aircraft_logbook` where date < '2020-08-14'
 		try:
-			cursor = self.get_cursor()
-
-			# compute the purge date 
-			purge_date = date.today() - timedelta(days=data_older_than)
-
-			# and execute the query
-			query = "delete from `{tablename}` where date < '{purge_date}'".format(tablename=TABLES_NAME['logbook-by-aircraft'], purge_date=purge_date)
-			cursor.execute(query)
-			self.cnx.commit()
-			self.logger.warning('Purge data created before {}, {} records deleted (purge setting={} retention day(s)).'.format(purge_date, cursor.rowcount,data_older_than))
+			with self.pool.connection() as connection:
+				# compute the purge date 
+				purge_date = date.today() - timedelta(days=data_older_than)
+
+				# and execute the query
+				cursor = connection.cursor()
+				try:
+					cursor.execute(MYSQL_PURGE_QUERY, (purge_date,))
+					connection.commit()
+					self.logger.warning('Purge data created before {}, {} records deleted (purge setting={} retention day(s)).'.format(purge_date, cursor.rowcount,data_older_than))
+				finally:
+					cursor.close()
 		except mysql.connector.Error as err:
 			self.logger.error('Unable to purge logbook entries.')
 			self.logger.error(err)
-		finally:
-			cursor.close()
-
 
 	def save_aircraft(self, logbook: dict, date :str) -> None:
 		super().save_aircraft(logbook, date)
 		try:
-			cursor = self.get_cursor()
-
-			query = ("INSERT INTO `{tablename}` "
-				 "(`date`, `aircraft_id`, `flight_id`, `status`, `status_last_airport`, `aircraft_type`, `aircraft_model`, `registration`, `cn`, `tracked`, `identified`, `takeoff_time`, `takeoff_airport`, `landing_time`, `landing_airport`, `flight_duration`, `launch_type`, `receivers`, `last_positions`, `takeoff_runway`, `landing_runway`)"
-				 " VALUES (%(date)s, %(aircraft_id)s, %(flight_id)s, %(status)s, %(status_last_airport)s, %(aircraft_type)s, %(aircraft_model)s, %(registration)s, %(cn)s, %(tracked)s, %(identified)s, %(takeoff_time)s, %(takeoff_airport)s, %(landing_time)s, %(landing_airport)s, %(flight_duration)s, %(launch_type)s, %(receivers)s, %(last_positions)s, %(takeoff_runway)s, %(landing_runway)s)"
-				 " ON DUPLICATE KEY UPDATE "
-				 "`status` = %(status)s, "
-				 "`status_last_airport` = %(status_last_airport)s, "
-				 "`aircraft_type` = %(aircraft_type)s, "
-				 "`aircraft_model` = %(aircraft_model)s, "
-				 "`registration` = %(registration)s, "
-				 "`cn` = %(cn)s, "
-				 "`tracked` = %(tracked)s, "
-				 "`identified` = %(identified)s, "
-				 "`takeoff_time` = %(takeoff_time)s, "
-				 "`takeoff_airport` = %(takeoff_airport)s, "
-				 "`landing_time` = %(landing_time)s, "
-				 "`landing_airport` = %(landing_airport)s, "
-				 "`flight_duration` = %(flight_duration)s, "
-				 "`launch_type` = %(launch_type)s, "
-				 "`receivers` = %(receivers)s, "
-				 "`last_positions` = %(last_positions)s, "
-				 "`takeoff_runway` = %(takeoff_runway)s, "
-				 "`landing_runway` = %(landing_runway)s"
-				 ).format(tablename=TABLES_NAME['logbook-by-aircraft'])
-
-			query_data = {
-				'date': date,
-				'aircraft_id': logbook['aircraft_id'],
-				'flight_id': logbook['flight_id'],
-				'status': logbook['status'],
-				'status_last_airport': logbook['status_last_airport'],
-				'aircraft_type': logbook['aircraft_type'],
-				'aircraft_model': logbook['aircraft_model'],
-				'registration': logbook['registration'],
-				'cn': '' if logbook['cn'] =='#unknown' else logbook['cn'],
-				'tracked': logbook['tracked'],
-				'identified': logbook['identified'],
-				'takeoff_time': logbook['takeoff_time'] if logbook['takeoff_time'] else None,
-				'takeoff_airport': logbook['takeoff_airport'],
-				'landing_time': logbook['landing_time'] if logbook['landing_time'] else None,
-				'landing_airport': logbook['landing_airport'],
-				'flight_duration': logbook['flight_duration'],
-				'launch_type': logbook['launch_type'],
-				'receivers': ','.join(logbook['receivers']),
-				'last_positions' : json.dumps(list(logbook['last_positions'])),
-				'takeoff_runway' : logbook['takeoff_runway'],
-				'landing_runway' : logbook['landing_runway']
-			}
-			cursor.execute(query, query_data)
-			self.cnx.commit()
+			with self.pool.connection() as connection:
+				connection.prepared(MYSQL_UPSERT_QUERY).execute(MYSQL_UPSERT_QUERY, self.upsert_parameters(logbook, date))
+				connection.commit()
 		except mysql.connector.Error as err:
 			self.logger.error('Unable to persist logbook entry {} for the date {}'.format(logbook, date))
 			self.logger.error(err)
-		finally:
-			cursor.close()
+
+	def upsert_parameters(self, logbook: dict, date :str) -> tuple:
+		return (
+			date,
+			logbook['aircraft_id'],
+			logbook['flight_id'],
+			logbook['status'],
+			logbook['status_last_airport'],
+			logbook['aircraft_type'],
+			logbook['aircraft_model'],
+			logbook['registration'],
+			'' if logbook['cn'] =='#unknown' else logbook['cn'],
+			logbook['tracked'],
+			logbook['identified'],
+			logbook['takeoff_time'] if logbook['takeoff_time'] else None,
+			logbook['takeoff_airport'],
+			logbook['landing_time'] if logbook['landing_time'] else None,
+			logbook['landing_airport'],
+			logbook['flight_duration'],
+			logbook['launch_type'],
+			','.join(logbook['receivers']),
+			json.dumps(list(logbook['last_positions'])),
+			logbook['takeoff_runway'],
+			logbook['landing_runway']
+		)
 
 	def load_aircraft(self, date :str, aircraft_id :str) -> list:
 		result = super().load_aircraft(date, aircraft_id)
 		try:
-			cursor = self.get_cursor(True)
-			# query = "SELECT * FROM {} WHERE date = '{}' and aircraft_id = '{}' and status != 'landed'".format(TABLES_NAME['logbook-by-aircraft'], date, aircraft_id)
-			query = "SELECT * FROM {} WHERE date = '{}' and aircraft_id = '{}'".format(TABLES_NAME['logbook-by-aircraft'], date, aircraft_id)
-			cursor.execute(query)
-			for row in cursor:
-				# transform string to deque for last_positions property
-				row['last_positions'] = deque(json.loads(row['last_positions']), maxlen=BUFFER_AIRCRAFT_POSITION)
-
-				# transform string to list for receivers property
-				row['receivers'] = row['receivers'].split(',')
-
-				result.append(row)
-			self.cnx.commit()
+			with self.pool.connection() as connection:
+				cursor = connection.prepared(MYSQL_LOAD_AIRCRAFT_QUERY)
+				cursor.execute(MYSQL_LOAD_AIRCRAFT_QUERY, (date, aircraft_id))
+				for values in cursor.fetchall():
+					result.append(self.row_to_logbook(cursor.column_names, values))
+				connection.commit()
 		except mysql.connector.Error as err:
 			self.logger.error('Unable to load logbook entries for aircraft id {} on date {}'.format(aircraft_id,date))
 			self.logger.error(err)
-		finally:
-			cursor.close()
 		return result
 
+	def load_day(self, date :str):
+		# a single query, the rows are streamed by batches instead of being all held by the cursor
+		super().load_day(date)
+		with self.pool.connection() as connection:
+			cursor = connection.prepared(MYSQL_LOAD_DAY_QUERY)
+			cursor.execute(MYSQL_LOAD_DAY_QUERY, (date,))
+			while True:
+				rows = cursor.fetchmany(MYSQL_LOAD_DAY_BATCH)
+				if not rows:
+					break
+				for values in rows:
+					yield self.row_to_logbook(cursor.column_names, values)
+			connection.commit()
+
+	def row_to_logbook(self, column_names, values) -> dict:
+		row = dict(zip(column_names, values))
+
+		# transform string to list for last_positions property, the logbook keeps as many of them as its positions buffer holds
+		row['last_positions'] = json.loads(row['last_positions']) if row['last_positions'] else []
+
+		# transform string to list for receivers property
+		row['receivers'] = row['receivers'].split(',')
+		return row
+
 	def isTablesExists(self):
 		try:
-			cursor = self.cnx.cursor()
-			# query = "SELECT count(*) FROM information_schema.TABLES WHERE (TABLE_SCHEMA = 'wpDB') AND (TABLE_NAME = 'acph_logbook')"
-			query = "SHOW TABLES LIKE '{}'".format(TABLES_NAME['logbook-by-aircraft'])
-			cursor.execute(query)
-			row = cursor.fetchone()
-			if row is not None:
-				return True
-			else:
-				return False
+			with self.pool.connection() as connection:
+				cursor = connection.cursor()
+				try:
+					# query = "SELECT count(*) FROM information_schema.TABLES WHERE (TABLE_SCHEMA = 'wpDB') AND (TABLE_NAME = 'acph_logbook')"
+					cursor.execute("SHOW TABLES LIKE %s", (TABLES_NAME['logbook-by-aircraft'],))
+					row = cursor.fetchone()
+				finally:
+					cursor.close()
+			return row is not None
 		except mysql.connector.Error as err:
 			self.logger.critical('Unable to verify if required tables are existing.' )
 			self.logger.critical(err)
 			raise(SystemExit)
-		finally:
-			cursor.close()
 
 	def open(self, config, checkTablesExisting = True) -> None:
 		super().open(config)
 		try:
-			# self.cnx = mysql.connector.connect(option_files=config_file, option_groups='mysql_connector_python')
-			self.cnx = mysql.connector.connect(user=config['user'], password=config['password'], database=config['database'], host=config['host'])
+			self.pool = MysqlConnectionPool(config,
+				size=int(self.settings.get('pool_size', MYSQL_POOL_SIZE)),
+				check_interval=float(self.settings.get('pool_check_interval', MYSQL_POOL_CHECK_INTERVAL)),
+				connect_timeout=int(self.settings.get('connect_timeout', MYSQL_CONNECT_TIMEOUT)),
+				reconnect_delay=float(self.settings.get('reconnect_delay', MYSQL_RECONNECT_DELAY)))
+
+			# open a first connection, the engine can not start without the DB
+			with self.pool.connection():
+				pass
 			if checkTablesExisting and not self.isTablesExists():
 				self.logger.critical('Required tables doesn\'t exists.')
 				raise(SystemExit(1))
@@ -208,24 +249,261 @@ class MysqlFlightLogPDO(FlightLogPDO):
 
 	def close(self) -> None:
 		super().close()
-		if self.cnx is not None:
+		if self.pool is not None:
 			try:
-				self.cnx.close()
+				self.pool.close()
 			except mysql.connector.Error as err:
 				self.logger.critical('Exception while closing the MySql connection: {}'.format(err))
 			finally:
-				self.cnx = None
+				self.pool = None
+
+class MysqlWriteBehindFlightLogPDO(MysqlFlightLogPDO):
+	""" MySQL persistence engine writing logbook entries in the background.
+
+	save_aircraft only queues the entry, pending entries are coalesced by
+	(date, aircraft_id, flight_id) so only the latest state of a flight is
+	written, and a writer thread flushes them in one transaction with
+	executemany when `batch_size` entries are pending or every
+	`flush_interval` seconds. After a failed flush the entries are kept and
+	retried after `flush_interval` seconds, or when the pool tries to connect
+	again. The queue is bounded to `max_queue_size` entries, save_aircraft
+	blocks at most `max_block` seconds when it is full and drops the entry
+	beyond it, or at once while the DB is failing, so that the reader of the
+	APRS feed is never stalled by the DB. close() drains the queue. The
+	writer thread borrows its own connection of the pool.
+	"""
+
+	# saves are coalesced in the queue, they can be more frequent
+	DEFAULT_SAVE_THROTTLE = 10
+
+	def __init__(self, settings = None):
+		super().__init__(settings)
+		self.batch_size = int(self.settings.get('batch_size', WRITE_BEHIND_BATCH_SIZE))
+		self.flush_interval = float(self.settings.get('flush_interval', WRITE_BEHIND_FLUSH_INTERVAL))
+		self.max_queue_size = int(self.settings.get('max_queue_size', WRITE_BEHIND_MAX_QUEUE_SIZE))
+		self.max_block = float(self.settings.get('max_block', WRITE_BEHIND_MAX_BLOCK))
+
+		self.pending = collections.OrderedDict()
+		self.pending_since = None
+		self.retry_at = 0						# no flush before, after a failed one
+		self.condition = threading.Condition()
+		self.flush_lock = threading.Lock()			# one batch written at a time, the states of a flight are committed in order
+		self.writer = None
+		self.closing = False
+
+		self.counter_saves = 0
+		self.counter_coalesced = 0
+		self.counter_blocked = 0
+		self.counter_dropped = 0
+		self.counter_flushes = 0
+		self.counter_rows_written = 0
+		self.counter_flush_errors = 0
+		self.flush_latency_last = 0
+		self.flush_latency_max = 0
+		self.flush_latency_total = 0
+
+	def open(self, config, checkTablesExisting = True) -> None:
+		super().open(config, checkTablesExisting)
+
+		if self.writer is None:
+			self.closing = False
+			self.writer = threading.Thread(target=self.__run, name='acph-write-behind', daemon=True)
+			self.writer.start()
+			self.logger.warning('Write-behind started (batch size={}, flush interval={}s, max queue size={}).'.format(self.batch_size, self.flush_interval, self.max_queue_size))
+
+	def close(self) -> None:
+		if self.writer is not None:
+			# the writer thread flushes all the pending entries before exiting
+			with self.condition:
+				self.closing = True
+				self.condition.notify_all()
+			self.writer.join()
+			self.writer = None
+			self.logStatistics()
+
+		super().close()
+
+	def save_aircraft(self, logbook: dict, date :str) -> None:
+		if self.writer is None:
+			# not opened or already closed, write it synchronously
+			super().save_aircraft(logbook, date)
+			return
+
+		FlightLogPDO.save_aircraft(self, logbook, date)
+		parameters = self.upsert_parameters(logbook, date)
+		key = (date, logbook['aircraft_id'], logbook['flight_id'])
+
+		with self.condition:
+			self.counter_saves += 1
+			if key in self.pending:
+				self.counter_coalesced += 1
+			else:
+				deadline = time.monotonic() + self.max_block
+				while len(self.pending) >= self.max_queue_size and not self.closing:
+					# the queue does not shrink while the DB is failing, do not wait for it
+					now = time.monotonic()
+					if now >= deadline or now < self.retry_at:
+						self.counter_dropped += 1
+						if self.counter_dropped % WRITE_BEHIND_LOG_INTERVAL == 1:
+							self.logger.error('Write-behind queue full ({} entries), {} logbook entries dropped, a flight is saved again with its next change.'.format(len(self.pending), self.counter_dropped))
+						return
+					self.counter_blocked += 1
+					self.condition.notify_all()
+					self.condition.wait(deadline - now)
+				if not self.pending:
+					self.pending_since = time.monotonic()
+			self.pending[key] = (key, parameters)
+
+			if len(self.pending) >= self.batch_size:
+				self.condition.notify_all()
+
+	def load_aircraft(self, date :str, aircraft_id :str) -> list:
+		# entries of this aircraft still in the queue, or in the batch the writer thread is writing, have to be committed before reading them back
+		with self.flush_lock:
+			with self.condition:
+				has_pending = any(key[0] == date and key[1] == aircraft_id for key in self.pending)
+			if has_pending:
+				self.__flushPending()
+
+		return super().load_aircraft(date, aircraft_id)
+
+	def load_day(self, date :str):
+		# all the pending entries have to be committed before reading the day back
+		if not self.flush():
+			raise mysql.connector.Error('Unable to write the pending logbook entries before loading the day {}'.format(date))
+		return super().load_day(date)
+
+	def queue_depth(self) -> int:
+		return len(self.pending)
+
+	def flush(self) -> bool:
+		# waits for the batch the writer thread may be writing
+		with self.flush_lock:
+			return self.__flushPending()
+
+	def __flushPending(self):
+		# the caller holds flush_lock, a batch is only taken from the queue with it
+		with self.condition:
+			batch = self.__takeBatch()
+		return self.__flush(batch) if batch else True
+
+	def __takeBatch(self):
+		batch = list(self.pending.values())
+		self.pending.clear()
+		self.pending_since = None
+		self.condition.notify_all()
+		return batch
+
+	def __run(self):
+		while True:
+			with self.condition:
+				while not self.closing:
+					now = time.monotonic()
+					if now < self.retry_at:
+						# wait after a failed flush instead of failing again at once
+						self.condition.wait(self.retry_at - now)
+						continue
+					if len(self.pending) >= self.batch_size:
+						break
+					if self.pending_since is None:
+						self.condition.wait()
+					else:
+						remaining = self.pending_since + self.flush_interval - now
+						if remaining <= 0:
+							break
+						self.condition.wait(remaining)
+
+				if self.closing and not self.pending:
+					return
+
+			with self.flush_lock:
+				if not self.__flushPending() and self.closing:
+					with self.condition:
+						self.logger.critical('Unable to drain the write-behind queue while closing, {} logbook entries lost.'.format(len(self.pending)))
+						self.__takeBatch()
+					return
+
+	def __flush(self, batch):
+		start_time = time.perf_counter()
+		try:
+			with self.pool.connection() as connection:
+				cursor = connection.cursor()
+				try:
+					cursor.executemany(MYSQL_UPSERT_QUERY, [parameters for key, parameters in batch])
+					connection.commit()
+				finally:
+					cursor.close()
+			self.counter_rows_written += len(batch)
+			success = True
+		except Exception as err:
+			success = False
+			self.counter_flush_errors += 1
+			self.logger.error('Unable to persist {} logbook entries, they will be retried with the next flush.'.format(len(batch)))
+			self.logger.error(err)
+
+			# put them back in the queue, unless a newer state of the same flight has been queued meanwhile
+			with self.condition:
+				for item in batch:
+					self.pending.setdefault(item[0], item)
+				now = time.monotonic()
+				if self.pending_since is None:
+					self.pending_since = now
+				# next try with the next flush, or with the next connection attempt of the pool
+				self.retry_at = max(now + self.flush_interval, self.pool.unavailable_until)
+
+		latency = time.perf_counter() - start_time
+		self.counter_flushes += 1
+		self.flush_latency_last = latency
+		self.flush_latency_max = max(self.flush_latency_max, latency)
+		self.flush_latency_total += latency
+		if self.counter_flushes % WRITE_BEHIND_LOG_INTERVAL == 0:
+			self.logStatistics()
+		return success
+
+	def logStatistics(self):
+		self.logger.info('Write-behind, queue depth {}, {} saves ({} coalesced, {} blocked, {} dropped), {} rows written in {} flushes ({} errors), flush latency last={}ms avg={}ms max={}ms'.format(
+			self.queue_depth(), self.counter_saves, self.counter_coalesced, self.counter_blocked, self.counter_dropped, self.counter_rows_written, self.counter_flushes, self.counter_flush_errors,
+			round(self.flush_latency_last * 1000, 1), round(self.flush_latency_total * 1000 / self.counter_flushes, 1) if self.counter_flushes else 0, round(self.flush_latency_max * 1000, 1)))
 
 class JsonFileFlightLogPDO(FlightLogPDO):
+	# JSON files are used for tests, they keep each and every state of the flights
+	DEFAULT_SAVE_THROTTLE = 0
+
+	def __init__(self, settings = None):
+		super().__init__(settings)
+		# only the files written by this engine are loaded back (aircraft evicted from the logbook), a replay does not depend on the files of a previous one
+		self.saved = set()
 
 	def save_aircraft(self, logbook: dict, date :str ) -> None:
 		super().save_aircraft(logbook, date)
+		self.saved.add((date, logbook['aircraft_id']))
 
 		# Log the result to output file
-		with open('./db/acph-logbook-{}-{}.json'.format(date, logbook['aircraft_id']), 'w') as fp:
+		with open(JSON_FILE_PATH.format(date, logbook['aircraft_id']), 'w') as fp:
 			fp.seek(0)
 			# json.dump(logbook.aircrafts_logbook, fp, indent=4, sort_keys=True, default = lambda obj: obj.__str__() if isinstance(obj, datetime.datetime) )
 			json.dump({'data': logbook}, fp, indent=4, sort_keys=True, default = self.json_converter )
 
+	def load_aircraft(self, date :str, aircraft_id :str) -> list:
+		# only the last flight of the aircraft is kept in its file
+		result = super().load_aircraft(date, aircraft_id)
+		if (date, aircraft_id) not in self.saved:
+			return result
+		try:
+			with open(JSON_FILE_PATH.format(date, aircraft_id), 'r') as fp:
+				row = json.load(fp)['data']
+		except FileNotFoundError:
+			return result
+		except (ValueError, KeyError) as err:
+			self.logger.error('Unable to load logbook entries for aircraft id {} on date {}: {}'.format(aircraft_id, date, err))
+			return result
+
+		for field in JSON_TIME_FIELDS:
+			if row.get(field):
+				row[field] = datetime.datetime.fromisoformat(row[field])
+		result.append(row)
+		return result
 
-
+	def load_day(self, date :str):
+		super().load_day(date)
+		return [row for saved_date, aircraft_id in sorted(self.saved) if saved_date == date for row in self.load_aircraft(date, aircraft_id)]
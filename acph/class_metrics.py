@@ -0,0 +1,287 @@
+#  This module contains the instrumentation of the beacon processing: duration histograms of its stages, counters
+#  of the beacons and of the flights state transitions, exposed in the Prometheus text format on a local HTTP
+#  endpoint and logged periodically.
+
+import math
+import time
+import bisect
+import logging
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+METRICS_HOST = '127.0.0.1'			# the endpoint is only reachable from the host by default
+METRICS_PORT = 9108					# port of the endpoint, no endpoint if empty
+METRICS_LOG_INTERVAL = 300			# log the metrics every n seconds, 0 to never log them
+METRICS_BUCKETS = (1e-06, 2.5e-06, 5e-06, 1e-05, 2.5e-05, 5e-05, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 1.0)	# seconds, upper bounds of the histograms buckets
+
+# stages of the beacon processing
+STAGE_PREFILTER = 'prefilter'
+STAGE_PARSE = 'parse'
+STAGE_HANDLE = 'handle'						# whole handling of a parsed beacon
+STAGE_OGN_LOOKUP = 'ogn_lookup'
+STAGE_NEAREST_AIRPORT = 'nearest_airport'
+STAGE_STATE_MACHINE = 'state_machine'
+STAGE_LAUNCH_TYPE = 'launch_type'
+STAGE_SAVE = 'save'
+
+# counters: name -> (help, label names)
+COUNTERS = {
+	'beacons': ('Parsed beacons by APRS and beacon type.', ('aprs_type', 'beacon_type')),
+	'state_transitions': ('Flights state transitions.', ('from', 'to')),
+}
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def escape_label(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class DisabledMetrics:
+
+	""" Metrics of a logbook without instrumentation, every method does nothing.
+
+	The instrumented code calls `clock` before a stage and `observe` after
+	it, on the metrics object of the logbook: with this class each stage only
+	costs these two calls.
+	"""
+
+	enabled = False
+
+	def clock(self):
+		return 0
+
+	def observe(self, stage, start):
+		pass
+
+	def count(self, name, *labels):
+		pass
+
+	def addGauges(self, prefix, gauges):
+		pass
+
+	def snapshot(self):
+		return None
+
+	def addShard(self, shard, snapshot):
+		pass
+
+	def start(self):
+		pass
+
+	def stop(self):
+		pass
+
+	def summary(self):
+		return []
+
+	def logStatistics(self):
+		pass
+
+NO_METRICS = DisabledMetrics()
+
+class AcphMetrics(DisabledMetrics):
+
+	""" Stage durations and counters of the beacon processing.
+
+	A stage duration is added to a histogram of fixed buckets (a bisect and
+	two additions), a counter is a dict entry per label values. `start` opens
+	the HTTP endpoint serving them in the Prometheus text format on
+	http://host:port/metrics, with the gauges of the objects registered by
+	`addGauges` (the APRS client), and a thread logging them every
+	`log_interval` seconds. The values are written by the logbook thread and
+	read by the endpoint without lock: a scrape may see a stage updated by a
+	beacon and not the next one. The logbook shards of the multi-process
+	pipeline send their `snapshot` to the main process, `addShard` keeps the
+	last one of each shard, they are added to the values of the process.
+
+	Parameters
+	----------
+	host : str, optional
+		Address the endpoint listens on.
+	port : int, optional
+		Port of the endpoint, no endpoint if None.
+	log_interval : float, optional
+		Seconds between 2 logs of the metrics, never logged if 0.
+	buckets : tuple of float, optional
+		Upper bounds of the histograms buckets in seconds, sorted.
+	"""
+
+	enabled = True
+
+	def __init__(self, host=METRICS_HOST, port=METRICS_PORT, log_interval=METRICS_LOG_INTERVAL, buckets=METRICS_BUCKETS):
+		self.logger = logging.getLogger(__name__)
+		self.host = host
+		self.port = port
+		self.log_interval = log_interval
+		self.buckets = tuple(buckets)
+
+		self.histograms = {}		# stage -> count of each bucket (the last one is +Inf), then sum of the durations
+		self.counters = {}			# (name, label values) -> count
+		self.gauges = []			# (prefix, function returning a dict of gauges)
+		self.shards = {}			# shard -> (histograms, counters), the last snapshot sent by a logbook shard
+		self.start_time = time.time()
+
+		self.server = None
+		self.threads = []
+		self.stopping = threading.Event()
+
+	@staticmethod
+	def withConfig(section) -> DisabledMetrics:
+		""" Metrics from the [metrics] section of the config, the shared disabled metrics if there is none or it is not enabled. """
+		if section is None or not section.getboolean('enabled', False):
+			return NO_METRICS
+		port = section.get('port', str(METRICS_PORT)).strip()
+		return AcphMetrics(host=section.get('host', METRICS_HOST), port=int(port) if port else None, log_interval=section.getfloat('log_interval', METRICS_LOG_INTERVAL))
+
+	# the clock of the stages, perf_counter itself to avoid a call
+	clock = staticmethod(time.perf_counter)
+
+	def observe(self, stage, start):
+		""" Add the duration of a stage started at `start` (a value of `clock`). """
+		duration = time.perf_counter() - start
+		histogram = self.histograms.get(stage)
+		if histogram is None:
+			histogram = self.histograms[stage] = [0] * (len(self.buckets) + 1) + [0.0]
+		histogram[bisect.bisect_left(self.buckets, duration)] += 1
+		histogram[-1] += duration
+
+	def count(self, name, *labels):
+		key = (name, labels)
+		self.counters[key] = self.counters.get(key, 0) + 1
+
+	def addGauges(self, prefix, gauges):
+		""" Expose the values of the dict returned by `gauges` as acph_<prefix>_<key>, None values are skipped. """
+		self.gauges.append((prefix, gauges))
+
+	def snapshot(self):
+		""" Copy of the histograms and counters of this process, for the main process of a logbook shard. """
+		return ({stage: list(histogram) for stage, histogram in list(self.histograms.items())}, dict(self.counters))
+
+	def addShard(self, shard, snapshot):
+		""" Replace the values of a logbook shard by its last snapshot. """
+		self.shards[shard] = snapshot
+
+	def merged(self):
+		""" Histograms and counters of this process and of the logbook shards. """
+		histograms, counters = self.snapshot()
+		for shard_histograms, shard_counters in list(self.shards.values()):
+			for stage, histogram in shard_histograms.items():
+				merged = histograms.get(stage)
+				histograms[stage] = list(histogram) if merged is None else [value + shard_value for value, shard_value in zip(merged, histogram)]
+			for key, value in shard_counters.items():
+				counters[key] = counters.get(key, 0) + value
+		return histograms, counters
+
+	def start(self):
+		""" Start the periodic log and, if a port is set, the HTTP endpoint. """
+		self.stopping.clear()
+		self.threads = []
+		if self.port is not None:
+			try:
+				self.server = ThreadingHTTPServer((self.host, self.port), self.__handlerClass())
+			except OSError as e:
+				self.logger.error('Unable to open the metrics endpoint on {}:{}: {}'.format(self.host, self.port, e))
+			else:
+				self.server.daemon_threads = True
+				self.threads.append(threading.Thread(target=self.server.serve_forever, name='acph-metrics-http', daemon=True))
+				self.logger.warning('Metrics endpoint on http://{}:{}/metrics'.format(self.host, self.port))
+		if self.log_interval > 0:
+			self.threads.append(threading.Thread(target=self.__logPeriodically, name='acph-metrics-log', daemon=True))
+		for thread in self.threads:
+			thread.start()
+
+	def stop(self):
+		self.stopping.set()
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+			self.server = None
+		for thread in self.threads:
+			thread.join()
+		self.threads = []
+
+	def __logPeriodically(self):
+		while not self.stopping.wait(self.log_interval):
+			self.logStatistics()
+
+	def __handlerClass(self):
+		metrics = self
+
+		class MetricsRequestHandler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split('?')[0] != '/metrics':
+					self.send_error(404)
+					return
+				body = metrics.exposition().encode()
+				self.send_response(200)
+				self.send_header('Content-Type', CONTENT_TYPE)
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				metrics.logger.debug('Metrics endpoint, {} {}'.format(self.address_string(), format % args))
+
+		return MetricsRequestHandler
+
+	def quantile(self, histogram, q):
+		""" Upper bound of the bucket of the q quantile of a histogram, inf if it is in the last bucket. """
+		total = sum(histogram[:-1])
+		rank = q * total
+		cumulative = 0
+		for bound, counter in zip(self.buckets + (math.inf,), histogram):
+			cumulative += counter
+			if cumulative >= rank:
+				return bound
+		return math.inf
+
+	def exposition(self):
+		""" The metrics in the Prometheus text format. """
+		lines = [
+			'# HELP acph_uptime_seconds Seconds since the metrics were created.',
+			'# TYPE acph_uptime_seconds gauge',
+			'acph_uptime_seconds {}'.format(round(time.time() - self.start_time, 3)),
+			'# HELP acph_stage_duration_seconds Duration of the stages of the beacon processing.',
+			'# TYPE acph_stage_duration_seconds histogram',
+		]
+		histograms, counters = self.merged()
+		for stage, histogram in sorted(histograms.items()):
+			cumulative = 0
+			for bound, counter in zip(self.buckets + (math.inf,), histogram):
+				cumulative += counter
+				lines.append('acph_stage_duration_seconds_bucket{{stage="{}",le="{}"}} {}'.format(escape_label(stage), '+Inf' if bound == math.inf else repr(bound), cumulative))
+			lines.append('acph_stage_duration_seconds_sum{{stage="{}"}} {}'.format(escape_label(stage), repr(histogram[-1])))
+			lines.append('acph_stage_duration_seconds_count{{stage="{}"}} {}'.format(escape_label(stage), cumulative))
+
+		counters = sorted(counters.items(), key=lambda item: (item[0][0], [str(label) for label in item[0][1]]))
+		for name, (description, label_names) in COUNTERS.items():
+			lines.append('# HELP acph_{}_total {}'.format(name, description))
+			lines.append('# TYPE acph_{}_total counter'.format(name))
+			for (counter_name, labels), value in counters:
+				if counter_name == name:
+					lines.append('acph_{}_total{{{}}} {}'.format(name, ','.join('{}="{}"'.format(label_name, escape_label(label)) for label_name, label in zip(label_names, labels)), value))
+
+		for prefix, gauges in self.gauges:
+			for key, value in gauges().items():
+				if value is not None:
+					lines.append('# TYPE acph_{}_{} gauge'.format(prefix, key))
+					lines.append('acph_{}_{} {}'.format(prefix, key, value))
+		return '\n'.join(lines) + '\n'
+
+	def summary(self):
+		""" One line per stage and counter, for the log and the replay tool. """
+		lines = []
+		histograms, counters = self.merged()
+		for stage, histogram in sorted(histograms.items()):
+			calls = sum(histogram[:-1])
+			lines.append('stage {}: {} calls, avg {}us, p50 <= {}us, p99 <= {}us'.format(stage, calls, round(histogram[-1] * 1e6 / calls, 2) if calls else 0,
+				round(self.quantile(histogram, 0.5) * 1e6, 1), round(self.quantile(histogram, 0.99) * 1e6, 1)))
+		for name, (description, label_names) in COUNTERS.items():
+			values = sorted(((labels, value) for (counter_name, labels), value in counters.items() if counter_name == name), key=lambda item: -item[1])
+			if values:
+				lines.append('{}: {}'.format(name, ', '.join('{} {}'.format('/'.join(str(label) for label in labels), value) for labels, value in values)))
+		return lines
+
+	def logStatistics(self):
+		for line in self.summary():
+			self.logger.info('Metrics, {}'.format(line))
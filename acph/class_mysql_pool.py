@@ -0,0 +1,141 @@
+import time
+import queue
+import logging
+import contextlib
+import mysql.connector
+
+from mysql.connector import errors
+
+MYSQL_POOL_SIZE = 2					# number of connections of the pool
+MYSQL_POOL_CHECK_INTERVAL = 60		# ping a connection idle for more than n seconds before using it
+MYSQL_CONNECT_TIMEOUT = 5			# max number of seconds to open a connection
+MYSQL_RECONNECT_DELAY = 30			# after a failed connection, fail fast for n seconds before trying again
+MYSQL_BORROW_TIMEOUT = 5			# max number of seconds to wait for a free connection of the pool
+
+class MysqlPooledConnection:
+	""" A connection slot of the pool, it keeps the prepared cursors of its connection. """
+
+	def __init__(self, pool):
+		self.pool = pool
+		self.cnx = None
+		self.prepared_cursors = {}
+		self.last_used = 0
+
+	def cursor(self, dictionary=False):
+		return self.cnx.cursor(dictionary=dictionary)
+
+	def prepared(self, query):
+		# the statement is prepared by the server on the first execute, then the cursor reuses it
+		cursor = self.prepared_cursors.get(query)
+		if cursor is None:
+			cursor = self.cnx.cursor(prepared=True)
+			self.prepared_cursors[query] = cursor
+		return cursor
+
+	def commit(self):
+		self.cnx.commit()
+
+	def check(self):
+		if self.cnx is not None and time.monotonic() - self.last_used < self.pool.check_interval:
+			return
+
+		if self.cnx is not None:
+			try:
+				self.pool.counter_pings += 1
+				self.cnx.ping(reconnect=False)
+				self.last_used = time.monotonic()
+				return
+			except errors.Error as err:
+				self.pool.logger.warning('Connection with MySql DB probably loose following the session time-out, reconnect. Error is {}'.format(err))
+				self.invalidate()
+
+		self.cnx = self.pool.connect()
+		self.last_used = time.monotonic()
+
+	def invalidate(self):
+		for cursor in self.prepared_cursors.values():
+			try:
+				cursor.close()
+			except errors.Error:
+				pass
+		self.prepared_cursors.clear()
+
+		if self.cnx is not None:
+			try:
+				self.cnx.close()
+			except errors.Error:
+				pass
+			self.cnx = None
+
+class MysqlConnectionPool:
+	""" Small pool of MySQL connections.
+
+	A connection is checked with a ping only when it has been idle for more
+	than `check_interval` seconds, not before each statement. Connections are
+	opened with a short `connect_timeout`, and once a connection attempt fails
+	the pool fails fast during `reconnect_delay` seconds, so that a DB hiccup
+	costs an error log instead of stalling the caller.
+	"""
+
+	def __init__(self, config, size=MYSQL_POOL_SIZE, check_interval=MYSQL_POOL_CHECK_INTERVAL, connect_timeout=MYSQL_CONNECT_TIMEOUT,
+			reconnect_delay=MYSQL_RECONNECT_DELAY, borrow_timeout=MYSQL_BORROW_TIMEOUT):
+		if size < 1:
+			raise ValueError('MySQL pool size must be strictly positive.')
+
+		self.logger = logging.getLogger(__name__)
+		self.config = {'user': config['user'], 'password': config['password'], 'database': config['database'], 'host': config['host']}
+		self.check_interval = check_interval
+		self.connect_timeout = connect_timeout
+		self.reconnect_delay = reconnect_delay
+		self.borrow_timeout = borrow_timeout
+		self.unavailable_until = 0
+
+		self.counter_connections = 0
+		self.counter_connection_errors = 0
+		self.counter_pings = 0
+
+		self.slots = queue.LifoQueue()
+		for _ in range(size):
+			self.slots.put(MysqlPooledConnection(self))
+
+	def connect(self):
+		now = time.monotonic()
+		if now < self.unavailable_until:
+			raise errors.OperationalError('MySql DB unavailable, next connection attempt in {}s.'.format(round(self.unavailable_until - now, 1)))
+
+		try:
+			cnx = mysql.connector.connect(**self.config, connection_timeout=self.connect_timeout)
+			self.counter_connections += 1
+			return cnx
+		except errors.Error:
+			self.counter_connection_errors += 1
+			self.unavailable_until = time.monotonic() + self.reconnect_delay
+			raise
+
+	@contextlib.contextmanager
+	def connection(self):
+		""" Borrow a connection of the pool, it is given back when the with block exits. """
+		try:
+			slot = self.slots.get(timeout=self.borrow_timeout)
+		except queue.Empty:
+			raise errors.PoolError('No MySql connection available within {}s.'.format(self.borrow_timeout))
+
+		try:
+			slot.check()
+			yield slot
+			slot.last_used = time.monotonic()
+		except (errors.OperationalError, errors.InterfaceError):
+			# connection lost, it is opened again on next use
+			slot.invalidate()
+			raise
+		finally:
+			self.slots.put(slot)
+
+	def close(self):
+		while True:
+			try:
+				slot = self.slots.get_nowait()
+			except queue.Empty:
+				break
+			slot.invalidate()
+		self.logger.info('MySql pool closed, {} connections opened ({} errors), {} liveness pings'.format(self.counter_connections, self.counter_connection_errors, self.counter_pings))
@@ -1,19 +1,46 @@
 
+import sys
 import urllib
 import logging
 import json
+from array import array
+from types import MappingProxyType
 from urllib.request import urlopen
 
 OGN_DDB_URL = "http://ddb.glidernet.org/"
 OGN_DDB_DEVICES_LIST_URL = "http://ddb.glidernet.org/download/?j=1"
 
+RECORDS_CACHE_SIZE = 4096		# max number of materialised devices (known or unknown) kept by the database
+
+# shared record returned for all the aircraft that are not in the OGN devices database
+UNKNOWN_OGN_DEVICE = MappingProxyType({
+	"device_type":"#unknown",			# normaly F or I or O
+	"device_id": "#unknown",
+	"aircraft_model":"#unknown",
+	"registration":"#unknown",
+	"cn":"#unknown",
+	"tracked":"N",
+	"identified":"N"})
+
 class OgnDevicesDatabase:
-	devices = None
+	""" OGN devices database stored by column.
+
+	Each column holds, for every device, the code of its value in the list of
+	distinct (interned) values of the column, and `index` maps a device id to
+	its row. A device record is only built by `getAircraftById`, as a read-only
+	mapping cached for the next beacons of the same aircraft.
+	"""
 
 	def __init__(self):
 		self.logger = logging.getLogger(__name__)
 		self.logger.setLevel(logging.INFO)
-		self.devices = {}
+		self.index = {}
+		self.columns = {}
+		self.records = {}
+		self.unknown_devices = set()
+
+	def __len__(self):
+		return len(self.index)
 
 	@staticmethod
 	def withURL():
@@ -21,10 +48,9 @@ class OgnDevicesDatabase:
 		
 		json_url = urlopen(OGN_DDB_DEVICES_LIST_URL)
 		data = json.loads(json_url.read())
-		for item in data['devices']:
-			instance.devices[item['device_id']] = item
+		instance.addDevices(data['devices'])
 
-		instance.logger.info('OGN devices datbase, {} devices loaded from url {}'.format(len(instance.devices),OGN_DDB_DEVICES_LIST_URL))
+		instance.logger.info('OGN devices datbase, {} devices loaded from url {}'.format(len(instance),OGN_DDB_DEVICES_LIST_URL))
 		return instance
 	
 	@staticmethod
@@ -34,18 +60,66 @@ class OgnDevicesDatabase:
 		with open(json_ogn_ddb_file) as json_file:
 			data = json.load(json_file)
 			# instance.devices = data['devices'] 			v0.1
-			for item in data['devices']:
-				instance.devices[item['device_id']] = item
+			instance.addDevices(data['devices'])
 
-		instance.logger.info('OGN devices datbase, {} devices loaded from json file {}'.format(len(instance.devices),json_ogn_ddb_file))			
+		instance.logger.info('OGN devices datbase, {} devices loaded from json file {}'.format(len(instance),json_ogn_ddb_file))			
 		return instance
 
+	def addDevices(self, devices):
+		# codes of the values of each column, only needed while adding devices
+		values_codes = {name: {value: code for code, value in enumerate(values)} for name, (_, values) in self.columns.items()}
+
+		for item in devices:
+			device_id = sys.intern(item['device_id'])
+			row = self.index.get(device_id)
+			if row is None:
+				row = self.index[device_id] = len(self.index)
+				for codes, _ in self.columns.values():
+					codes.append(0)
+
+			for name, value in item.items():
+				if name == 'device_id':
+					continue
+				column = self.columns.get(name)
+				if column is None:
+					# a column seen for the first time, previous devices have the None value
+					column = self.columns[name] = (array('I', [0] * len(self.index)), [None])
+					values_codes[name] = {None: 0}
+				codes, values = column
+				values_code = values_codes[name]
+				code = values_code.get(value)
+				if code is None:
+					code = values_code[value] = len(values)
+					values.append(sys.intern(value) if isinstance(value, str) else value)
+				codes[row] = code
+
+		self.records.clear()
+		self.unknown_devices.clear()
+
 	def getAircraftById(self, device_id):
 		# for aDevice in iter(self.devices):				v0.1
 		# 	if aDevice['device_id'] == device_id:
 		# 		return aDevice
 		# return None
-		return self.devices.get(device_id,None)
+		record = self.records.get(device_id)
+		if record is not None:
+			return record
+		if device_id in self.unknown_devices:
+			return None
+
+		if len(self.records) + len(self.unknown_devices) >= RECORDS_CACHE_SIZE:
+			self.records.clear()
+			self.unknown_devices.clear()
+
+		row = self.index.get(device_id)
+		if row is None:
+			self.unknown_devices.add(device_id)
+			return None
+
+		record = {name: values[codes[row]] for name, (codes, values) in self.columns.items() if codes[row]}
+		record['device_id'] = device_id
+		record = self.records[device_id] = MappingProxyType(record)
+		return record
 
 	def getAircraftModelById(self, device_id):
 		aircraft = self.getAircraftById(device_id)
@@ -0,0 +1,373 @@
+#  This module contains a multi-process pipeline to process the APRS beacons on several cores: the
+#  process feeding the beacons (reader), a pool of parser processes and N logbook shards, each shard
+#  owning the flights of a hash-partition of the aircraft addresses.
+
+import time
+import zlib
+import queue
+import heapq
+import operator
+import signal
+import logging
+import collections
+import threading
+import multiprocessing
+
+from ogn.parser import parse, ParseError
+
+PIPELINE_BATCH_SIZE = 256			# number of messages sent at once from a process to another
+PIPELINE_BATCH_INTERVAL = 0.5		# max number of seconds a message waits in a batch of the reader
+PIPELINE_QUEUE_SIZE = 64			# max number of batches waiting in the queue of a process
+PIPELINE_CHECK_INTERVAL = 1			# number of seconds between 2 checks of the processes while waiting for a queue
+PIPELINE_METRICS_INTERVAL = 10		# number of seconds between 2 snapshots of the metrics sent by a shard to the main process
+
+TOW_PLANE_AIRCRAFT_TYPE = 2			# OGN aircraft type of the tow planes
+
+def partition(key, partitions):
+	""" Partition of an aircraft address (hexadecimal) or of any other key. """
+	try:
+		return int(key, 16) % partitions
+	except ValueError:
+		return zlib.crc32(key.encode('utf-8')) % partitions
+
+def run_parser(index, input_queue, shard_queues, parser):
+	""" Parser process: parse the raw messages and send them to the shard owning the aircraft.
+
+	Each batch received gives one message to each shard, even empty, so that the shards know
+	this parser has sent all its beacons of the batch.
+	"""
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	logger = logging.getLogger(__name__)
+	shards = len(shard_queues)
+	parse_beacon = parser.parse if parser is not None else parse
+
+	while True:
+		batch = input_queue.get()
+		if batch is None:
+			break
+
+		outputs = [[] for _ in range(shards)]
+		for sequence, raw_message, timestamp, date in batch:
+			try:
+				beacon = parse_beacon(raw_message, timestamp)
+			except ParseError as parsingError:
+				logger.info(parsingError)
+				continue
+			except Exception:
+				logger.exception('Unexpected error when parsing following aprs beacon {}'.format(raw_message))
+				continue
+
+			owner = partition(beacon.get('address') or beacon.get('name') or '', shards)
+			outputs[owner].append((sequence, beacon, date, False))
+
+			# the gliders of all the shards need the positions of the tow planes to detect their launch type
+			if beacon.get('aprs_type') == 'position' and beacon.get('aircraft_type') == TOW_PLANE_AIRCRAFT_TYPE:
+				for shard in range(shards):
+					if shard != owner:
+						outputs[shard].append((sequence, beacon, date, True))
+
+		for shard_queue, output in zip(shard_queues, outputs):
+			shard_queue.put((index, output))
+
+	# tell each shard this parser is done
+	for shard_queue in shard_queues:
+		shard_queue.put((index, None))
+	if parser is not None:
+		parser.logStatistics()
+
+def run_shard(index, shards, input_queue, parsers, logbook, pdo_factory, result_queue, metrics_queue):
+	""" Logbook shard process: run the flights state machine of its aircraft, with its own persistence engine.
+
+	The beacons of a batch of the reader come from all the parsers, they are handled once each
+	parser has sent its part, in the order the reader received them: the positions of the tow
+	planes of the other shards are known before the beacons of the gliders that follow them, as
+	in a single process logbook. The metrics of the shard, if enabled, are sent to the main process
+	that serves and logs them.
+	"""
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	logger = logging.getLogger(__name__)
+	logbook.pdo_engine = pdo_factory()
+	# the warm start only keeps the aircraft of the shard
+	logbook.aircraft_filter = lambda aircraft_id: partition(aircraft_id, shards) == index
+	metrics = logbook.metrics
+	metrics_time = time.monotonic()
+	counter_beacons = 0
+	counter_tow_plane_positions = 0
+
+	pending = [collections.deque() for _ in range(parsers)]		# parts of the batches received from each parser
+	parsers_done = 0
+	while parsers_done < parsers:
+		parser, part = input_queue.get()
+		if part is None:
+			parsers_done += 1
+			continue
+		pending[parser].append(part)
+		if not all(pending):
+			continue
+
+		for sequence, beacon, date, tow_plane_position in heapq.merge(*(parts.popleft() for parts in pending), key=operator.itemgetter(0)):
+			if tow_plane_position:
+				counter_tow_plane_positions += 1
+				logbook.handleTowPlanePosition(beacon, date)
+			else:
+				counter_beacons += 1
+				logbook.handleParsedBeacon(beacon, date)
+
+		if metrics.enabled and time.monotonic() - metrics_time >= PIPELINE_METRICS_INTERVAL:
+			metrics_queue.put((index, metrics.snapshot()))
+			metrics_time = time.monotonic()
+
+	logbook.flush()
+	logbook.pdo_engine.close()
+	logger.warning('Logbook shard #{} stopped, {} beacons handled, {} tow plane positions received from the other shards.'.format(index, counter_beacons, counter_tow_plane_positions))
+
+	result_queue.put({
+		'shard': index,
+		'counter_beacons': counter_beacons,
+		'counter_tow_plane_positions': counter_tow_plane_positions,
+		'counter_aircraft_beacon_position': logbook.counter_aircraft_beacon_position,
+		'counter_saves': logbook.counter_saves,
+		'counter_saves_skipped': logbook.counter_saves_skipped,
+		'counter_evictions': logbook.counter_evictions,
+		'counter_loads': logbook.counter_loads,
+		'counter_reloads': logbook.counter_reloads,
+		'counter_warm_started': logbook.counter_warm_started,
+		'counter_loads_avoided': logbook.counter_loads_avoided,
+		'logbook': dict(logbook.logbook),
+		'evicted_flights': logbook.evicted_flights,
+		'metrics': metrics.snapshot(),
+	})
+
+class AcphPipeline:
+
+	""" Process the beacons on several cores.
+
+	The beacons given to `handleBeacon` (the reader) are batched and sent to a
+	pool of `parsers` processes, a raw message goes always to the same parser
+	according to its callsign. A batch is sent when it is full, or by a timer
+	thread at most `batch_interval` seconds after it was started. Each parsed
+	beacon is sent to one of the `shards` logbook processes according to the
+	aircraft address, the positions of the tow planes are also sent to all the
+	other shards for the launch type detection. A shard handles its beacons in
+	the order the reader received them, whatever the parser, so the flights
+	are the same as with a single process logbook. The pre-filter of the
+	logbook, if any, is applied by the reader before batching, its parser is
+	used by the parser processes. The metrics of the shards are added to the
+	ones of `logbook`, the prefilter and parse stages are not measured.
+
+	Each shard is a fork of `logbook` (the airports and OGN databases are
+	shared copy-on-write) and persists its flights with the engine returned by
+	`pdo_factory`, called in the shard process. Processes are forked, the
+	pipeline is only available on the platforms supporting fork.
+
+	Parameters
+	----------
+	logbook : FlightsLogBook
+		Logbook the shards are forked from, its persistence engine is not used.
+	pdo_factory : callable
+		Return an opened persistence engine, called once by each shard.
+	shards : int
+		Number of logbook shards.
+	parsers : int, optional
+		Number of parser processes, same as `shards` by default.
+	"""
+
+	def __init__(self, logbook, pdo_factory, shards, parsers=None, batch_size=PIPELINE_BATCH_SIZE, batch_interval=PIPELINE_BATCH_INTERVAL):
+		if shards < 1:
+			raise ValueError('The pipeline needs at least one logbook shard.')
+
+		self.logger = logging.getLogger(__name__)
+		self.logbook_template = logbook
+		self.metrics = logbook.metrics
+		self.prefilter = logbook.prefilter
+		self.pdo_factory = pdo_factory
+		self.shards = shards
+		self.parsers = parsers if parsers else shards
+		self.batch_size = batch_size
+		self.batch_interval = batch_interval
+		self.context = multiprocessing.get_context('fork')
+
+		self.parser_queues = []
+		self.shard_queues = []
+		self.result_queue = None
+		self.metrics_queue = None
+		self.processes = []
+		self.shard_processes = []
+		self.failure = None			# error of a process found by the timer thread, raised to the reader
+		self.batches = [[] for _ in range(self.parsers)]
+		self.batch_started = time.monotonic()
+		self.sequence = 0			# number of the beacons sent, the order of the beacons of the shards
+		# the batches are also sent by a timer thread when no beacon comes (quiet feed at night)
+		self.batches_lock = threading.Lock()
+		self.timer = None
+		self.stopped = threading.Event()
+
+		# merged results of the shards, available once the pipeline is closed
+		self.logbook = {}
+		self.evicted_flights = None if logbook.evicted_flights is None else {}
+		self.counter_beacons = 0
+		self.counter_aircraft_beacon_position = 0
+		self.counter_saves = 0
+		self.counter_saves_skipped = 0
+		self.counter_evictions = 0
+		self.counter_loads = 0
+		self.counter_reloads = 0
+		self.counter_warm_started = 0
+		self.counter_loads_avoided = 0
+
+	def start(self):
+		self.parser_queues = [self.context.Queue(PIPELINE_QUEUE_SIZE) for _ in range(self.parsers)]
+		self.shard_queues = [self.context.Queue(PIPELINE_QUEUE_SIZE) for _ in range(self.shards)]
+		self.result_queue = self.context.Queue()
+		self.metrics_queue = self.context.Queue()
+
+		self.shard_processes = [self.context.Process(target=run_shard, name='acph-shard-{}'.format(index), daemon=True,
+			args=(index, self.shards, shard_queue, self.parsers, self.logbook_template, self.pdo_factory, self.result_queue, self.metrics_queue)) for index, shard_queue in enumerate(self.shard_queues)]
+		self.processes.extend(self.shard_processes)
+		for index, parser_queue in enumerate(self.parser_queues):
+			self.processes.append(self.context.Process(target=run_parser, name='acph-parser-{}'.format(index), daemon=True,
+				args=(index, parser_queue, self.shard_queues, self.logbook_template.parser)))
+		for process in self.processes:
+			process.start()
+
+		# started after the fork of the processes
+		self.stopped.clear()
+		self.timer = threading.Thread(target=self.__runTimer, name='acph-pipeline-timer', daemon=True)
+		self.timer.start()
+		self.logger.warning('Pipeline started with {} parsers and {} logbook shards.'.format(self.parsers, self.shards))
+
+	def handleBeacon(self, raw_message, timestamp = None, date = None):
+		if self.failure is not None:
+			raise RuntimeError(self.failure)
+		self.counter_beacons += 1
+		if self.prefilter is not None and not self.prefilter.accept(raw_message):
+			return
+
+		callsign_end = raw_message.find('>')
+		index = partition(raw_message[:callsign_end] if callsign_end > 0 else raw_message, self.parsers) if self.parsers > 1 else 0
+		with self.batches_lock:
+			batch = self.batches[index]
+			batch.append((self.sequence, raw_message, timestamp, date))
+			self.sequence += 1
+
+			if len(batch) >= self.batch_size or time.monotonic() - self.batch_started >= self.batch_interval:
+				self.__flushBatches()
+
+	def flush(self):
+		with self.batches_lock:
+			self.__flushBatches()
+
+	def __flushBatches(self):
+		# each parser gets its batch, even empty, the shards wait for all the parsers before handling a batch
+		if any(self.batches):
+			for parser_queue, batch in zip(self.parser_queues, self.batches):
+				self.__put(parser_queue, batch)
+		self.batches = [[] for _ in range(self.parsers)]
+		self.batch_started = time.monotonic()
+
+	def __put(self, process_queue, item, closing=False):
+		# a full queue is not waited for forever, the process reading it may be dead
+		while True:
+			try:
+				process_queue.put(item, timeout=PIPELINE_CHECK_INTERVAL)
+				return
+			except queue.Full:
+				self.checkProcesses(closing)
+
+	def checkProcesses(self, closing=False):
+		""" Raise a RuntimeError if a process of the pipeline has stopped before the end of the beacons, only a parser stops while closing. """
+		for process in self.processes:
+			if not process.is_alive() and not (closing and process.exitcode == 0 and process not in self.shard_processes):
+				raise RuntimeError('Pipeline process {} stopped unexpectedly (exit code {}).'.format(process.name, process.exitcode))
+
+	def __runTimer(self):
+		# a beacon waits at most batch_interval seconds in the reader, even when it is the last one for a while
+		while not self.stopped.wait(self.batch_interval / 2):
+			try:
+				self.checkProcesses()
+				self.__receiveMetrics()
+				with self.batches_lock:
+					if any(self.batches) and time.monotonic() - self.batch_started >= self.batch_interval:
+						self.__flushBatches()
+			except RuntimeError as err:
+				self.logger.critical(err)
+				self.failure = str(err)
+				return
+
+	def __receiveMetrics(self):
+		while True:
+			try:
+				shard, snapshot = self.metrics_queue.get_nowait()
+			except queue.Empty:
+				return
+			self.metrics.addShard(shard, snapshot)
+
+	def terminate(self):
+		""" Stop all the processes without waiting for the pending beacons. """
+		self.stopped.set()
+		for process in self.processes:
+			if process.is_alive():
+				process.terminate()
+		for process in self.processes:
+			process.join()
+		self.processes = []
+		self.shard_processes = []
+
+	def __getResult(self, received):
+		# the parsers stop once they have sent all the beacons, a shard once it has sent its result
+		while True:
+			try:
+				return self.result_queue.get(timeout=PIPELINE_CHECK_INTERVAL)
+			except queue.Empty:
+				pass
+			for process in self.processes:
+				if not process.is_alive() and process.exitcode != 0:
+					raise RuntimeError('Pipeline process {} stopped unexpectedly (exit code {}).'.format(process.name, process.exitcode))
+			stopped = [process for process in self.shard_processes if not process.is_alive()]
+			if len(stopped) > received:
+				# a result is sent before the shard stops, the last one may still be in the pipe
+				try:
+					return self.result_queue.get(timeout=PIPELINE_CHECK_INTERVAL)
+				except queue.Empty:
+					raise RuntimeError('Pipeline shards {} stopped without sending their result.'.format(', '.join(process.name for process in stopped)))
+
+	def close(self):
+		""" Process the pending beacons, stop the processes and merge the results of the shards. """
+		if self.timer is not None:
+			self.stopped.set()
+			self.timer.join()
+			self.timer = None
+		try:
+			if self.failure is not None:
+				raise RuntimeError(self.failure)
+			self.flush()
+			for parser_queue in self.parser_queues:
+				self.__put(parser_queue, None, closing=True)
+			results = [self.__getResult(received) for received in range(self.shards)]
+		except RuntimeError:
+			self.terminate()
+			raise
+		# the snapshots still in the queue are older than the ones of the results
+		self.__receiveMetrics()
+
+		for result in results:
+			self.counter_aircraft_beacon_position += result['counter_aircraft_beacon_position']
+			self.counter_saves += result['counter_saves']
+			self.counter_saves_skipped += result['counter_saves_skipped']
+			self.counter_evictions += result['counter_evictions']
+			self.counter_loads += result['counter_loads']
+			self.counter_reloads += result['counter_reloads']
+			self.counter_warm_started += result['counter_warm_started']
+			self.counter_loads_avoided += result['counter_loads_avoided']
+			for date, logbook_for_a_date in result['logbook'].items():
+				self.logbook.setdefault(date, {}).update(logbook_for_a_date)
+			for date, evicted_for_a_date in (result['evicted_flights'] or {}).items():
+				self.evicted_flights.setdefault(date, {}).update(evicted_for_a_date)
+			if result['metrics'] is not None:
+				self.metrics.addShard(result['shard'], result['metrics'])
+
+		for process in self.processes:
+			process.join()
+		self.processes = []
+		self.shard_processes = []
+		self.logger.warning('Pipeline stopped, {} beacons processed.'.format(self.counter_beacons))
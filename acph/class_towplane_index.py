@@ -0,0 +1,93 @@
+#  This module contains a spatial index of the recent positions of the tow planes, used to detect the aerotow
+#  launch of the gliders.
+
+import math
+import logging
+import datetime
+
+from collections import deque
+
+TOWPLANE_WINDOW = 10				# seconds a tow plane position is kept
+TOWPLANE_CELL_LATITUDE = 0.01		# degree, ~1.1km
+TOWPLANE_CELL_LONGITUDE = 0.02		# degree, wider than the max glider to tow plane distance (0.4km) up to 79° of latitude
+TOWPLANE_LOG_INTERVAL = 10000		# log the counters every n positions added
+
+class TowPlaneIndex:
+
+	""" Positions of the tow planes received during the last `window` seconds, bucketed in a grid.
+
+	A position is added to its cell and to the 8 neighbour cells, so all the
+	positions closer to a point than a cell size are in the cell of the point:
+	finding the tow planes near a glider is a single dict lookup. Positions are
+	expired by beacon timestamp, against the most recent timestamp seen, so the
+	index keeps every tow plane position of the window whatever the traffic.
+
+	Parameters
+	----------
+	window : int, optional
+		Seconds a position is kept, and max age of a matching position.
+	cell_latitude, cell_longitude : float, optional
+		Size of a cell in degrees, must be larger than the max distance of a match.
+	"""
+
+	def __init__(self, window=TOWPLANE_WINDOW, cell_latitude=TOWPLANE_CELL_LATITUDE, cell_longitude=TOWPLANE_CELL_LONGITUDE):
+		self.logger = logging.getLogger(__name__)
+		self.window = datetime.timedelta(seconds=window)
+		self.cell_latitude = cell_latitude
+		self.cell_longitude = cell_longitude
+
+		self.cells = {}				# cell -> positions of the cell and of its neighbours, oldest first
+		self.positions = deque()	# (timestamp, cells, position) in the order they were added
+		self.latest = None			# most recent timestamp seen
+
+		self.counter_positions = 0
+		self.counter_expired = 0
+
+	def __len__(self):
+		return len(self.positions)
+
+	def cell(self, latitude, longitude):
+		return (math.floor(latitude / self.cell_latitude), math.floor(longitude / self.cell_longitude))
+
+	def add(self, position):
+		""" Add a position, a dict with at least latitude, longitude and timestamp. """
+		self.expire(position['timestamp'])
+		row, column = self.cell(position['latitude'], position['longitude'])
+		keys = [(row + i, column + j) for i in (-1, 0, 1) for j in (-1, 0, 1)]
+		for key in keys:
+			cell = self.cells.get(key)
+			if cell is None:
+				cell = self.cells[key] = deque()
+			cell.append(position)
+		self.positions.append((position['timestamp'], keys, position))
+
+		self.counter_positions += 1
+		if self.counter_positions % TOWPLANE_LOG_INTERVAL == 0:
+			self.logger.info('Tow planes index, {} positions added, {} expired, {} in the window of {}s'.format(self.counter_positions, self.counter_expired, len(self.positions), self.window.total_seconds()))
+
+	def expire(self, timestamp):
+		""" Remove the positions older than the window before the most recent timestamp seen. """
+		if self.latest is None or timestamp > self.latest:
+			self.latest = timestamp
+		cutoff = self.latest - self.window
+		while self.positions and self.positions[0][0] < cutoff:
+			_, keys, position = self.positions.popleft()
+			for key in keys:
+				cell = self.cells[key]
+				if cell[0] is position:
+					cell.popleft()
+				else:
+					# positions received out of order
+					cell.remove(position)
+				if not cell:
+					del self.cells[key]
+			self.counter_expired += 1
+
+	def candidates(self, latitude, longitude, timestamp):
+		""" Positions close to a point and at most `window` seconds older than timestamp, most recent first. """
+		self.expire(timestamp)
+		cell = self.cells.get(self.cell(latitude, longitude))
+		if not cell:
+			return []
+		cutoff = timestamp - self.window
+		return [position for position in reversed(cell) if position['timestamp'] >= cutoff]
@@ -1,71 +1,201 @@
 #  This module contains an implementation of a Vantage Point-tree (VP-tree).
 
 # This is a  modified version of the vp-tree project (https://pypi.org/project/vptree/)
-# with numpy dependency removed
+# with numpy dependency removed. Nodes are stored in flat parallel arrays indexed by
+# node number instead of nested objects, the tree is built iteratively and can be
+# saved to / loaded from a cache file.
 
-# import numpy as np
-import statistics
+import os
+import heapq
+import pickle
+import hashlib
+import logging
+
+from array import array
+
+VPTREE_CACHE_VERSION = 2		# bump it when the layout of the cache file or the implementation of a distance function changes
+NO_NODE = -1					# child index of a missing child
 
 class AcphVPTree:
 
-	def __init__(self, points, dist_fn):
-		self.left = None
-		self.right = None
-		# self.left_min = np.inf
-		self.left_min = float('inf')
-		self.left_max = 0
-		# self.right_min = np.inf
-		self.right_min = float('inf')
-		self.right_max = 0
+	def __init__(self, points, dist_fn, build=True):
 		self.dist_fn = dist_fn
 
+		# one entry per node
+		self.vps = []
+		self.left = array('l')
+		self.right = array('l')
+		self.left_min = array('d')
+		self.left_max = array('d')
+		self.right_min = array('d')
+		self.right_max = array('d')
+
+		if not build:
+			return
+
 		if not len(points):
 			raise ValueError('Points can not be empty.')
 
-		# Vantage point is point furthest from parent vp.
-		vp_i = 0
-		self.vp = points[vp_i]
-		# points = np.delete(points, vp_i, axis=0)
-		points.pop(vp_i)
+		self._build(list(points))
+
+	def _new_node(self, vp):
+		self.vps.append(vp)
+		self.left.append(NO_NODE)
+		self.right.append(NO_NODE)
+		self.left_min.append(float('inf'))
+		self.left_max.append(0)
+		self.right_min.append(float('inf'))
+		self.right_max.append(0)
+		return len(self.vps) - 1
+
+	def _build(self, points):
+		# each item of the stack is a node and the points of its subtree, its vantage point
+		# (the point furthest from the parent vp) being first.
+		stack = [(self._new_node(points[0]), points)]
+
+		while len(stack) > 0:
+			node, points = stack.pop()
+			if len(points) == 1:
+				continue
 
-		if len(points) == 0:
-			return
+			vp = points[0]
+			distances = [self.dist_fn(vp, p) for p in points[1:]]
 
-		# Choose division boundary at median of distances.
-		distances = [self.dist_fn(self.vp, p) for p in points]
-		# median = np.median(distances)
-		median = statistics.median(distances)
-
-		left_points = []
-		right_points = []
-		for point, distance in zip(points, distances):
-			if distance >= median:
-				self.right_min = min(distance, self.right_min)
-				if distance > self.right_max:
-					self.right_max = distance
-					right_points.insert(0, point) # put furthest first
-				else:
-					right_points.append(point)
+			# Choose division boundary at median of distances.
+			sorted_distances = sorted(distances)
+			middle = len(sorted_distances) // 2
+			if len(sorted_distances) % 2:
+				median = sorted_distances[middle]
 			else:
-				self.left_min = min(distance, self.left_min)
-				if distance > self.left_max:
-					self.left_max = distance
-					left_points.insert(0, point) # put furthest first
+				median = (sorted_distances[middle - 1] + sorted_distances[middle]) / 2
+
+			left_points = []
+			right_points = []
+			left_furthest = right_furthest = 0
+			for point, distance in zip(points[1:], distances):
+				if distance >= median:
+					if distance < self.right_min[node]:
+						self.right_min[node] = distance
+					if distance > self.right_max[node]:
+						self.right_max[node] = distance
+						right_furthest = len(right_points)
+					right_points.append(point)
 				else:
+					if distance < self.left_min[node]:
+						self.left_min[node] = distance
+					if distance > self.left_max[node]:
+						self.left_max[node] = distance
+						left_furthest = len(left_points)
 					left_points.append(point)
 
-		if len(left_points) > 0:
-			self.left = AcphVPTree(points=left_points, dist_fn=self.dist_fn)
+			# put furthest first, it is the vantage point of the child
+			if len(left_points) > 0:
+				left_points[0], left_points[left_furthest] = left_points[left_furthest], left_points[0]
+				self.left[node] = self._new_node(left_points[0])
+				stack.append((self.left[node], left_points))
+
+			if len(right_points) > 0:
+				right_points[0], right_points[right_furthest] = right_points[right_furthest], right_points[0]
+				self.right[node] = self._new_node(right_points[0])
+				stack.append((self.right[node], right_points))
+
+	def __len__(self):
+		return len(self.vps)
+
+	@staticmethod
+	def cacheKey(points, dist_fn):
+		""" Hash of the points set and the distance function used to build a tree. """
+		digest = hashlib.sha256()
+		digest.update('{}/{}'.format(VPTREE_CACHE_VERSION, getattr(dist_fn, '__name__', repr(dist_fn))).encode('utf-8'))
+		for point in points:
+			digest.update(repr(list(point)).encode('utf-8'))
+		return digest.hexdigest()
+
+	@staticmethod
+	def withCacheFile(points, dist_fn, cache_dir):
+		""" Load the tree of `points` from the cache directory, build and save it if not yet cached.
 
-		if len(right_points) > 0:
-			self.right = AcphVPTree(points=right_points, dist_fn=self.dist_fn)
+		Parameters
+		----------
+		points : list
+			Points of the tree.
+		dist_fn : callable
+			Distance function.
+		cache_dir : str
+			Directory of the cache files.
 
-	def _is_leaf(self):
-		return (self.left is None) and (self.right is None)
+		Returns
+		-------
+		AcphVPTree
+			The tree of `points`.
+		"""
+		logger = logging.getLogger(__name__)
+		key = AcphVPTree.cacheKey(points, dist_fn)
+		cache_file = os.path.join(cache_dir, 'vptree-{}.pickle'.format(key))
+
+		try:
+			instance = AcphVPTree.load(cache_file, dist_fn, key)
+			logger.info('VP-tree of {} points loaded from cache file {}'.format(len(instance), cache_file))
+			return instance
+		except FileNotFoundError:
+			logger.info('No VP-tree cache file {}, build the tree.'.format(cache_file))
+		except (IOError, ValueError, pickle.UnpicklingError, EOFError) as err:
+			logger.warning('Unable to load VP-tree cache file {}, build the tree. Error is {}'.format(cache_file, err))
+
+		instance = AcphVPTree(points, dist_fn)
+		try:
+			instance.save(cache_file, key)
+			logger.info('VP-tree of {} points saved to cache file {}'.format(len(instance), cache_file))
+		except IOError as err:
+			logger.warning('Unable to save VP-tree cache file {}. Error is {}'.format(cache_file, err))
+		return instance
+
+	def save(self, cache_file, key=None):
+		""" Save the tree nodes to `cache_file`, the distance function is not saved. """
+		state = {
+			'version': VPTREE_CACHE_VERSION,
+			'key': key,
+			'vps': self.vps,
+			'left': self.left,
+			'right': self.right,
+			'left_min': self.left_min,
+			'left_max': self.left_max,
+			'right_min': self.right_min,
+			'right_max': self.right_max,
+		}
+
+		# write to a temporary file first, a process killed while saving does not leave a truncated cache
+		tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+		with open(tmp_file, 'wb') as fp:
+			pickle.dump(state, fp, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp_file, cache_file)
+
+	@staticmethod
+	def load(cache_file, dist_fn, key=None):
+		""" Load a tree saved with `save`, `key` if given must match the saved one. """
+		with open(cache_file, 'rb') as fp:
+			state = pickle.load(fp)
+
+		if state.get('version') != VPTREE_CACHE_VERSION:
+			raise ValueError('VP-tree cache version {} is not supported.'.format(state.get('version')))
+		if key is not None and state.get('key') != key:
+			raise ValueError('VP-tree cache key mismatch.')
+
+		instance = AcphVPTree(None, dist_fn, build=False)
+		instance.vps = state['vps']
+		instance.left = state['left']
+		instance.right = state['right']
+		instance.left_min = state['left_min']
+		instance.left_max = state['left_max']
+		instance.right_min = state['right_min']
+		instance.right_max = state['right_max']
+		if not len(instance.vps):
+			raise ValueError('VP-tree cache is empty.')
+		return instance
 
 	def get_nearest_neighbor(self, query):
 		""" Get single nearest neighbor.
-		
+
 		Parameters
 		----------
 		query : Any
@@ -80,7 +210,7 @@ class AcphVPTree:
 
 	def get_n_nearest_neighbors(self, query, n_neighbors):
 		""" Get `n_neighbors` nearest neigbors to `query`
-		
+
 		Parameters
 		----------
 		query : Any
@@ -95,40 +225,7 @@ class AcphVPTree:
 		"""
 		if not isinstance(n_neighbors, int) or n_neighbors < 1:
 			raise ValueError('n_neighbors must be strictly positive integer')
-		neighbors = _AutoSortingList(max_size=n_neighbors)
-		nodes_to_visit = [(self, 0)]
-
-		# furthest_d = np.inf
-		furthest_d = float('inf')
-
-		while len(nodes_to_visit) > 0:
-			node, d0 = nodes_to_visit.pop(0)
-			if node is None or d0 > furthest_d:
-				continue
-
-			d = self.dist_fn(query, node.vp)
-			if d < furthest_d:
-				neighbors.append((d, node.vp))
-				furthest_d, _ = neighbors[-1]
-
-			if node._is_leaf():
-				continue
-
-			if node.left_min <= d <= node.left_max:
-				nodes_to_visit.insert(0, (node.left, 0))
-			elif node.left_min - furthest_d <= d <= node.left_max + furthest_d:
-				nodes_to_visit.append((node.left,
-									   node.left_min - d if d < node.left_min
-									   else d - node.left_max))
-
-			if node.right_min <= d <= node.right_max:
-				nodes_to_visit.insert(0, (node.right, 0))
-			elif node.right_min - furthest_d <= d <= node.right_max + furthest_d:
-				nodes_to_visit.append((node.right,
-									   node.right_min - d if d < node.right_min
-									   else d - node.right_max))
-
-		return list(neighbors)
+		return self._search(query, n_neighbors, float('inf'), [], [])
 
 	def get_all_in_range(self, query, max_distance):
 		""" Find all neighbours within `max_distance`.
@@ -147,67 +244,93 @@ class AcphVPTree:
 
 		Notes
 		-----
-		Returned neighbors are not sorted according to distance.
+		Returned neighbors are sorted according to distance.
 		"""
-		neighbors = list()
-		nodes_to_visit = [(self, 0)]
-
-		while len(nodes_to_visit) > 0:
-			node, d0 = nodes_to_visit.pop(0)
-			if node is None or d0 > max_distance:
-				continue
-
-			d = self.dist_fn(query, node.vp)
-			if d < max_distance:
-				neighbors.append((d, node.vp))
-
-			if node._is_leaf():
-				continue
-
-			if node.left_min <= d <= node.left_max:
-				nodes_to_visit.insert(0, (node.left, 0))
-			elif node.left_min - max_distance <= d <= node.left_max + max_distance:
-				nodes_to_visit.append((node.left,
-									   node.left_min - d if d < node.left_min
-									   else d - node.left_max))
-
-			if node.right_min <= d <= node.right_max:
-				nodes_to_visit.insert(0, (node.right, 0))
-			elif node.right_min - max_distance <= d <= node.right_max + max_distance:
-				nodes_to_visit.append((node.right,
-									   node.right_min - d if d < node.right_min
-									   else d - node.right_max))
-
-		return neighbors
-
+		return self._search(query, None, max_distance, [], [])
 
-class _AutoSortingList(list):
+	def query_batch(self, points, k=1, max_distance=float('inf')):
+		""" Get the nearest neighbors of many query points in one call.
 
-	""" Simple auto-sorting list.
+		Parameters
+		----------
+		points : list
+			Query points.
+		k : int or None, optional
+			Number of neighbors to fetch per query point, None to fetch
+			all the neighbors within `max_distance`.
+		max_distance : float, optional
+			Threshold distance for query.
 
-	Inefficient for large sizes since the queue is sorted at
-	each push.
+		Returns
+		-------
+		list
+			For each query point, the list of (distance, point) of its
+			neighbors within `max_distance`, sorted according to distance.
 
-	Parameters
-	---------
-	size : int, optional
-		Max queue size.
-	"""
+		Notes
+		-----
+		The heaps of the search are allocated once and reused from one query
+		point to the next.
+		"""
+		if k is not None and (not isinstance(k, int) or k < 1):
+			raise ValueError('k must be strictly positive integer or None')
+		if k is None and max_distance == float('inf'):
+			raise ValueError('max_distance is required to fetch all the neighbors in range')
 
-	def __init__(self, max_size=None, *args):
-		super(_AutoSortingList, self).__init__(*args)
-		self.max_size = max_size
+		nodes_to_visit = []
+		neighbors = []
+		return [self._search(query, k, max_distance, nodes_to_visit, neighbors) for query in points]
 
-	def append(self, item):
-		""" Append `item` and sort.
+	def _search(self, query, k, max_distance, nodes_to_visit, neighbors):
+		""" Best-first search of the `k` nearest neighbors (all if `k` is None) closer than `max_distance`.
 
-		Parameters
-		----------
-		item : Any
-			Input item.
+		`nodes_to_visit` is a min-heap of (lower bound of the distance to the subtree, node) and
+		`neighbors` a bounded max-heap of (-distance, node) of the neighbors found so far. Both
+		lists are emptied before the search.
 		"""
-		super(_AutoSortingList, self).append(item)
-		self.sort(key=lambda x: x[0])
-		if self.max_size is not None and len(self) > self.max_size:
-			self.pop()
+		del nodes_to_visit[:]
+		del neighbors[:]
+		bound = max_distance
 
+		heapq.heappush(nodes_to_visit, (0, 0))
+		while len(nodes_to_visit) > 0:
+			d0, node = heapq.heappop(nodes_to_visit)
+			if d0 > bound:
+				# nodes are visited by increasing lower bound, none of the remaining ones can do better
+				break
+
+			d = self.dist_fn(query, self.vps[node])
+			bound = self._push_neighbor(neighbors, k, d, node, bound, max_distance)
+
+			child = self.left[node]
+			if child != NO_NODE:
+				d1 = max(d0, self.left_min[node] - d, d - self.left_max[node])
+				if d1 <= bound:
+					heapq.heappush(nodes_to_visit, (d1, child))
+
+			child = self.right[node]
+			if child != NO_NODE:
+				d1 = max(d0, self.right_min[node] - d, d - self.right_max[node])
+				if d1 <= bound:
+					heapq.heappush(nodes_to_visit, (d1, child))
+
+		return [(-negative_d, self.vps[node]) for negative_d, node in sorted(neighbors, reverse=True)]
+
+	@staticmethod
+	def _push_neighbor(neighbors, k, d, node, bound, max_distance):
+		if d >= bound:
+			return bound
+
+		if k is None:
+			neighbors.append((-d, node))
+			return bound
+
+		if len(neighbors) < k:
+			heapq.heappush(neighbors, (-d, node))
+		else:
+			heapq.heapreplace(neighbors, (-d, node))
+
+		# the bound shrinks to the distance of the furthest neighbor once k neighbors are found
+		if len(neighbors) == k:
+			return min(max_distance, -neighbors[0][0])
+		return bound
@@ -0,0 +1,53 @@
+#  This module contains the distance functions of the logbook on plain floats (degrees in, km out), and their
+#  numpy versions for arrays of points, to avoid the geopy Point objects in the hot paths.
+
+import math
+import numpy as np
+
+EARTH_RADIUS = 6371.009				# mean earth radius in km, same value as geopy great_circle
+FAST_DISTANCE_TOLERANCE = 0.0001	# max relative error of the equirectangular distance trusted by within_distance
+FAST_DISTANCE_MAX = 50				# km, above the equirectangular approximation is not used by within_distance
+
+def haversine(latitude1, longitude1, latitude2, longitude2):
+	""" Great circle distance in km between 2 points, same model as geopy great_circle. """
+	lat1 = math.radians(latitude1)
+	lat2 = math.radians(latitude2)
+	hav = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2
+	return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, hav)))
+
+def equirectangular(latitude1, longitude1, latitude2, longitude2):
+	""" Approximated distance in km between 2 close points, projected on the plane tangent at their mean latitude. """
+	x = math.radians(longitude2 - longitude1) * math.cos(math.radians((latitude1 + latitude2) / 2))
+	y = math.radians(latitude2 - latitude1)
+	return EARTH_RADIUS * math.sqrt(x * x + y * y)
+
+def within_distance(latitude1, longitude1, latitude2, longitude2, max_distance):
+	""" True if the great circle distance between 2 points is at most max_distance km.
+
+	The equirectangular distance is used when it is far enough from max_distance
+	for its error (below FAST_DISTANCE_TOLERANCE for distances up to
+	FAST_DISTANCE_MAX km, see benchmark/bench_geo.py) not to change the answer,
+	the haversine distance decides the other cases.
+	"""
+	distance = equirectangular(latitude1, longitude1, latitude2, longitude2)
+	if max_distance <= FAST_DISTANCE_MAX:
+		if distance < max_distance * (1 - FAST_DISTANCE_TOLERANCE):
+			return True
+		if distance > max_distance * (1 + FAST_DISTANCE_TOLERANCE):
+			return False
+	return haversine(latitude1, longitude1, latitude2, longitude2) <= max_distance
+
+def haversine_batch(latitude, longitude, latitudes, longitudes):
+	""" Great circle distances in km between a point and arrays of points. """
+	lat = math.radians(latitude)
+	lats = np.radians(np.asarray(latitudes, dtype=np.float64))
+	lons = np.radians(np.asarray(longitudes, dtype=np.float64))
+	hav = np.sin((lats - lat) / 2) ** 2 + math.cos(lat) * np.cos(lats) * np.sin((lons - math.radians(longitude)) / 2) ** 2
+	return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(1.0, hav)))
+
+def equirectangular_batch(latitude, longitude, latitudes, longitudes):
+	""" Approximated distances in km between a point and arrays of close points. """
+	lats = np.asarray(latitudes, dtype=np.float64)
+	x = np.radians(np.asarray(longitudes, dtype=np.float64) - longitude) * np.cos(np.radians((lats + latitude) / 2))
+	y = np.radians(lats - latitude)
+	return EARTH_RADIUS * np.sqrt(x * x + y * y)
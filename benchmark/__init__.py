@@ -0,0 +1 @@
+#  Benchmarks of the logbook, run them from the root of the repository, e.g. python3 benchmark/bench_geo.py
@@ -0,0 +1,81 @@
+#  Microbenchmark of the APRS socket receive path: text mode makefile reading (one readline call per line)
+#  against the recv_into buffer of AcphAprsClient (complete lines of the buffer decoded and split at once).
+#
+#  python3 benchmark/bench_aprs_socket.py -n 500000
+
+import os
+import sys
+import time
+import socket
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from acph.class_aprs import AcphAprsClient
+
+# a full feed mix: aircraft positions, receivers positions and statuses, server comments
+FEED_SAMPLE = [
+	"FLRDDA5BA>OGFLR,qAS,LFHA:/101600h4535.68N/00326.72E'090/049/A=003816 !W90! id06DDA5BA -039fpm +0.0rot 8.8dB 0e +1.2kHz gps4x5",
+	"ICA3D1C35>OGFLR,qAS,Roitzsch:/114136h5124.82N/01227.47E'000/000/A=000299 !W65! id0D3D1C35 +000fpm +0.0rot 6.2dB 0e -5.4kHz gps2x3",
+	"OGN2FD00F>OGNTRK,qAS,LZHL:/114138h4857.61N/01754.42E'000/000/A=000794 !W66! id072FD00F +000fpm +0.0rot FL003.12 11.8dB 0e +0.3kHz",
+	"LFHA>OGNSDR,TCPIP*,qAC,GLIDERN2:/114134h4534.42NI00311.22E&/A=001204",
+	"LFHA>OGNSDR,TCPIP*,qAC,GLIDERN2:>114134h v0.2.8.RPI-GPU CPU:0.5 RAM:736.5/970.9MB NTP:0.4ms/+1.1ppm +49.9C 1/1Acfts[1h] RF:+49+1.5ppm/+1.45dB/+0.3dB@10km[21475]/+10.8dB@10km[1/1]",
+	"FLRDD1234>OGFLR,qAS,LFHA:/101432h4524.65N/00316.64E'176/081/A=001243 !W50! id0ADD1234 -787fpm +0.0rot 8.8dB 0e +1.2kHz gps4x5",
+	"RND000000>OGNFNT,qAS,Chambery:/114137h4534.03N/00555.50E'000/000/A=000000 !W00! id3E000000 +000fpm",
+	"# aprsc 2.1.4-g408ed49 17 Mar 2018 09:30:36 GMT GLIDERN1 37.187.40.234:10152",
+	"FLRDDF0EF>OGFLR,qAS,LFLC:/114138h4546.99N/00309.89E'245/067/A=004386 !W73! id06DDF0EF +257fpm -0.5rot 14.5dB 0e -2.9kHz gps2x3",
+	"LFLC>OGNSDR,TCPIP*,qAC,GLIDERN3:/114135h4547.37NI00309.60E&/A=001073",
+]
+
+def send_feed(sock, lines):
+	data = ''.join(line + '\r\n' for line in FEED_SAMPLE).encode()
+	repeat, remaining = divmod(lines, len(FEED_SAMPLE))
+	for _ in range(repeat):
+		sock.sendall(data)
+	sock.sendall(''.join(line + '\r\n' for line in FEED_SAMPLE[:remaining]).encode())
+	sock.shutdown(socket.SHUT_WR)
+
+def read_makefile(sock, callback):
+	# text mode file object of the socket, every line is decoded then stripped
+	sock_file = sock.makefile('rw')
+	while True:
+		line = sock_file.readline()
+		if not line:
+			return
+		callback(line.strip())
+
+def read_recv_into(sock, callback, precheck):
+	client = AcphAprsClient('N0CALL', -1, precheck=precheck)
+	client.sock = sock
+	client.receive(callback, lambda client: None)
+
+def bench(name, lines, reader):
+	reader_sock, writer_sock = socket.socketpair()
+	counter = [0, 0]
+	def callback(line):
+		counter[0] += 1
+		counter[1] += len(line)
+
+	# the feed is sent by another process, so that the sender does not share the GIL with the reader
+	writer = multiprocessing.get_context('fork').Process(target=send_feed, args=(writer_sock, lines), daemon=True)
+	writer.start()
+	writer_sock.close()
+	start_time = time.perf_counter()
+	reader(reader_sock, callback)
+	duration = time.perf_counter() - start_time
+	writer.join()
+	reader_sock.close()
+	print('  {:<26} {:>10} {:>12} {:>14} {:>12}'.format(name, round(duration, 3), round(lines / duration), counter[0], counter[1]))
+	return duration
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Microbenchmark of the APRS socket receive path')
+	parser.add_argument("-n", "--lines", action='store', dest='lines', type=int, default=500000, help='number of lines of the feed, default value is 500000')
+	args = parser.parse_args()
+
+	print('{} lines of feed'.format(args.lines))
+	print('  {:<26} {:>10} {:>12} {:>14} {:>12}'.format('receive path', 'time s', 'lines/s', 'decoded lines', 'chars'))
+	reference = bench('makefile (text mode)', args.lines, read_makefile)
+	no_precheck = bench('recv_into', args.lines, lambda sock, callback: read_recv_into(sock, callback, False))
+	precheck = bench('recv_into + comments drop', args.lines, lambda sock, callback: read_recv_into(sock, callback, True))
+	print('Speedup of recv_into: {}, dropping the server comments: {}'.format(round(reference / no_precheck, 2), round(reference / precheck, 2)))
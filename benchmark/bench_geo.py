@@ -0,0 +1,96 @@
+#  Benchmark and accuracy report of the distance functions of acph.geo_math against geopy, on random pairs of
+#  points of our region.
+#
+#  python3 benchmark/bench_geo.py -n 100000
+
+import os
+import sys
+import math
+import time
+import random
+import argparse
+import numpy as np
+
+from geopy import distance
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from acph import geo_math
+
+REGION = (41.0, -5.5, 51.5, 9.9)				# min latitude, min longitude, max latitude, max longitude (France)
+DISTANCE_RANGES = (0.5, 5, 50, 500)			# km, max distance between the 2 points of a pair
+SEED = 20200814
+
+def random_pairs(count, max_distance, generator):
+	pairs = []
+	for _ in range(count):
+		latitude = generator.uniform(REGION[0], REGION[2])
+		longitude = generator.uniform(REGION[1], REGION[3])
+		# second point at a random bearing and distance
+		bearing = generator.uniform(0, 2 * math.pi)
+		offset = generator.uniform(0, max_distance) / geo_math.EARTH_RADIUS
+		pairs.append((latitude, longitude, latitude + math.degrees(offset * math.cos(bearing)),
+			longitude + math.degrees(offset * math.sin(bearing)) / math.cos(math.radians(latitude))))
+	return pairs
+
+def timed(function, pairs):
+	start_time = time.perf_counter()
+	results = [function(*pair) for pair in pairs]
+	return results, (time.perf_counter() - start_time) * 1e6 / len(pairs)
+
+def accuracy(pairs, max_distance):
+	# reference is the WGS-84 geodesic, the logbook compares the distances to thresholds defined on it
+	reference, reference_us = timed(lambda lat1, lon1, lat2, lon2: distance.geodesic((lat1, lon1), (lat2, lon2), ellipsoid='WGS-84').km, pairs)
+	print('\nPairs up to {}km'.format(max_distance))
+	print('  {:<26} {:>10} {:>16} {:>16}'.format('function', 'avg us', 'max abs error m', 'max rel error'))
+	print('  {:<26} {:>10} {:>16} {:>16}'.format('geopy geodesic', round(reference_us, 2), 0, 0))
+
+	functions = (
+		('geopy great_circle', lambda lat1, lon1, lat2, lon2: distance.great_circle((lat1, lon1), (lat2, lon2)).km),
+		('haversine', geo_math.haversine),
+		('equirectangular', geo_math.equirectangular),
+	)
+	results = {}
+	for name, function in functions:
+		values, duration_us = timed(function, pairs)
+		results[name] = values
+		errors = [abs(value - expected) for value, expected in zip(values, reference)]
+		relative_errors = [error / expected for error, expected in zip(errors, reference) if expected > 0]
+		print('  {:<26} {:>10} {:>16} {:>16}'.format(name, round(duration_us, 2), round(max(errors) * 1000, 3), '{:.2e}'.format(max(relative_errors))))
+
+	# error of the fast approximation against the model it replaces
+	relative_errors = [abs(fast - exact) / exact for fast, exact in zip(results['equirectangular'], results['haversine']) if exact > 0]
+	print('  equirectangular vs haversine, max relative error {:.2e} (tolerance of within_distance {:.0e})'.format(max(relative_errors), geo_math.FAST_DISTANCE_TOLERANCE))
+
+	latitudes2 = np.array([pair[2] for pair in pairs])
+	longitudes2 = np.array([pair[3] for pair in pairs])
+	start_time = time.perf_counter()
+	for lat1, lon1, _, _ in pairs[:1000]:
+		geo_math.haversine_batch(lat1, lon1, latitudes2[:1000], longitudes2[:1000])
+	print('  haversine_batch, {} ns per distance (1000 x 1000 points)'.format(round((time.perf_counter() - start_time) * 1e9 / 1e6, 1)))
+	return relative_errors
+
+def check_within_distance(generator, count, threshold=0.4):
+	# pairs around the threshold of the tow plane detection, within_distance must give the haversine answer
+	pairs = random_pairs(count, 2 * threshold, generator)
+	expected, haversine_us = timed(lambda lat1, lon1, lat2, lon2: geo_math.haversine(lat1, lon1, lat2, lon2) <= threshold, pairs)
+	fast, fast_us = timed(lambda lat1, lon1, lat2, lon2: geo_math.within_distance(lat1, lon1, lat2, lon2, threshold), pairs)
+	geopy_answers, geopy_us = timed(lambda lat1, lon1, lat2, lon2: distance.great_circle((lat1, lon1), (lat2, lon2)).km <= threshold, pairs)
+	mismatches = sum(1 for a, b in zip(expected, fast) if a != b)
+	geopy_mismatches = sum(1 for a, b in zip(geopy_answers, fast) if a != b)
+	print('\nwithin_distance({}km) on {} pairs: {} us per call (haversine {} us, geopy great_circle {} us), {} answers differ from haversine, {} from geopy'.format(
+		threshold, count, round(fast_us, 2), round(haversine_us, 2), round(geopy_us, 2), mismatches, geopy_mismatches))
+	return mismatches == 0
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark and accuracy of the distance functions against geopy')
+	parser.add_argument("-n", "--pairs", action='store', dest='pairs', type=int, default=100000, help='number of pairs of points per distance range, default value is 100000')
+	args = parser.parse_args()
+
+	generator = random.Random(SEED)
+	print('Region {}, {} random pairs per distance range'.format(REGION, args.pairs))
+	for max_distance in DISTANCE_RANGES:
+		relative_errors = accuracy(random_pairs(args.pairs, max_distance, generator), max_distance)
+		if max_distance <= geo_math.FAST_DISTANCE_MAX and max(relative_errors) > geo_math.FAST_DISTANCE_TOLERANCE:
+			print('  the equirectangular error exceeds the tolerance of within_distance')
+			sys.exit(1)
+	sys.exit(0 if check_within_distance(generator, args.pairs) else 1)
@@ -0,0 +1,253 @@
+#  Benchmarks of the logbook on the synthetic OGN traffic of benchmark/traffic.py: end-to-end handleBeacon throughput
+#  for each nearest airport engine, nearest airport lookup, runway detection, tow plane detection and persistence
+#  engines. The results are saved as JSON, --compare prints the changes against the results of a previous run.
+#
+#  python3 benchmark/bench_logbook.py -n 200 --compare benchmark/results/bench-logbook-20200814-100000.json
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import datetime
+import tempfile
+import subprocess
+import configparser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from acph.class_airport_db import OurAirportsDatabase
+from acph.class_ogn_db import OgnDevicesDatabase
+from acph.class_flights_logbook import FlightsLogBook, BUFFER_AIRCRAFT_POSITION
+from acph.class_flights_logbook_pdo import FlightLogPDO
+from acph.class_flight_state import FlightState
+from acph.class_beacon_parser import AircraftBeaconParser
+from acph.class_towplane_index import TowPlaneIndex
+from benchmark.traffic import TrafficGenerator, SCENARIOS, TRAFFIC_SEED, TRAFFIC_DURATION
+
+BENCHMARKS = ('handle_beacon', 'nearest_airport', 'detect_runway', 'tow_detection', 'persistence')
+AIRPORTS_ENGINES = ('vptree', 'numpy', 'grid')
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+REGRESSION_THRESHOLD = 0.1			# a result worse by more than 10% than the compared one is a regression
+LOOKUPS = 20000						# number of nearest airport lookups and runway detections
+SAVES = 2000						# number of logbook entries saved by each persistence engine
+LOOKUP_RADIUS = 10					# km, max distance of the looked up points to an airfield
+
+class NullFlightLogPDO(FlightLogPDO):
+	""" Persistence engine saving nothing, so that the end-to-end benchmark measures the logbook only. """
+	pass
+
+class BenchmarkResults:
+	def __init__(self):
+		self.results = {}
+
+	def add(self, name, value, unit, better='higher'):
+		self.results[name] = {'value': value, 'unit': unit, 'better': better}
+		print('  {:<48} {:>14} {}'.format(name, round(value, 3), unit))
+
+def timed(function, *args):
+	start_time = time.perf_counter()
+	result = function(*args)
+	return result, time.perf_counter() - start_time
+
+def git_commit():
+	try:
+		return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def create_logbook(traffic, airports, engine, pdo_engine):
+	ogndb = OgnDevicesDatabase()
+	ogndb.addDevices(traffic.devices)
+	return FlightsLogBook(receivers_filter={'NAVITER'}, ogndb=ogndb, airports_db=airports, pdo_engine=pdo_engine, airports_engine=engine, parser=AircraftBeaconParser())
+
+def check_flights(traffic, logbook):
+	""" Number of aircraft whose first flight has the expected launch type and status. """
+	launch_types = statuses = 0
+	for entries in logbook.logbook.values():
+		for address, flights in entries.items():
+			expected = traffic.expected[address]
+			if flights and flights[0].launch_type == expected['launch_type']:
+				launch_types += 1
+			if flights and (expected['status'] is None or flights[0].status == expected['status']):
+				statuses += 1
+	return launch_types, statuses
+
+def bench_handle_beacon(results, traffic, airports, beacons):
+	for engine in AIRPORTS_ENGINES:
+		logbook = create_logbook(traffic, airports, engine, NullFlightLogPDO())
+
+		def replay():
+			for timestamp, raw_message in beacons:
+				logbook.handleBeacon(raw_message, timestamp)
+		_, duration = timed(replay)
+		results.add('handle_beacon.{}.beacons_per_second'.format(engine), len(beacons) / duration, 'beacons/s')
+
+		launch_types, statuses = check_flights(traffic, logbook)
+		results.add('handle_beacon.{}.launch_types_found'.format(engine), 100 * launch_types / len(traffic.expected), '% of the aircraft')
+		results.add('handle_beacon.{}.statuses_found'.format(engine), 100 * statuses / len(traffic.expected), '% of the aircraft')
+
+def lookup_points(traffic, generator, count):
+	# points around the airfields of the traffic, where the beacons are
+	points = []
+	for _ in range(count):
+		airport = generator.choice(traffic.airfields)
+		points.append((airport.lat + generator.uniform(-1, 1) * LOOKUP_RADIUS / 111.2, airport.lon + generator.uniform(-1, 1) * LOOKUP_RADIUS / 78.6))
+	return points
+
+def bench_nearest_airport(results, traffic, airports, generator):
+	points = lookup_points(traffic, generator, LOOKUPS)
+	answers = {}
+	for engine in AIRPORTS_ENGINES:
+		logbook = create_logbook(traffic, airports, engine, NullFlightLogPDO())
+		find = logbook.findNearestAirportWithEngine
+		answers[engine], duration = timed(lambda: [find(latitude, longitude)[0] for latitude, longitude in points])
+		results.add('nearest_airport.{}.lookup'.format(engine), duration * 1e6 / len(points), 'us', 'lower')
+
+	# the engines must find the same airports
+	reference = answers[AIRPORTS_ENGINES[0]]
+	for engine in AIRPORTS_ENGINES[1:]:
+		results.add('nearest_airport.{}.mismatches'.format(engine), sum(1 for a, b in zip(reference, answers[engine]) if a != b), 'lookups', 'lower')
+
+def bench_detect_runway(results, traffic, airports, generator):
+	logbook = create_logbook(traffic, airports, 'grid', NullFlightLogPDO())
+	calls = [({'track': generator.randrange(0, 360)}, generator.choice(traffic.airfields).icao) for _ in range(LOOKUPS)]
+	_, duration = timed(lambda: [logbook.detectRunway(beacon, icao) for beacon, icao in calls])
+	results.add('detect_runway.call', duration * 1e6 / len(calls), 'us', 'lower')
+
+def bench_tow_detection(results, traffic):
+	positions = traffic.towPlanePositions()
+	gliders = [(timestamp, latitude, longitude) for address, (aircraft_type, receiver, trajectory) in traffic.trajectories.items() if traffic.expected[address]['scenario'] == 'aerotow' and aircraft_type == 1
+		for timestamp, latitude, longitude, altitude, track, speed, climb_rate in trajectory.positions]
+	if not positions or not gliders:
+		print('  no aerotow in the traffic, tow detection not measured')
+		return
+
+	# the tow planes and gliders positions are interleaved by time, as received
+	events = sorted([(position['timestamp'], 0, position) for position in positions] + [(glider[0], 1, glider) for glider in gliders], key=lambda event: (event[0], event[1]))
+	index = TowPlaneIndex()
+	counters = {'add': [0, 0.0], 'candidates': [0, 0.0]}
+	for timestamp, kind, event in events:
+		start_time = time.perf_counter()
+		if kind == 0:
+			index.add(event)
+			counter = counters['add']
+		else:
+			index.candidates(event[1], event[2], timestamp)
+			counter = counters['candidates']
+		counter[1] += time.perf_counter() - start_time
+		counter[0] += 1
+	results.add('tow_detection.add', counters['add'][1] * 1e6 / counters['add'][0], 'us', 'lower')
+	results.add('tow_detection.candidates', counters['candidates'][1] * 1e6 / counters['candidates'][0], 'us', 'lower')
+
+def flight_entries(traffic, count):
+	entries = []
+	for i, device in enumerate(traffic.devices * (count // len(traffic.devices) + 1)):
+		entry = FlightState(device['device_id'], i // len(traffic.devices) + 1, 'glider', device, BUFFER_AIRCRAFT_POSITION)
+		for position in traffic.trajectories[device['device_id']][2].positions[:BUFFER_AIRCRAFT_POSITION]:
+			entry.last_positions.appendleft(position[3], position[5], position[6], position[4], position[1], position[2])
+		entries.append(entry.asDict())
+	return entries[:count]
+
+def bench_persistence(results, traffic, args):
+	entries = flight_entries(traffic, SAVES)
+	date = traffic.start.strftime('%Y-%m-%d')
+	engines = ['JSON'] + (['MySQL', 'MySQL-write-behind'] if args.mysql else [])
+	config = configparser.ConfigParser()
+	config.read(args.config_file)
+
+	for engine in engines:
+		cwd = os.getcwd()
+		with tempfile.TemporaryDirectory() as directory:
+			# the JSON engine writes in ./db
+			os.chdir(directory)
+			os.mkdir('db')
+			try:
+				pdo_engine = FlightLogPDO.factory(engine, config['persistence'] if 'persistence' in config else None)
+				pdo_engine.open(config['mysql_connector_python'] if 'mysql_connector_python' in config else None)
+				start_time = time.perf_counter()
+				for entry in entries:
+					pdo_engine.save_aircraft(entry, date)
+				pdo_engine.close()
+				duration = time.perf_counter() - start_time
+			finally:
+				os.chdir(cwd)
+		results.add('persistence.{}.saves_per_second'.format(engine), len(entries) / duration, 'saves/s')
+
+def compare(results, parameters, filepath):
+	with open(filepath) as fp:
+		previous = json.load(fp)
+	print('\nComparison with {} (commit {}, {})'.format(filepath, previous.get('commit'), previous.get('date')))
+	if previous.get('parameters') != parameters:
+		print('  the traffic parameters differ, {} against {}'.format(previous.get('parameters'), parameters))
+	regressions = 0
+	for name, result in results.items():
+		reference = previous['results'].get(name)
+		if reference is None or not reference['value']:
+			continue
+		change = (result['value'] - reference['value']) / abs(reference['value'])
+		worse = -change if result['better'] == 'higher' else change
+		regression = worse > REGRESSION_THRESHOLD
+		regressions += regression
+		print('  {:<48} {:>14} {:>14} {:>+8.1f}% {}'.format(name, round(reference['value'], 3), round(result['value'], 3), 100 * change, 'REGRESSION' if regression else ''))
+	return regressions
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmarks of the logbook on synthetic OGN traffic')
+	parser.add_argument("-n", "--aircraft", action='store', dest='aircraft', type=int, default=100, help='number of aircraft of the traffic, default value is 100')
+	parser.add_argument("--duration", action='store', dest='duration', type=int, default=TRAFFIC_DURATION, help='seconds of traffic, default value is {}'.format(TRAFFIC_DURATION))
+	parser.add_argument("--seed", action='store', dest='seed', type=int, default=TRAFFIC_SEED, help='seed of the traffic generator, default value is {}'.format(TRAFFIC_SEED))
+	parser.add_argument("--scenarios", action='store', dest='scenarios', default=','.join(SCENARIOS), help='comma separated scenarios of the traffic, default value is {}'.format(','.join(SCENARIOS)))
+	parser.add_argument("--airports-dir", action='store', dest='airports_dir', default='.', help='directory of the airports.csv and runways.csv files, default value is .')
+	parser.add_argument("-b", "--benchmarks", action='store', dest='benchmarks', default=','.join(BENCHMARKS), help='comma separated benchmarks to run, default value is {}'.format(','.join(BENCHMARKS)))
+	parser.add_argument("-i", "--ini", action='store', dest='config_file', default='./acph-logbook.ini', help='ini config file of the MySQL connection, default value is ./acph-logbook.ini')
+	parser.add_argument("--mysql", action='store_true', dest='mysql', help='also benchmark the MySQL persistence engines')
+	parser.add_argument("--capture", action='store', dest='capture', help='write the traffic in a capture file acph-replay.py can replay')
+	parser.add_argument("--ddb", action='store', dest='ddb', help='write the aircraft of the traffic in an OGN devices database file for the replay of the capture')
+	parser.add_argument("-o", "--output", action='store', dest='output', help='results file, default value is benchmark/results/bench-logbook-<date>-<time>.json')
+	parser.add_argument("--compare", action='store', dest='compare', help='results file of a previous run to compare with, exit with status 1 on a regression')
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.ERROR)
+
+	airports = OurAirportsDatabase.withCsvFile(args.airports_dir, country='FR').airports
+	start_time = time.perf_counter()
+	traffic = TrafficGenerator(airports, aircraft=args.aircraft, duration=args.duration, seed=args.seed, scenarios=tuple(args.scenarios.split(',')))
+	beacons = traffic.beacons()
+	print('{} aircraft, {} beacons around {} airfields, generated in {}s'.format(len(traffic.devices), len(beacons), len(traffic.airfields), round(time.perf_counter() - start_time, 3)))
+	if args.capture:
+		traffic.writeCapture(args.capture)
+	if args.ddb:
+		traffic.writeDevices(args.ddb)
+
+	results = BenchmarkResults()
+	generator = random.Random(args.seed)
+	benchmarks = args.benchmarks.split(',')
+	if 'handle_beacon' in benchmarks:
+		bench_handle_beacon(results, traffic, airports, beacons)
+	if 'nearest_airport' in benchmarks:
+		bench_nearest_airport(results, traffic, airports, generator)
+	if 'detect_runway' in benchmarks:
+		bench_detect_runway(results, traffic, airports, generator)
+	if 'tow_detection' in benchmarks:
+		bench_tow_detection(results, traffic)
+	if 'persistence' in benchmarks:
+		bench_persistence(results, traffic, args)
+
+	parameters = {'aircraft': args.aircraft, 'duration': args.duration, 'seed': args.seed, 'scenarios': args.scenarios, 'beacons': len(beacons), 'airfields': len(traffic.airfields)}
+	output = args.output or os.path.join(RESULTS_DIR, 'bench-logbook-{}.json'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S')))
+	os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+	with open(output, 'w') as fp:
+		json.dump({
+			'benchmark': 'logbook',
+			'date': datetime.datetime.now().isoformat(timespec='seconds'),
+			'commit': git_commit(),
+			'python': platform.python_version(),
+			'parameters': parameters,
+			'results': results.results,
+		}, fp, indent=4, sort_keys=True)
+	print('Results saved in {}'.format(output))
+
+	if args.compare:
+		sys.exit(1 if compare(results.results, parameters, args.compare) else 0)
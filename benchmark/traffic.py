@@ -0,0 +1,320 @@
+#  This module contains a deterministic generator of OGN APRS traffic around the airfields of an airports database,
+#  used by the benchmarks: aircraft on the ground, aerotows, winch launches, cross-country flights and landings,
+#  each aircraft sending a FLARM position beacon every 2 seconds, and the receivers of the airfields their own
+#  position and status beacons.
+
+import json
+import math
+import random
+import datetime
+
+from acph.class_airport_db import RUNWAY_DIRECTION_REGEX
+
+SCENARIOS = ('ground', 'aerotow', 'winch', 'cross_country', 'landing')
+TRAFFIC_SEED = 20200814
+TRAFFIC_START = datetime.datetime(2020, 8, 14, 9, 0, 0)
+TRAFFIC_DURATION = 3600					# seconds of traffic
+TRAFFIC_AIRFIELDS = 30					# max number of airfields the flights start from
+AIRFIELD_TYPES = ('small_airport', 'medium_airport')
+BEACON_INTERVAL = 2						# seconds between 2 positions of an aircraft
+RECEIVER_INTERVAL = 300					# seconds between 2 position and status beacons of a receiver
+ADDRESS_BASE = 0xD00000					# flarm address of the first generated aircraft
+TOW_DISTANCE = 0.05						# km between a tow plane and its glider
+
+GLIDER = 1								# OGN aircraft types
+TOW_PLANE = 2
+ADDRESS_TYPE_FLARM = 2
+
+KM_PER_DEGREE = 111.2					# km per degree of latitude
+KMH_TO_KNOTS = 1 / 1.852
+METER_TO_FEET = 1 / 0.3048
+MS_TO_FPM = 60 / 0.3048
+
+def aprs_coordinate(value, degrees_digits, hemispheres):
+	""" APRS ddmm.mm (or dddmm.mm) coordinate and the third decimal of the minutes, for the !W..! precision extension. """
+	hemisphere = hemispheres[0] if value >= 0 else hemispheres[1]
+	minutes = round(abs(value) * 60000)
+	degrees, minutes = divmod(minutes, 60000)
+	return '{:0{}d}{:02d}.{:02d}{}'.format(degrees, degrees_digits, minutes // 1000, minutes % 1000 // 10, hemisphere), minutes % 10
+
+def aircraft_beacon(timestamp, address, aircraft_type, receiver, latitude, longitude, altitude, track, speed, climb_rate):
+	latitude, latitude_precision = aprs_coordinate(latitude, 2, 'NS')
+	longitude, longitude_precision = aprs_coordinate(longitude, 3, 'EW')
+	return "FLR{address}>OGFLR,qAS,{receiver}:/{time}h{latitude}/{longitude}'{track:03d}/{speed:03d}/A={altitude:06d} !W{latitude_precision}{longitude_precision}! id{details:02X}{address} {climb_rate:+04d}fpm +0.0rot 8.8dB 0e +1.2kHz gps4x5".format(
+		address=address, receiver=receiver, time=timestamp.strftime('%H%M%S'), latitude=latitude, longitude=longitude, track=round(track) % 360,
+		speed=round(speed * KMH_TO_KNOTS), altitude=max(0, round(altitude * METER_TO_FEET)), latitude_precision=latitude_precision, longitude_precision=longitude_precision,
+		details=aircraft_type << 2 | ADDRESS_TYPE_FLARM, climb_rate=round(climb_rate * MS_TO_FPM))
+
+def receiver_beacons(timestamp, receiver, latitude, longitude, altitude):
+	latitude, _ = aprs_coordinate(latitude, 2, 'NS')
+	longitude, _ = aprs_coordinate(longitude, 3, 'EW')
+	time = timestamp.strftime('%H%M%S')
+	return [
+		'{}>OGNSDR,TCPIP*,qAC,GLIDERN3:/{}h{}I{}&/A={:06d}'.format(receiver, time, latitude, longitude, round(altitude * METER_TO_FEET)),
+		'{}>OGNSDR,TCPIP*,qAC,GLIDERN3:>{}h v0.2.8.RPI-GPU CPU:0.3 RAM:771.3/972.2MB NTP:0.4ms/+1.1ppm +49.9C'.format(receiver, time),
+	]
+
+def registration(prefix, index):
+	letters = ''
+	for _ in range(3):
+		index, letter = divmod(index, 26)
+		letters = chr(ord('A') + letter) + letters
+	return prefix + letters
+
+class Trajectory:
+
+	""" Positions of an aircraft, one every BEACON_INTERVAL seconds, built phase by phase. """
+
+	def __init__(self, start, airport, latitude, longitude, altitude, track):
+		self.time = start
+		self.airport = airport
+		self.latitude = latitude
+		self.longitude = longitude
+		self.altitude = altitude
+		self.track = track
+		self.positions = []		# (timestamp, latitude, longitude, altitude, track, speed, climb rate)
+
+	def step(self, speed, climb_rate, track=None):
+		if track is not None:
+			self.track = track % 360
+		distance = speed / 3.6 * BEACON_INTERVAL / 1000
+		self.latitude += distance * math.cos(math.radians(self.track)) / KM_PER_DEGREE
+		self.longitude += distance * math.sin(math.radians(self.track)) / (KM_PER_DEGREE * math.cos(math.radians(self.latitude)))
+		self.altitude = max(self.airport.elevation_m, self.altitude + climb_rate * BEACON_INTERVAL)
+		self.time += datetime.timedelta(seconds=BEACON_INTERVAL)
+		self.positions.append((self.time, self.latitude, self.longitude, self.altitude, self.track, speed, climb_rate))
+
+	def hold(self, duration):
+		for _ in range(int(duration // BEACON_INTERVAL)):
+			self.step(0, 0)
+
+	def fly(self, duration, speed, climb_rate, track=None):
+		for _ in range(int(duration // BEACON_INTERVAL)):
+			self.step(speed, climb_rate, track)
+
+	def roll(self, speeds, climb_rate=0):
+		for speed in speeds:
+			self.step(speed, climb_rate)
+
+	def bearing(self, latitude, longitude):
+		y = (longitude - self.longitude) * math.cos(math.radians(self.latitude))
+		x = latitude - self.latitude
+		return math.degrees(math.atan2(y, x)) % 360, math.hypot(x, y) * KM_PER_DEGREE
+
+	def flyTo(self, latitude, longitude, speed, altitude):
+		""" Fly straight to a point, reaching `altitude` on it. """
+		track, distance = self.bearing(latitude, longitude)
+		steps = max(1, int(distance / (speed / 3.6 * BEACON_INTERVAL / 1000)))
+		climb_rate = (altitude - self.altitude) / (steps * BEACON_INTERVAL)
+		for _ in range(steps):
+			self.step(speed, climb_rate, track)
+
+	def land(self, runway_track):
+		""" Join a final 2km before the runway, land on it and stop. """
+		airport = self.airport
+		final_latitude = airport.lat - 2 * math.cos(math.radians(runway_track)) / KM_PER_DEGREE
+		final_longitude = airport.lon - 2 * math.sin(math.radians(runway_track)) / (KM_PER_DEGREE * math.cos(math.radians(airport.lat)))
+		self.flyTo(final_latitude, final_longitude, 110, airport.elevation_m + 150)
+		self.flyTo(airport.lat, airport.lon, 90, airport.elevation_m)
+		self.roll((60, 40, 25, 10, 0))
+		self.hold(60)
+
+class TrafficGenerator:
+
+	""" Synthetic OGN traffic of `aircraft` aircraft around the airfields of `airports`.
+
+	Each aircraft follows a scenario chosen among `scenarios` with a random
+	generator seeded by `seed`, the same parameters always give the same
+	beacons. The flights start during the first half of `duration` seconds
+	from `start`, and the beacons after the end are dropped.
+
+	- ground: a glider or a tow plane standing or taxiing on an airfield,
+	- aerotow: a tow plane and a glider taking off together, the glider is
+	  released after 5 minutes, both come back to land,
+	- winch: a glider launched by a winch, climbing at 15m/s,
+	- cross_country: a glider crossing the region 20 to 40km from an airfield,
+	- landing: a tow plane coming from 15km away to land, its launch type is
+	  autonome as soon as it flies near the airfield.
+
+	`expected` gives, for each aircraft address, the scenario, and the launch
+	type and status the logbook should find for its first flight.
+
+	Parameters
+	----------
+	airports : dict
+		Airports database, icao -> AirportCodeValue.
+	aircraft : int, optional
+		Number of aircraft, an aerotow counts for 2.
+	duration : int, optional
+		Seconds of traffic.
+	seed : int, optional
+		Seed of the random generator.
+	start : datetime, optional
+		Time of the first beacon.
+	scenarios : tuple of str, optional
+		Scenarios the aircraft are given.
+	airfields : int, optional
+		Max number of airfields used.
+	"""
+
+	def __init__(self, airports, aircraft=100, duration=TRAFFIC_DURATION, seed=TRAFFIC_SEED, start=TRAFFIC_START, scenarios=SCENARIOS, airfields=TRAFFIC_AIRFIELDS):
+		for scenario in scenarios:
+			if scenario not in SCENARIOS:
+				raise ValueError('{} is an invalid traffic scenario.'.format(scenario))
+		self.random = random.Random(seed)
+		self.seed = seed
+		self.duration = duration
+		self.start = start
+		self.end = start + datetime.timedelta(seconds=duration)
+
+		candidates = sorted(icao for icao, airport in airports.items() if airport.type in AIRFIELD_TYPES)
+		if not candidates:
+			raise ValueError('No airfield to generate the traffic from.')
+		self.airfields = [airports[icao] for icao in sorted(self.random.sample(candidates, min(airfields, len(candidates))))]
+
+		self.devices = []		# OGN devices database entries of the aircraft
+		self.expected = {}		# address -> expected logbook result
+		self.trajectories = {}	# address -> (aircraft type, receiver, Trajectory)
+		generators = {
+			'ground': self.generateGround,
+			'aerotow': self.generateAerotow,
+			'winch': self.generateWinch,
+			'cross_country': self.generateCrossCountry,
+			'landing': self.generateLanding,
+		}
+		while len(self.devices) < aircraft:
+			generators[self.random.choice(scenarios)]()
+
+	def runwayTrack(self, airport):
+		# heading of the first runway designator, a random heading if the airfield has no runway
+		for runway in airport.runways:
+			match = RUNWAY_DIRECTION_REGEX.search(runway.direction)
+			if match is not None:
+				return int(match.group(1)) * 10 % 360
+		return self.random.randrange(0, 360, 10)
+
+	def startTime(self):
+		return self.start + datetime.timedelta(seconds=self.random.randrange(0, max(1, self.duration // 2)))
+
+	def addAircraft(self, aircraft_type, scenario, trajectory, launch_type, status):
+		index = len(self.devices)
+		address = '{:06X}'.format(ADDRESS_BASE + index)
+		self.devices.append({
+			'device_type': 'F',
+			'device_id': address,
+			'aircraft_model': 'ASK-21' if aircraft_type == GLIDER else 'Robin DR400',
+			'registration': registration('F-C' if aircraft_type == GLIDER else 'F-G', index),
+			'cn': '{:02d}'.format(index % 100),
+			'tracked': 'Y',
+			'identified': 'Y',
+		})
+		# the final status is unknown when the traffic ends before the end of the scenario
+		self.expected[address] = {'scenario': scenario, 'launch_type': launch_type, 'status': status if trajectory.positions[-1][0] < self.end else None}
+		self.trajectories[address] = (aircraft_type, trajectory.airport.icao, trajectory)
+		return address
+
+	def takeoffTrajectory(self, airport, start, track, offset=0.0):
+		# on the runway threshold, `offset` km behind it
+		latitude = airport.lat - offset * math.cos(math.radians(track)) / KM_PER_DEGREE
+		longitude = airport.lon - offset * math.sin(math.radians(track)) / (KM_PER_DEGREE * math.cos(math.radians(airport.lat)))
+		return Trajectory(start, airport, latitude, longitude, airport.elevation_m, track)
+
+	def generateGround(self):
+		airport = self.random.choice(self.airfields)
+		trajectory = self.takeoffTrajectory(airport, self.startTime(), self.runwayTrack(airport), self.random.uniform(0, 0.3))
+		for _ in range(self.random.randint(2, 6)):
+			trajectory.hold(self.random.uniform(60, 300))
+			trajectory.fly(self.random.uniform(10, 60), self.random.uniform(5, 20), 0, self.random.randrange(0, 360))
+		self.addAircraft(self.random.choice((GLIDER, TOW_PLANE)), 'ground', trajectory, '#unknown', 'ground')
+
+	def generateAerotow(self):
+		airport = self.random.choice(self.airfields)
+		start = self.startTime()
+		track = self.runwayTrack(airport)
+		tow_plane = self.takeoffTrajectory(airport, start, track)
+		# the glider sends its beacons one second after the tow plane
+		glider = self.takeoffTrajectory(airport, start + datetime.timedelta(seconds=1), track, TOW_DISTANCE)
+		for trajectory in (tow_plane, glider):
+			trajectory.hold(60)
+			trajectory.roll((20, 40, 60, 80, 100))
+			trajectory.fly(300, 110, 3)
+
+		# release, the tow plane comes back, the glider flies for a while before landing
+		tow_plane.fly(60, 150, -4, track + 180)
+		tow_plane.land(track)
+		glider.fly(self.random.uniform(600, 1800), 90, -0.3, self.random.randrange(0, 360))
+		glider.land(track)
+
+		self.addAircraft(TOW_PLANE, 'aerotow', tow_plane, 'autonome', 'landed')
+		self.addAircraft(GLIDER, 'aerotow', glider, self.devices[-1]['registration'], 'landed')
+
+	def generateWinch(self):
+		airport = self.random.choice(self.airfields)
+		track = self.runwayTrack(airport)
+		trajectory = self.takeoffTrajectory(airport, self.startTime(), track)
+		trajectory.hold(60)
+		trajectory.roll((60, 90, 100), 10)
+		trajectory.fly(40, 100, 15)
+		trajectory.fly(self.random.uniform(300, 900), 90, -0.8, self.random.randrange(0, 360))
+		trajectory.land(track)
+		self.addAircraft(GLIDER, 'winch', trajectory, 'winch', 'landed')
+
+	def generateCrossCountry(self):
+		airport = self.random.choice(self.airfields)
+		distance = self.random.uniform(20, 40)
+		bearing = self.random.uniform(0, 360)
+		latitude = airport.lat + distance * math.cos(math.radians(bearing)) / KM_PER_DEGREE
+		longitude = airport.lon + distance * math.sin(math.radians(bearing)) / (KM_PER_DEGREE * math.cos(math.radians(airport.lat)))
+		trajectory = Trajectory(self.startTime(), airport, latitude, longitude, airport.elevation_m + self.random.uniform(800, 2000), self.random.uniform(0, 360))
+		trajectory.fly(self.random.uniform(600, 1800), self.random.uniform(80, 130), self.random.uniform(-0.3, 0.3))
+		self.addAircraft(GLIDER, 'cross_country', trajectory, '#unknown', 'air')
+
+	def generateLanding(self):
+		airport = self.random.choice(self.airfields)
+		track = self.runwayTrack(airport)
+		bearing = self.random.uniform(0, 360)
+		latitude = airport.lat + 15 * math.cos(math.radians(bearing)) / KM_PER_DEGREE
+		longitude = airport.lon + 15 * math.sin(math.radians(bearing)) / (KM_PER_DEGREE * math.cos(math.radians(airport.lat)))
+		trajectory = Trajectory(self.startTime(), airport, latitude, longitude, airport.elevation_m + 600, 0)
+		trajectory.land(track)
+		self.addAircraft(TOW_PLANE, 'landing', trajectory, 'autonome', 'landed')
+
+	def beacons(self):
+		""" (timestamp, raw APRS message) of all the beacons, by time. """
+		beacons = []
+		for address, (aircraft_type, receiver, trajectory) in self.trajectories.items():
+			for timestamp, latitude, longitude, altitude, track, speed, climb_rate in trajectory.positions:
+				if timestamp < self.end:
+					beacons.append((timestamp, aircraft_beacon(timestamp, address, aircraft_type, receiver, latitude, longitude, altitude, track, speed, climb_rate)))
+
+		# a generator of its own, the beacons are the same each time
+		generator = random.Random(self.seed)
+		for airport in self.airfields:
+			timestamp = self.start + datetime.timedelta(seconds=generator.randrange(RECEIVER_INTERVAL))
+			while timestamp < self.end:
+				beacons.extend((timestamp, beacon) for beacon in receiver_beacons(timestamp, airport.icao, airport.lat, airport.lon, airport.elevation_m))
+				timestamp += datetime.timedelta(seconds=RECEIVER_INTERVAL)
+
+		beacons.sort(key=lambda beacon: beacon[0])
+		return beacons
+
+	def towPlanePositions(self):
+		""" Positions of the tow planes as added to the logbook tow planes index, by time. """
+		positions = []
+		for address, (aircraft_type, receiver, trajectory) in self.trajectories.items():
+			if aircraft_type == TOW_PLANE:
+				positions.extend({'aircraft_id': address, 'registration': address, 'timestamp': timestamp, 'latitude': latitude, 'longitude': longitude, 'altitude': altitude,
+					'track': track, 'ground_speed': speed, 'climb_rate': climb_rate} for timestamp, latitude, longitude, altitude, track, speed, climb_rate in trajectory.positions)
+		positions.sort(key=lambda position: position['timestamp'])
+		return positions
+
+	def writeCapture(self, filepath):
+		""" Write the beacons as a log of the logbook, a capture acph-replay.py can replay. """
+		with open(filepath, 'w') as fp:
+			for timestamp, beacon in self.beacons():
+				fp.write('[{},000] acph.class_flights_logbook.INFO: raw data: {}\n'.format(timestamp.strftime('%Y-%m-%d %H:%M:%S'), beacon))
+
+	def writeDevices(self, filepath):
+		""" Write the aircraft as an OGN devices database JSON file, the one acph-replay.py loads with the capture. """
+		with open(filepath, 'w') as fp:
+			json.dump({'devices': self.devices}, fp)
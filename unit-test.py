@@ -66,8 +66,8 @@ def main():
 		logger.error("File path {} does not exist. Exiting...".format(filepath))
 		sys.exit()
 
-	# Create the PDO Engine to store the results on the fly: could be JSON or MySql
-	pdo_engine = FlightLogPDO.factory(config['logbook']['persistence'] if 'logbook' in config else 'JSON')
+	# Create the PDO Engine to store the results on the fly: could be JSON, MySql or MySql-write-behind
+	pdo_engine = FlightLogPDO.factory(config['logbook']['persistence'] if 'logbook' in config else 'JSON', config['persistence'] if 'persistence' in config else None)
 	pdo_engine.open(config['mysql_connector_python'])
 
 	# take the opportunity to purge data hold in the persistence engine
@@ -77,7 +77,8 @@ def main():
 	# logbook = FlightsLogBook(receivers_filter={'LFHA','LFHP'}, ogndb = ogndb, airports_db = listOfAirportsFiltered, pdo_engine = pdo_engine)
 
 	# create the ACPH Flight logbook and handling all the beacons received
-	logbook = FlightsLogBook(receivers_filter={'NAVITER'}, ogndb = ogndb, airports_db = listOfAirportsFiltered, pdo_engine = pdo_engine)
+	logbook_config = config['logbook'] if 'logbook' in config else {}
+	logbook = FlightsLogBook(receivers_filter={'NAVITER'}, ogndb = ogndb, airports_db = listOfAirportsFiltered, pdo_engine = pdo_engine, airports_engine = logbook_config.get('airports_engine', 'vptree'), cache_dir = logbook_config.get('cache_dir'))
 
 	# logbook.airports = {k: v for k, v in airports.items() if k in {'LFHA', 'LFHR', 'LFHT', 'LFHP'}}		# filter only some french airports for test purpose
 	# logbook.airports = {k: v for k, v in airports.items() if k in {'LFHA'}}		# filter only some french airports for test purpose
@@ -121,7 +122,8 @@ def main():
 	stop_time = time.process_time()
 	logger.info('End of parsing, execution time {} seconds'.format(timedelta(seconds=stop_time-start_time)))
 
-	# close the logbook persistent engine
+	# save the pending logbook changes and close the logbook persistent engine
+	logbook.flush()
 	logbook.pdo_engine.close()
 
 	# For test purpose dump internal logbook structure results